@@ -0,0 +1,29 @@
+"""
+Tracker client backends.
+
+'sync' - WebClient performs blocking requests, update lanes run in OS threads.
+'gevent' - socket, time and threading modules are patched, so the same
+WebClient code becomes cooperative and lanes run as greenlets in a single
+thread. Many more lanes fit in one process this way.
+"""
+SYNC = 'sync'
+GEVENT = 'gevent'
+
+
+def setup(backend):
+    """
+    Activate tracker client backend. Must be called as early as possible,
+    before any network or threading code runs
+    """
+    if backend == SYNC:
+        return
+
+    if backend != GEVENT:
+        raise ValueError('Unknown tracker client backend: {}'.format(backend))
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise RuntimeError('gevent is required for {} backend'.format(backend))
+
+    monkey.patch_all()
@@ -1,49 +1,287 @@
 import os
-from UserDict import DictMixin
+import time
+import zlib
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Namespace and key for category tree javascript
+TREE_NAMESPACE = 'tree'
+CATEGORY_TREE_KEY = 'category_tree.json'
+
+# Keys for pre-rendered feed and its metadata (last update time, ttl) in
+# feed namespace
+FEED_KEY = 'feed.xml'
+FEED_META_KEY = 'meta.json'
+
+# Namespace versions changed by other processes are noticed after this
+# interval, seconds
+VERSION_CHECK_INTERVAL = 1
+
+# Content encodings of precompressed cache items, in order of preference
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+# File name suffixes of precompressed items
+_ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+def get_cache(config):
+    """Returns process-wide cache in DATA_DIR"""
+    directory = os.path.join(config.DATA_DIR, 'cache')
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = Cache(directory, config.CACHE_MEMORY_SIZE,
+                                       config.CACHE_MEMORY_TTL)
+        return _caches[directory]
+
+
+def feed_namespace(category_id):
+    """Cache namespace for feed of the category"""
+    return 'feed-{}'.format(category_id)
+
+
+def compressed_key(key, encoding):
+    """Cache key for item compressed with content encoding"""
+    return key + _ENCODING_SUFFIXES[encoding]
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        # wbits offset 16 produces gzip header and trailer
+        compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == 'br':
+        return brotli.compress(data)
+    else:
+        raise ValueError('Unsupported encoding: {}'.format(encoding))
+
+
+def store_compressed(cache, namespace, key, data, version=None):
+    """
+    Store precompressed variants of cache item
+    :returns dict(encoding: compressed data)
+    """
+    variants = dict()
+    for encoding in ENCODINGS:
+        variants[encoding] = compress(data, encoding)
+        cache.set(namespace, compressed_key(key, encoding), variants[encoding],
+                  version)
+    return variants
+
 
 @contextmanager
-def open_for_atomic_write(name):
+def open_for_atomic_write(name, sync=True):
     dirpath, filename = os.path.split(name)
     # use the same dir for os.rename() to work
     with NamedTemporaryFile(dir=dirpath, prefix=filename, suffix='.tmp') as f:
         yield f
         f.flush()  # libc -> OS
-        os.fsync(f)  # OS -> disc (note: on OSX it is not enough)
+        if sync:
+            os.fsync(f)  # OS -> disc (note: on OSX it is not enough)
         f.delete = False  # don't delete tmp file if `replace()` fails
         f.close()
         os.rename(f.name, name)
 
 
-class DiskCache(DictMixin):
-    def __init__(self, directory):
+class LRUCache(object):
+    """
+    Thread-safe in-memory cache of string values, limited by number of items
+    and their total size. Items expire after ttl seconds, if ttl is set.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, ttl=None):
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.time():
+                self._bytes -= len(value)
+                return default
+
+            self._items[key] = (value, expires)
+            return value
+
+    def put(self, key, value):
+        if self._max_bytes is not None and len(value) > self._max_bytes:
+            return
+
+        expires = time.time() + self._ttl if self._ttl else None
+        with self._lock:
+            self._pop(key)
+            self._items[key] = (value, expires)
+            self._bytes += len(value)
+
+            while (self._max_items is not None and
+                   len(self._items) > self._max_items) or \
+                    (self._max_bytes is not None and
+                     self._bytes > self._max_bytes):
+                _, (evicted, _) = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item[0])
+
+    def __len__(self):
+        return len(self._items)
+
+
+class Cache(object):
+    """
+    Two-tier cache: in-process LRU in front of directory shared by all
+    processes. Keys belong to namespaces, each namespace has a version,
+    changing the version invalidates all keys in namespace in all processes.
+    """
+
+    def __init__(self, directory, max_bytes, ttl):
         self._dir = directory
+        self._memory = LRUCache(max_bytes=max_bytes, ttl=ttl)
+        self._versions = dict()
+        self._lock = threading.Lock()
 
-    def full_path(self, key):
-        if os.sep in key or os.pathsep in key:
+    def _version_path(self, namespace):
+        return os.path.join(self._dir, namespace, 'VERSION')
+
+    def version(self, namespace):
+        """Current version of namespace, re-read at most once per
+        VERSION_CHECK_INTERVAL"""
+        now = time.time()
+        with self._lock:
+            version, checked = self._versions.get(namespace, (None, 0))
+        if now - checked < VERSION_CHECK_INTERVAL:
+            return version
+
+        try:
+            with open(self._version_path(namespace)) as f:
+                version = f.read().strip() or '0'
+        except IOError:
+            version = '0'
+
+        with self._lock:
+            self._versions[namespace] = (version, now)
+        return version
+
+    def bump(self, namespace):
+        """Invalidate all items in namespace"""
+        # Time-based versions do not need read-modify-write
+        version = '{:x}'.format(int(time.time() * 1000000))
+        self._ensure_dir(namespace)
+        with open_for_atomic_write(self._version_path(namespace),
+                                   sync=False) as f:
+            f.write(version)
+        with self._lock:
+            self._versions[namespace] = (version, time.time())
+        return version
+
+    def _ensure_dir(self, namespace):
+        path = os.path.join(self._dir, namespace)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def path(self, namespace, key, version=None):
+        """Path of file in shared tier"""
+        if os.sep in key or os.sep in namespace:
             raise IndexError
-        return os.path.join(self._dir, key)
+        if version is None:
+            version = self.version(namespace)
+        return os.path.join(self._dir, namespace,
+                            '{}-{}'.format(version, key))
+
+    def get(self, namespace, key, version=None):
+        """
+        Get value stored under namespace version, current version by
+        default
+        :returns cached value or None
+        """
+        if version is None:
+            version = self.version(namespace)
+        memory_key = (namespace, version, key)
+
+        value = self._memory.get(memory_key)
+        if value is not None:
+            return value
 
-    def __getitem__(self, key):
         try:
-            with open(self.full_path(key)) as f:
-                return f.read()
+            with open(self.path(namespace, key, version), 'rb') as f:
+                value = f.read()
         except IOError:
-            raise KeyError
+            return None
 
-    def __setitem__(self, key, value):
-        if not os.path.isdir(self._dir):
-            os.makedirs(self._dir)
+        self._memory.put(memory_key, value)
+        return value
 
-        with open_for_atomic_write(self.full_path(key)) as f:
+    def set(self, namespace, key, value, version=None):
+        """
+        Store value under namespace version, current version by default.
+        Value built from data read before version changed should be stored
+        under version read before that data
+        """
+        if version is None:
+            version = self.version(namespace)
+        self._ensure_dir(namespace)
+        # Cache is rebuilt if lost, no fsync required
+        with open_for_atomic_write(self.path(namespace, key, version),
+                                   sync=False) as f:
             f.write(value)
+        self._memory.put((namespace, version, key), value)
+
+    def purge_stale(self):
+        """
+        Remove files of old namespace versions from shared tier
+        :returns int Number of removed files
+        """
+        if not os.path.isdir(self._dir):
+            return 0
+
+        removed = 0
+        for namespace in os.listdir(self._dir):
+            ns_dir = os.path.join(self._dir, namespace)
+            if not os.path.isdir(ns_dir):
+                continue
 
-    def __delitem__(self, key):
-        os.remove(self.full_path(key))
+            with self._lock:
+                self._versions.pop(namespace, None)
+            prefix = self.version(namespace) + '-'
 
-    def __contains__(self, key):
-        return os.path.isfile(self.full_path(key))
+            for name in os.listdir(ns_dir):
+                # Temporary files may be in use by writers
+                if name == 'VERSION' or name.startswith(prefix) or \
+                        name.endswith('.tmp'):
+                    continue
+                try:
+                    os.remove(os.path.join(ns_dir, name))
+                    removed += 1
+                except OSError:
+                    pass
 
-        # keys() __iter__(), and iteritems().
+        return removed
@@ -16,6 +16,36 @@ ANNOUNCE_URLS = [
     'http://bt4.{host}/ann'.format(host=TRACKER_HOST)
 ]
 
+# Tracker client backend, 'sync' or 'gevent', see rtrss.backends
+WEBCLIENT_BACKEND = os.environ.get('RTRSS_WEBCLIENT_BACKEND', 'sync')
+
+# Number of tracker accounts processing topics concurrently during update,
+# each account works in its own lane. 1 means serial processing
+UPDATE_CONCURRENCY = 3
+
+# Number of worker processes parsing tracker pages, so parsing does not
+# block network requests of update and populate lanes. 0 means pages are
+# parsed by lanes themselves. Not used with gevent backend
+PARSE_PROCESSES = int(os.environ.get('RTRSS_PARSE_PROCESSES', 0))
+
+# Minimum interval between tracker requests of each kind, per account, seconds
+REQUEST_INTERVALS = {
+    'page': 0.5,
+    'search': 1.8,
+    'torrent': 5,
+}
+
+# Maximum number of HTTP sessions kept alive between tracker requests
+SESSION_POOL_SIZE = 10
+
+# Sessions not used for this long are closed, seconds
+SESSION_MAX_IDLE = 300
+
+# In-process tier of feed and category tree cache: size limit, bytes, and
+# item lifetime, seconds
+CACHE_MEMORY_SIZE = 32 * 1024 * 1024
+CACHE_MEMORY_TTL = 300
+
 LOGLEVEL = logging.INFO
 
 LOG_FORMAT_LOGENTRIES = '%(levelname)s %(name)s %(message)s'
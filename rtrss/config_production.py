@@ -1,6 +1,7 @@
 import os
 
-SQLALCHEMY_DATABASE_URI = os.environ.get('OPENSHIFT_POSTGRESQL_DB_URL')
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    'RTRSS_DATABASE_URL', os.environ.get('OPENSHIFT_POSTGRESQL_DB_URL'))
 
 # directory to store runtime data, write access required
 DATA_DIR = os.environ.get('OPENSHIFT_DATA_DIR')
@@ -10,7 +11,12 @@ SECRET_KEY = os.environ.get('RTRSS_SECRET_KEY')
 FILESTORAGE_SETTINGS = {
     'URL': os.environ.get('RTRSS_FILESTORAGE_URL'),
     'PRIVATEKEY_URL': os.environ.get('RTRSS_GCS_PRIVATEKEY_URL'),
-    'CLIENT_EMAIL': os.environ.get('RTRSS_CLIENT_EMAIL')
+    'CLIENT_EMAIL': os.environ.get('RTRSS_CLIENT_EMAIL'),
+    # Local torrent file cache limits, bytes
+    'CACHE_SIZE': int(os.environ.get('RTRSS_TORRENT_CACHE_SIZE',
+                                     200 * 1024 * 1024)),
+    'MEMORY_CACHE_SIZE': int(os.environ.get('RTRSS_TORRENT_MEMORY_CACHE_SIZE',
+                                            16 * 1024 * 1024)),
 }
 
 PORT = int(os.environ.get('OPENSHIFT_PYTHON_PORT'))
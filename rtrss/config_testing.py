@@ -9,6 +9,8 @@ DATA_DIR = os.path.join(ROOT_DIR, 'data')
 
 TESTING = True
 
+DEBUG = False
+
 SECRET_KEY = 'development key'
 
 FILESTORAGE_SETTINGS = {
@@ -4,8 +4,10 @@ from contextlib import contextmanager
 
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import create_engine, exists, select
+from sqlalchemy import create_engine, exists, select, text
 from sqlalchemy.schema import CreateSchema, DropSchema
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.ext.compiler import compiles
 
 from rtrss.exceptions import OperationInterruptedException
 from rtrss import config
@@ -13,6 +15,56 @@ from rtrss import config
 
 SCHEMA_NAME = 'public'
 
+# Upserts need PostgreSQL 9.5+, migrations need 9.6+
+MIN_SERVER_VERSION = 90600
+
+# Idempotent statements to bring schema of existing database up to date
+MIGRATIONS = [
+    'ALTER TABLE topics '
+    'ADD COLUMN IF NOT EXISTS has_torrent BOOLEAN NOT NULL DEFAULT false',
+
+    'UPDATE topics SET has_torrent = true '
+    'WHERE NOT has_torrent AND id IN (SELECT id FROM torrents)',
+
+    'CREATE INDEX IF NOT EXISTS ix_category_updated_at '
+    'ON topics (category_id, updated_at DESC) WHERE has_torrent',
+
+    'ALTER TABLE category_stats '
+    'ADD COLUMN IF NOT EXISTS needs_cleanup BOOLEAN NOT NULL DEFAULT false',
+]
+
+REBUILD_CLOSURE_SQL = text("""
+DELETE FROM category_closure;
+INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+    SELECT id, id, 0 FROM categories
+    UNION ALL
+    SELECT tree.ancestor_id, c.id, tree.depth + 1
+    FROM tree JOIN categories c ON c.parent_id = tree.descendant_id
+)
+SELECT ancestor_id, descendant_id, depth FROM tree;
+""")
+
+REBUILD_STATS_SQL = text("""
+DELETE FROM category_stats;
+INSERT INTO category_stats (category_id, torrents, subtree_torrents,
+                            needs_cleanup)
+SELECT c.id, coalesce(own.cnt, 0), coalesce(sub.cnt, 0), true
+FROM categories c
+LEFT JOIN (
+    SELECT t.category_id, count(*) AS cnt
+    FROM topics t JOIN torrents tr ON tr.id = t.id
+    GROUP BY t.category_id
+) own ON own.category_id = c.id
+LEFT JOIN (
+    SELECT cc.ancestor_id, count(*) AS cnt
+    FROM category_closure cc
+    JOIN topics t ON t.category_id = cc.descendant_id
+    JOIN torrents tr ON tr.id = t.id
+    GROUP BY cc.ancestor_id
+) sub ON sub.ancestor_id = c.id;
+""")
+
 _logger = logging.getLogger(__name__)
 
 
@@ -45,17 +97,89 @@ def session_scope(sessionfactory=None):
         session.close()
 
 
+class Upsert(Insert):
+    """
+    INSERT ... ON CONFLICT DO UPDATE statement (PostgreSQL 9.5+). Rows
+    conflicting on key columns are updated with inserted values
+    """
+    def __init__(self, table, key=('id', ), **kwargs):
+        super(Upsert, self).__init__(table, **kwargs)
+        self.conflict_key = key
+
+
+@compiles(Upsert)
+def compile_upsert(upsert, compiler, **kwargs):
+    statement = compiler.visit_insert(upsert, **kwargs)
+    params = upsert.parameters
+    columns = (params[0] if isinstance(params, list) else params).keys()
+    quote = compiler.preparer.quote
+
+    updates = ', '.join(
+        '{0} = EXCLUDED.{0}'.format(quote(c))
+        for c in columns if c not in upsert.conflict_key
+    )
+    key = ', '.join(quote(c) for c in upsert.conflict_key)
+    return '{} ON CONFLICT ({}) DO UPDATE SET {}'.format(statement, key,
+                                                         updates)
+
+
+def upsert(db, table, rows):
+    """Insert or update rows (list of dicts) with single statement"""
+    if rows:
+        db.execute(Upsert(table).values(rows))
+
+
 def init(eng=None):
     _logger.info('Initializing database')
 
     if eng is None:
         eng = engine
+    check_server_version(eng)
     if not schema_exists(SCHEMA_NAME):
         eng.execute(CreateSchema(SCHEMA_NAME))
     from rtrss.models import Base
     Base.metadata.create_all(bind=eng)
 
 
+def migrate(eng=None):
+    _logger.info('Migrating database')
+
+    if eng is None:
+        eng = engine
+    check_server_version(eng)
+    from rtrss.models import Base
+    Base.metadata.create_all(bind=eng)
+
+    for statement in MIGRATIONS:
+        eng.execute(text(statement))
+
+    # Closure and counters of existing categories, tables may be just created
+    rebuild_category_stats(eng)
+
+
+def rebuild_category_stats(eng=None):
+    """Rebuild category closure table and torrent counters from scratch"""
+    if eng is None:
+        eng = engine
+    with eng.begin() as conn:
+        conn.execute(REBUILD_CLOSURE_SQL)
+        conn.execute(REBUILD_STATS_SQL)
+
+
+def server_version_num(eng):
+    """PostgreSQL server version as integer, e.g. 90603 for 9.6.3"""
+    return int(eng.execute(text('SHOW server_version_num')).scalar())
+
+
+def check_server_version(eng):
+    """Raises RuntimeError if PostgreSQL server is too old"""
+    server_version = server_version_num(eng)
+    if server_version < MIN_SERVER_VERSION:
+        raise RuntimeError(
+            'PostgreSQL {} is not supported, 9.6 or newer is required'
+            .format(server_version))
+
+
 def clear(eng=None):
     _logger.info('Clearing database')
 
@@ -0,0 +1,109 @@
+"""
+Tracker feed position, persisted between update cycles: validators for
+conditional feed request, high-water mark of processed entries and topics
+to retry
+"""
+import os
+import json
+import logging
+import datetime
+
+from rtrss.caching import open_for_atomic_write
+
+
+STATE_FILENAME = 'feed-state.json'
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+_logger = logging.getLogger(__name__)
+
+
+class FeedState(object):
+    def __init__(self, path=None):
+        self.path = path
+        # Validators of last feed response
+        self.etag = None
+        self.last_modified = None
+        # Update time of newest processed entry and ids of entries with
+        # this update time
+        self.high_water = None
+        self.seen_ids = set()
+        # Entries failed to process, dict(topic id: entry)
+        self.retry = dict()
+
+    @classmethod
+    def load(cls, data_dir):
+        """Load state from data dir, returns empty state if there is none"""
+        state = cls(os.path.join(data_dir, STATE_FILENAME))
+
+        try:
+            with open(state.path) as f:
+                data = json.load(f)
+        except IOError:
+            return state
+        except ValueError as e:
+            _logger.warn('Ignoring invalid feed state %s: %s', state.path, e)
+            return state
+
+        state.etag = data.get('etag')
+        state.last_modified = data.get('last_modified')
+        state.high_water = parse_datetime(data.get('high_water'))
+        state.seen_ids = set(data.get('seen_ids', []))
+        state.retry = dict()
+        for entry in data.get('retry', []):
+            entry['updated_at'] = parse_datetime(entry['updated_at'])
+            state.retry[entry['id']] = entry
+
+        return state
+
+    def save(self):
+        retry = list()
+        for entry in self.retry.values():
+            entry = dict(entry)
+            entry['updated_at'] = format_datetime(entry['updated_at'])
+            retry.append(entry)
+
+        data = dict({
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'high_water': format_datetime(self.high_water),
+            'seen_ids': sorted(self.seen_ids),
+            'retry': retry,
+        })
+
+        with open_for_atomic_write(self.path) as f:
+            json.dump(data, f)
+
+    def is_seen(self, topic_id, updated_at):
+        """Returns True if entry was processed in previous cycles"""
+        if self.high_water is None:
+            return False
+        if updated_at == self.high_water:
+            return topic_id in self.seen_ids
+        return updated_at < self.high_water
+
+    def retry_since(self):
+        """Update time of oldest entry to retry, None if there are none"""
+        if not self.retry:
+            return None
+        return min(entry['updated_at'] for entry in self.retry.values())
+
+    def advance(self, entries):
+        """Move high-water mark to the newest of entries"""
+        for entry in entries:
+            updated_at = entry['updated_at']
+            if self.high_water is None or updated_at > self.high_water:
+                self.high_water = updated_at
+                self.seen_ids = set()
+            if updated_at == self.high_water:
+                self.seen_ids.add(entry['id'])
+
+
+def format_datetime(dt):
+    return dt.strftime(DATETIME_FORMAT) if dt else None
+
+
+def parse_datetime(value):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, DATETIME_FORMAT)
@@ -4,24 +4,28 @@ All database interactions are performed by Manager
 """
 import logging
 import datetime
-import os
+import time
+import threading
+import Queue
+from collections import Counter
 
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import or_
-from sqlalchemy import orm, func, over, Integer
-from sqlalchemy.dialects.postgres import ARRAY
+from sqlalchemy import func, select
 from newrelic.agent import BackgroundTask
 
 from rtrss.scraper import Scraper
-from rtrss.models import Topic, User, Category, Torrent
+from rtrss.feedstate import FeedState
+from rtrss.models import (Topic, User, Category, Torrent, CategoryClosure,
+                          CategoryStats)
 from rtrss.exceptions import (TopicException, OperationInterruptedException,
                               CaptchaRequiredException, TorrentFileException,
                               ItemProcessingFailedException,
                               DownloadLimitException)
-from rtrss.database import session_scope
+from rtrss.database import session_scope, upsert, rebuild_category_stats
 from rtrss import util, storage
-from rtrss.caching import DiskCache
+from rtrss.caching import get_cache, feed_namespace, TREE_NAMESPACE
 from rtrss.stats import get_stats
 
 
@@ -35,14 +39,162 @@ from rtrss.stats import get_stats
 KEEP_TORRENTS_MIN = 25
 KEEP_TORRENTS_MAX = 75
 
+# Cleanup deletes topics in batches of this size
+CLEANUP_BATCH_SIZE = 500
+
+# Key of torrent file in storage
+TORRENT_FILENAME = '{}.torrent'
+
+# Accumulated topic and torrent changes are written to database in batches
+# of this size
+FLUSH_BATCH_SIZE = 50
+
 _logger = logging.getLogger(__name__)
 
 
+class CategoryIndex(object):
+    """
+    Process-local index of categories. Category table is small and rarely
+    changes, so it is loaded once and updated as categories are added
+    """
+    def __init__(self):
+        self._ids = dict()  # (tracker_id, is_subforum): id
+        self._parents = dict()  # id: parent_id
+
+    def load(self):
+        with session_scope() as db:
+            rows = db.query(Category.id, Category.tracker_id,
+                            Category.is_subforum, Category.parent_id).all()
+
+        for row in rows:
+            self.add(*row)
+
+    def add(self, category_id, tracker_id, is_subforum, parent_id):
+        self._ids[(tracker_id, is_subforum)] = category_id
+        self._parents[category_id] = parent_id
+
+    def find(self, tracker_id, is_subforum):
+        """Returns category id or None if category not exists"""
+        return self._ids.get((tracker_id, is_subforum))
+
+    def with_ancestors(self, category_ids):
+        """Returns set of category ids along with ids of all their ancestors"""
+        result = set()
+        for category_id in category_ids:
+            while category_id is not None and category_id not in result:
+                result.add(category_id)
+                category_id = self._parents.get(category_id)
+        return result
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class ChangeBatch(object):
+    """
+    Accumulates topic, torrent and user changes, made during processing of
+    pending topics, and writes them to database in bulk
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.topics = dict()  # topic id: row
+        self.torrents = dict()  # topic id: row
+        self.downloads = Counter()  # user id: number of downloads
+        self.new_torrents = dict()  # topic id: category id
+        self.cookies = dict()  # user id: cookies
+
+    def __len__(self):
+        return len(self.topics) + len(self.torrents)
+
+    def add_topic(self, tid, category_id, updated_at, title):
+        with self._lock:
+            self.topics[tid] = dict(id=tid, category_id=category_id,
+                                    updated_at=updated_at, title=title)
+
+    def add_torrent(self, tid, infohash, size, tfsize):
+        with self._lock:
+            self.torrents[tid] = dict(id=tid, infohash=infohash, size=size,
+                                      tfsize=tfsize)
+
+    def has_infohash(self, infohash):
+        with self._lock:
+            return any(t['infohash'] == infohash
+                       for t in self.torrents.values())
+
+    def count_torrent(self, tid, category_id):
+        """Count torrent, added to category"""
+        with self._lock:
+            self.new_torrents[tid] = category_id
+
+    def discard(self, tids):
+        """Drop topic and torrent changes of topics"""
+        with self._lock:
+            for tid in tids:
+                self.topics.pop(tid, None)
+                self.torrents.pop(tid, None)
+                self.new_torrents.pop(tid, None)
+
+    def add_download(self, user):
+        with self._lock:
+            self.downloads[user.id] += 1
+
+    def save_cookies(self, user):
+        with self._lock:
+            self.cookies[user.id] = user.cookies
+
+    def flush(self):
+        """Write all accumulated changes in a single transaction"""
+        with self._lock:
+            topics, torrents = self.topics.values(), self.torrents.values()
+            downloads, cookies = self.downloads, self.cookies
+            new_torrents = Counter(self.new_torrents.values())
+            self.clear()
+
+        if not (topics or torrents or downloads or cookies):
+            return
+
+        with session_scope() as db:
+            upsert(db, Topic.__table__, topics)
+            upsert(db, Torrent.__table__, torrents)
+            update_torrent_counts(db, new_torrents)
+
+            if torrents:
+                db.query(Topic) \
+                    .filter(Topic.id.in_([t['id'] for t in torrents])) \
+                    .update({Topic.has_torrent: True},
+                            synchronize_session=False)
+
+            for user_id in set(downloads) | set(cookies):
+                values = dict()
+                if user_id in downloads:
+                    values[User.downloads_today] = \
+                        User.downloads_today + downloads[user_id]
+                if user_id in cookies:
+                    values[User.cookies] = cookies[user_id]
+
+                db.query(User).filter(User.id == user_id) \
+                    .update(values, synchronize_session=False)
+
+        _logger.debug('Saved %d topics and %d torrents', len(topics),
+                      len(torrents))
+
+
 class Manager(object):
     def __init__(self, config):
         self._storage = None
+        self._categories = None
         self.config = config
         self.changed_categories = set()
+        self._category_lock = threading.Lock()
+        # Held while torrent is added to batch and queued for upload, batch
+        # is not flushed in between
+        self._upload_lock = threading.Lock()
+        self.batch = ChangeBatch()
+        self.failed_items = list()
+        self.pending_items = dict()
 
     @property
     def storage(self):
@@ -55,6 +207,14 @@ class Manager(object):
             )
             return self._storage
 
+    @property
+    def categories(self):
+        """Category index, loaded once per manager instance"""
+        if self._categories is None:
+            self._categories = CategoryIndex()
+            self._categories.load()
+        return self._categories
+
     def run_task(self, task_name, *args, **kwargs):
         """Run task, catching all exceptions"""
         app = util.get_newreilc_app('worker', 10.0)
@@ -69,76 +229,99 @@ class Manager(object):
             getattr(self, task_name)(*args, **kwargs)
         except OperationInterruptedException as e:
             _logger.warn("Operation interrupted: {}".format(str(e)))
+        finally:
+            self.close_storage()
+            # Changes flushed before task failure are visible in feeds too
+            self.invalidate_cache()
 
     def update(self):
         _logger.debug('Starting update')
+        started = time.time()
 
-        torrents_changed = 0
-
-        for item in self.make_pending_list():
-            try:
-                torrents_changed += self.process_pending_topic(item)
-            except (TopicException, TorrentFileException) as e:
-                _logger.debug('Failed to proces topic: %s', e)
+        state = FeedState.load(self.config.DATA_DIR)
+        pending = self.make_pending_list(state)
+        if not pending:
+            state.save()
+            _logger.debug('No new topics')
+            return
 
-        _logger.info('%d torrents added/updated', torrents_changed)
+        self.failed_items = list()
+        try:
+            torrents_changed = self.process_pending_items(pending)
+        except OperationInterruptedException:
+            self.save_feed_state(state)
+            raise
+        self.save_feed_state(state)
 
-        self.invalidate_cache()
+        _logger.info('%d torrents added/updated in %.1f s (%s backend)',
+                     torrents_changed, time.time() - started,
+                     self.config.WEBCLIENT_BACKEND)
 
     def cleanup(self):
-        to_delete = list()
+        """
+        Remove old topics from categories, which got new torrents since last
+        cleanup
+        """
         with session_scope() as db:
-            twc = (
-                db.query(Topic.category_id, Topic.updated_at, Torrent.id)
-                .join(Torrent, Torrent.id == Topic.id)
-                .subquery(name='twc')
+            # Categories with too few torrents have nothing to remove
+            db.query(CategoryStats) \
+                .filter(CategoryStats.needs_cleanup) \
+                .filter(CategoryStats.torrents < KEEP_TORRENTS_MIN) \
+                .update({CategoryStats.needs_cleanup: False},
+                        synchronize_session=False)
+
+            rows = (
+                db.query(CategoryStats.category_id)
+                .filter(CategoryStats.needs_cleanup)
+                .all()
             )
 
-            s2 = (
-                db.query(
-                    twc.c.category_id,
-                    twc.c.updated_at,
-                    over(
-                        func.rank().label('rnk'),
-                        partition_by=twc.c.category_id,
-                        order_by=twc.c.updated_at.desc()
-                    ).label('rank')
-                )
-                .subquery(name='s2')
-            )
+        removed = 0
+        for (category_id, ) in rows:
+            removed += self.cleanup_category(category_id)
+
+        message = 'Cleanup removed {} topics from {} categories'.format(
+            removed, len(self.changed_categories))
+        _logger.info(message)
+        self.invalidate_cache()
 
-            t1 = orm.aliased(Topic, name='t1')
+        purged = get_cache(self.config).purge_stale()
+        _logger.debug('Removed %d stale cache files', purged)
 
-            query = (
-                db.query(
-                    s2.c.category_id,
-                    func.array_agg(t1.id, type_=ARRAY(Integer)).label('ids')
-                )
-                .join(t1, t1.category_id == s2.c.category_id)
-                .filter(t1.updated_at < s2.c.updated_at)
-                .group_by(s2.c.rank, s2.c.category_id)
-                .having(s2.c.rank == 25)
-            )
+    def cleanup_category(self, category_id):
+        """
+        Delete topics older than KEEP_TORRENTS_MIN latest torrents in category,
+        in batches of CLEANUP_BATCH_SIZE topics
+        :returns int Number of deleted topics
+        """
+        removed = 0
+
+        while True:
+            with session_scope() as db:
+                rows = load_expired_topics(db, category_id, KEEP_TORRENTS_MIN,
+                                           CLEANUP_BATCH_SIZE)
 
-            for (cat_id, topic_ids) in query.all():
-                self.changed_categories.add(cat_id)
-                to_delete.extend(topic_ids)
+                if not rows:
+                    db.query(CategoryStats) \
+                        .filter(CategoryStats.category_id == category_id) \
+                        .update({CategoryStats.needs_cleanup: False},
+                                synchronize_session=False)
+                    return removed
 
-            if to_delete:
-                db.query(Torrent).filter(Torrent.id.in_(to_delete)) \
+                topic_ids = [tid for (tid, ) in rows]
+
+                count = db.query(Torrent) \
+                    .filter(Torrent.id.in_(topic_ids)) \
                     .delete(synchronize_session=False)
-                db.expire_all()
-                db.query(Topic).filter(Topic.id.in_(to_delete)) \
+                db.query(Topic).filter(Topic.id.in_(topic_ids)) \
                     .delete(synchronize_session=False)
+                update_torrent_counts(db, {category_id: -count})
 
-        if to_delete:
-            keys = ['{}.torrent'.format(tid) for tid in to_delete]
+            keys = [TORRENT_FILENAME.format(tid) for tid in topic_ids]
             self.storage.bulk_delete(keys)
 
-        message = 'Cleanup removed {} torrents from {} categories'.format(
-            len(to_delete), len(self.changed_categories))
-        _logger.info(message)
-        self.invalidate_cache()
+            removed += len(topic_ids)
+            self.changed_categories.add(category_id)
 
     def daily_reset(self):
         """Reset user download counters"""
@@ -149,12 +332,18 @@ class Manager(object):
         _logger.info('stats {}'.format(' '.join(stats_values)))
 
 
-    def make_pending_list(self):
+    def make_pending_list(self, state=None):
         """
-        Returns list of topics to process
+        Returns list of topics to process. If feed state is given, only
+        topics not seen in previous cycles and topics failed to process are
+        returned
         """
         scraper = Scraper(self.config)
-        latest = scraper.get_latest_topics()
+        latest = scraper.get_latest_topics(state)
+
+        if not latest:
+            return []
+
         existing = load_topics(latest.keys())
 
         existing_ids = existing.keys()
@@ -162,7 +351,9 @@ class Manager(object):
 
         for tid, topic in latest.items():
 
-            if tid in existing_ids and not topic['changed']:
+            # Failed topics are retried even if saved before failure
+            if tid in existing_ids and not topic['changed'] and \
+                    not topic.get('retry'):
                 continue
 
             topic['id'] = tid
@@ -173,19 +364,101 @@ class Manager(object):
 
         return pending
 
-    def process_pending_topic(self, item):
+    def process_pending_items(self, items, limit=None):
+        """
+        Process pending topics, in several concurrent lanes if configured.
+        If limit is set, lanes stop after adding this many torrents (may be
+        exceeded by number of lanes - 1). Raises OperationInterruptedException
+        if any lane was stopped by an error.
+        Returns number of torrents added or updated
+        :returns int
+        """
+        queue = Queue.Queue()
+        for item in items:
+            queue.put(item)
+
+        self.pending_items = dict((item['id'], item) for item in items)
+        results = list()
+        errors = list()
+        num_lanes = min(self.config.UPDATE_CONCURRENCY, len(items))
+
+        try:
+            if num_lanes > 1:
+                lanes = [
+                    threading.Thread(target=self.run_lane,
+                                     args=(queue, results, errors, user,
+                                           limit))
+                    for user in select_users(num_lanes)
+                ]
+                for lane in lanes:
+                    lane.start()
+                for lane in lanes:
+                    lane.join()
+            else:
+                self.process_lane(queue, results, limit=limit)
+        finally:
+            # Items left by interrupted lanes
+            while limit is None and not queue.empty():
+                self.failed_items.append(queue.get_nowait())
+            self.flush_batch()
+
+        if errors:
+            raise OperationInterruptedException(
+                '{} of {} lanes failed'.format(len(errors), num_lanes))
+
+        return sum(results)
+
+    def run_lane(self, queue, results, errors, user, limit=None):
+        """Lane thread entry point, errors stopping the lane are collected"""
+        _logger.debug('Lane of %s started', user)
+        try:
+            self.process_lane(queue, results, user, limit)
+        except OperationInterruptedException as e:
+            _logger.warn('Lane of %s interrupted: %s', user, e)
+            errors.append(e)
+        except Exception as e:
+            _logger.exception('Lane of %s failed', user)
+            errors.append(e)
+
+    def process_lane(self, queue, results, user=None, limit=None):
+        """
+        Process items from queue until it is empty or limit of added
+        torrents reached. If user is set, all topics are processed on behalf
+        of this user
+        """
+        while limit is None or sum(results) < limit:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results.append(self.process_pending_topic(item, user))
+            except OperationInterruptedException:
+                self.failed_items.append(item)
+                raise
+            except (TopicException, TorrentFileException) as e:
+                _logger.debug('Failed to proces topic: %s', e)
+                self.failed_items.append(item)
+            except Exception:
+                _logger.exception('Failed to process topic %s', item['id'])
+                self.failed_items.append(item)
+
+            if len(self.batch) >= FLUSH_BATCH_SIZE:
+                self.flush_batch()
+
+    def process_pending_topic(self, item, user=None):
         """Process new or updated torrent/topic. Returns 1 if torrent was added
         or updated, 0 otherwise
         :returns int
         """
 
         tid = item['id']
-        user = select_user()
+        if user is None:
+            user = select_user()
         scraper = Scraper(self.config)
         parsed = scraper.get_topic(tid, user)
-
-        with session_scope() as db:
-            db.add(user)
+        self.batch.save_cookies(user)
 
         title = item['title']
         is_new_topic = item['new']
@@ -194,11 +467,12 @@ class Manager(object):
         infohash = parsed['infohash']
         old_infohash = item.get('old_infohash')
 
-        category_id = self.ensure_category(categories.pop(), categories)
+        with self._category_lock:
+            category_id = self.ensure_category(categories.pop(), categories)
 
         # Save topic only if it is new or infohash changed (but not removed)
         if is_new_topic or (infohash and infohash != old_infohash):
-            save_topic(tid, category_id, updated_at, title)
+            self.batch.add_topic(tid, category_id, updated_at, title)
 
         # do not save torrent if no infohash
         if not infohash:
@@ -206,29 +480,50 @@ class Manager(object):
 
         # Torrent new or changed
         if is_new_topic or old_infohash != infohash:
-            self.process_torrent(tid, infohash, old_infohash)
+            self.process_torrent(tid, infohash, old_infohash, user)
+            self.changed_categories.add(category_id)
+            if not old_infohash:
+                self.batch.count_torrent(tid, category_id)
             return 1
 
         return 0
 
 
+    def save_feed_state(self, state):
+        """
+        Save feed state, with failed items to retry next cycles while they
+        are in feed
+        """
+        state.retry = dict()
+        for item in self.failed_items:
+            state.retry[item['id']] = dict({
+                'id': item['id'],
+                'title': item['title'],
+                'updated_at': item['updated_at'],
+                'changed': item['changed'],
+            })
+        state.save()
+
+        if state.retry:
+            _logger.debug('%d topics to retry', len(state.retry))
+
     def ensure_category(self, c_dict, parents):
         """
         Check if category exists, create if not. Create all parent
         categories if needed. Returns category id
         """
-        category = find_category(c_dict['tracker_id'], c_dict['is_subforum'])
+        category_id = self.categories.find(c_dict['tracker_id'],
+                                           c_dict['is_subforum'])
 
-        if category:
-            return category.id
+        if category_id is not None:
+            return category_id
 
         if parents:
             p_dict = parents.pop()
-            parent = find_category(p_dict['tracker_id'], p_dict['is_subforum'])
+            parent_id = self.categories.find(p_dict['tracker_id'],
+                                             p_dict['is_subforum'])
 
-            if parent:
-                parent_id = parent.id
-            else:
+            if parent_id is None:
                 parent_id = self.ensure_category(p_dict, parents)
         elif c_dict['tracker_id'] == 0:
             parent_id = None
@@ -248,23 +543,31 @@ class Manager(object):
 
         with session_scope() as db:
             db.add(category)
+            db.flush()
+            category_id = category.id
+            add_category_closure(db, category_id, parent_id)
 
-        category = find_category(c_dict['tracker_id'], c_dict['is_subforum'])
-        _logger.info('Added category %s (%d)', category.title, category.id)
+        self.categories.add(category_id, c_dict['tracker_id'],
+                            c_dict['is_subforum'], parent_id)
+        _logger.info(u'Added category %s (%d)', c_dict['title'], category_id)
+        get_cache(self.config).bump(TREE_NAMESPACE)
 
-        cache = DiskCache(os.path.join(self.config.DATA_DIR, 'cache'))
-        cache_key = 'category_tree.json'
-        del cache[cache_key]
+        return category_id
 
-        return category.id
+    def process_torrent(self, tid, infohash, old_infohash=None, user=None):
+        if self.batch.has_infohash(infohash) or torrent_exists(infohash):
+            msg = 'Torrent with infohash {} already exists'.format(infohash)
+            _logger.error(msg)
+            raise TopicException(msg)
 
-    def process_torrent(self, tid, infohash, old_infohash=None):
         scraper = Scraper(self.config)
-        user = select_user()
+        if user is None or not user.can_download():
+            user = select_user()
         torrent_dict = None
         retry_count = 0
 
         while torrent_dict is None and retry_count < 3:
+            retry_count += 1
             try:
                 # This call can raise TopicException, CaptchaRequiredException
                 # or TorrentFileException
@@ -276,12 +579,15 @@ class Manager(object):
             except DownloadLimitException:  # User reached download limit
                 user.downloads_today = user.downloads_limit
                 with session_scope() as db:
-                    db.add(user)
+                    db.merge(user)
+                user = select_user()
 
-        user.downloads_today += 1
+        if torrent_dict is None:
+            raise TorrentFileException(
+                'Failed to download torrent {}'.format(tid))
 
-        with session_scope() as db:
-            db.add(user)
+        user.downloads_today += 1
+        self.batch.add_download(user)
 
         torrentfile = torrent_dict['torrentfile']
         real_infohash = torrent_dict['infohash']
@@ -293,45 +599,82 @@ class Manager(object):
             _logger.error(msg)
             raise TopicException(msg)
 
-        with session_scope() as db:
-            torrent = (
-                db.query(Torrent)
-                .filter(Torrent.infohash == infohash)
-                .first()
-            )
+        self.queue_torrent(tid, infohash, download_size, torrentfile)
 
-        if torrent:
-            msg = 'Torrent with infohash {} already exists: {}'.format(
-                infohash, torrent)
-            _logger.error(msg)
-            raise TopicException(msg)
+    def queue_torrent(self, tid, infohash, download_size, torrentfile):
+        """Add torrent to batch and queue its file for upload"""
+        with self._upload_lock:
+            self.batch.add_torrent(tid, infohash, download_size,
+                                   len(torrentfile))
 
-        torrent = Torrent(
-            id=tid,
-            infohash=infohash,
-            size=download_size,
-            tfsize=len(torrentfile)
-        )
+            # Changed torrent file replaces old one, which is kept if upload
+            # fails
+            self.storage.put_async(
+                TORRENT_FILENAME.format(tid),
+                torrentfile,
+                mimetype='application/x-bittorrent'
+            )
 
-        with session_scope() as db:
-            db.merge(torrent)
+    def flush_storage(self):
+        """
+        Wait for queued torrent file uploads
+        :returns list of topic ids of torrents failed to upload
+        """
+        if self._storage is None:
+            return []
+        return self._failed_uploads(self._storage.flush())
 
-        filename = '{}.torrent'.format(tid)
+    def close_storage(self):
+        """Wait for queued uploads and release storage threads and clients"""
+        if self._storage is None:
+            return
+        self._failed_uploads(self._storage.close())
+        self._storage = None
 
-        if old_infohash:
-            self.storage.delete(filename)
+    def _failed_uploads(self, keys):
+        if keys:
+            _logger.error('Failed to upload %d torrent files: %s',
+                          len(keys), ', '.join(keys))
+        return [int(key.split('.')[0]) for key in keys]
 
-        self.storage.put(
-            filename,
-            torrentfile,
-            mimetype='application/x-bittorrent'
-        )
+    def flush_batch(self):
+        """
+        Write accumulated changes to database, once torrent files are
+        uploaded. Topics with torrents failed to upload are not saved and
+        are recorded as failed
+        """
+        with self._upload_lock:
+            failed = self.flush_storage()
+            if failed:
+                self.batch.discard(failed)
+                self.failed_items.extend(self.pending_items[tid]
+                                         for tid in failed
+                                         if tid in self.pending_items)
+            self.batch.flush()
+
+    def migrate_storage(self):
+        """Move torrent files in local directory storage to sharded layout"""
+        if not hasattr(self.storage, 'migrate_flat_layout'):
+            _logger.info('%r has no layout to migrate', self.storage)
+            return
+
+        self.storage.migrate_flat_layout()
 
     def invalidate_cache(self):
         """Invalidates cache for all changed categories. Should be called after
         all operations that may add, change or delete topics/torrents"""
-        for category_id in self.changed_categories:
-            pass  # TODO implement this
+        if not self.changed_categories:
+            return
+
+        # Root feed includes all categories
+        category_ids = self.categories.with_ancestors(self.changed_categories)
+        category_ids.add(0)
+        cache = get_cache(self.config)
+        for cid in category_ids:
+            cache.bump(feed_namespace(cid))
+        _logger.debug('Feed cache invalidated for %d categories',
+                      len(category_ids))
+        self.changed_categories.clear()
 
     def sync_categories(self):
         """Import all existing tracker categories into DB"""
@@ -352,11 +695,11 @@ class Manager(object):
                     is_subforum=False,
                 )
                 db.add(root)
+                db.flush()
+                add_category_closure(db, root.id, None)
 
         for forum_id in scraper.get_forum_ids(user):
-            category = find_category(forum_id, True)
-
-            if category:
+            if self.categories.find(forum_id, True) is not None:
                 continue
 
             try:
@@ -410,23 +753,25 @@ class Manager(object):
         if not len(categories):
             return
 
-
         total_added = 0
 
-        for cat, num_torrents in categories:
-            # If this category has some torrents - only add missing amount
-            to_add = count - num_torrents
+        try:
+            for cat, num_torrents in categories:
+                # If this category has some torrents - only add missing amount
+                to_add = count - num_torrents
 
-            # Do not add more than total
-            if total_added + to_add > total:
-                to_add = total - total_added
+                # Do not add more than total
+                if total_added + to_add > total:
+                    to_add = total - total_added
 
-            added = self.populate_category(cat.tracker_id, to_add)
-            total_added += added
-            _logger.debug('Added %d torrents to %s ', added, cat.title)
+                added = self.populate_category(cat.tracker_id, to_add)
+                total_added += added
+                _logger.debug('Added %d torrents to %s ', added, cat.title)
 
-            if total_added >= total:
-                break
+                if total_added >= total:
+                    break
+        finally:
+            self.flush_storage()
 
         _logger.info('Populate task added %d torrents', total_added)
 
@@ -437,41 +782,49 @@ class Manager(object):
         """
         scraper = Scraper(self.config)
         user = select_user()
+        added = 0
+        found = 0
+
         try:
-            torrents = scraper.find_torrents(user, forum_id)
+            for torrents in scraper.search_pages(user, forum_id):
+                found += len(torrents)
+                added += self.add_new_topics(torrents, count - added)
+                if added >= count:
+                    break
         except ItemProcessingFailedException as e:
             msg = "Failed to populate category {}: {}".format(forum_id, e)
             _logger.error(msg)
-            torrents = []
-
-        with session_scope() as db:
-            db.add(user)
+        finally:
+            self.batch.save_cookies(user)
+            self.batch.flush()
 
-        if not torrents:
+        if not found:
             _logger.debug('No torrents found in category %d', forum_id)
-            return 0
 
-        added = 0
-
-        for tdict in torrents:
-            with session_scope() as db:
-                exists = db.query(Topic).get(tdict['id'])
+        return added
 
-            # Skip torrents that are already in database
-            if exists:
-                continue
+    def add_new_topics(self, torrents, count):
+        """
+        Process topics from the list, skipping existing ones, until count
+        torrents added. Topics are processed in concurrent lanes, so page
+        parsing in parse pool overlaps with downloads
+        :returns int Number of torrents added
+        """
+        existing = existing_topic_ids([tdict['id'] for tdict in torrents])
 
+        # Skip torrents that are already in database
+        pending = [t for t in torrents if t['id'] not in existing]
+        for tdict in pending:
             tdict['new'] = True
-            try:
-                added += self.process_pending_topic(tdict)
 
-            except TopicException:
-                _logger.debug('Failed to add topic %d', tdict['id'])
+        if not pending:
+            return 0
+        return self.process_pending_items(pending, limit=count)
 
-            if added == count:
-                break
-
-        return added
+    def rebuild_category_stats(self):
+        """Rebuild category closure table and torrent counters from scratch"""
+        rebuild_category_stats()
+        _logger.info('Category closure and counters rebuilt')
 
     def daily_populate_task(self):
         dlslots = estimate_free_download_slots()
@@ -487,14 +840,7 @@ def select_user(with_dlslots=True):
     """
     with session_scope() as db:
         try:
-            query = db.query(User).filter(User.enabled.is_(True))
-
-            if with_dlslots:
-                query = query.filter(or_(
-                    User.downloads_limit > User.downloads_today,
-                    User.downloads_limit.is_(None)
-                ))
-
+            query = users_query(db, with_dlslots)
             user = query.order_by(func.random()).limit(1).one()
 
         except NoResultFound:
@@ -505,6 +851,34 @@ def select_user(with_dlslots=True):
     return user
 
 
+def select_users(count, with_dlslots=True):
+    """
+    Select up to count distinct random users, see select_user
+    :returns list(User)
+    """
+    with session_scope() as db:
+        query = users_query(db, with_dlslots)
+        users = query.order_by(func.random()).limit(count).all()
+        db.expunge_all()
+
+    if not users:
+        raise OperationInterruptedException('No suitable users found')
+
+    return users
+
+
+def users_query(db, with_dlslots):
+    query = db.query(User).filter(User.enabled.is_(True))
+
+    if with_dlslots:
+        query = query.filter(or_(
+            User.downloads_limit > User.downloads_today,
+            User.downloads_limit.is_(None)
+        ))
+
+    return query
+
+
 def load_topics(ids):
     """
     Loads existing topics from database
@@ -524,33 +898,96 @@ def load_topics(ids):
     return topics
 
 
-def save_topic(tid, category_id, updated_at, title):
+def existing_topic_ids(ids):
     """
-    Insert or update topic.
+    Returns set of ids of topics existing in database
+    :returns set
     """
-    topic = Topic(
-        id=tid,
-        category_id=category_id,
-        title=title,
-        updated_at=updated_at
+    with session_scope() as db:
+        rows = db.query(Topic.id).filter(Topic.id.in_(ids)).all()
+    return set(row.id for row in rows)
+
+
+def add_category_closure(db, category_id, parent_id):
+    """Add closure rows and counters for newly created category"""
+    db.add(CategoryClosure(ancestor_id=category_id, descendant_id=category_id,
+                           depth=0))
+
+    if parent_id is not None:
+        parents = (
+            db.query(CategoryClosure)
+            .filter(CategoryClosure.descendant_id == parent_id)
+            .all()
+        )
+        for p in parents:
+            db.add(CategoryClosure(ancestor_id=p.ancestor_id,
+                                   descendant_id=category_id,
+                                   depth=p.depth + 1))
+
+    db.add(CategoryStats(category_id=category_id, torrents=0,
+                         subtree_torrents=0, needs_cleanup=False))
+
+
+def update_torrent_counts(db, deltas):
+    """
+    Update torrent counters of categories and all their ancestors
+    :param deltas: dict(category id: change of torrent count)
+    """
+    for category_id, delta in deltas.items():
+        if not delta:
+            continue
+
+        values = {CategoryStats.torrents: CategoryStats.torrents + delta}
+        # Categories with new torrents are checked by next cleanup
+        if delta > 0:
+            values[CategoryStats.needs_cleanup] = True
+
+        db.query(CategoryStats) \
+            .filter(CategoryStats.category_id == category_id) \
+            .update(values, synchronize_session=False)
+
+        ancestors = (
+            select([CategoryClosure.ancestor_id])
+            .where(CategoryClosure.descendant_id == category_id)
+        )
+        db.query(CategoryStats) \
+            .filter(CategoryStats.category_id.in_(ancestors)) \
+            .update({CategoryStats.subtree_torrents:
+                     CategoryStats.subtree_torrents + delta},
+                    synchronize_session=False)
+
+
+def load_expired_topics(db, category_id, keep, limit):
+    """
+    Returns ids of up to limit topics in category, older than keep latest
+    torrents
+    """
+    threshold = (
+        db.query(Topic.updated_at)
+        .filter(Topic.category_id == category_id)
+        .filter(Topic.has_torrent)
+        .order_by(Topic.updated_at.desc())
+        .offset(keep - 1)
+        .limit(1)
+        .scalar()
     )
 
-    _logger.debug('Saving topic %s', topic)
-    with session_scope() as db:
-        topic = db.merge(topic)
-        db.commit()
+    if threshold is None:
+        return []
+
+    return (
+        db.query(Topic.id)
+        .filter(Topic.category_id == category_id)
+        .filter(Topic.updated_at < threshold)
+        .limit(limit)
+        .all()
+    )
 
 
-def find_category(tracker_id, is_subforum):
+def torrent_exists(infohash):
     with session_scope() as db:
-        category = (
-            db.query(Category).filter(
-                Category.tracker_id == tracker_id,
-                Category.is_subforum == is_subforum
-            ).first()
-        )
-        db.expunge_all()
-    return category
+        query = db.query(Torrent.id).filter(Torrent.infohash == infohash)
+        return db.query(query.exists()).scalar()
 
 
 def estimate_free_download_slots(days=7):
@@ -5,9 +5,11 @@ from sqlalchemy import Column, Integer, String, ForeignKey, PickleType,\
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql import expression
 
 
-__all__ = ["Category", "Topic", "Torrent", "User"]
+__all__ = ["Category", "CategoryClosure", "CategoryStats", "Topic", "Torrent",
+           "User"]
 
 _logger = logging.getLogger(__name__)
 
@@ -32,6 +34,45 @@ class Category(Base):
         return u"<Category(id={}, title='{}')>".format(self.id, self.title)
 
 
+class CategoryClosure(Base):
+    """
+    Ancestor-descendant pairs for all categories. Every category is also
+    its own ancestor with depth 0
+    """
+    __tablename__ = 'category_closure'
+
+    ancestor_id = Column(Integer, ForeignKey('categories.id'),
+                         primary_key=True)
+    descendant_id = Column(Integer, ForeignKey('categories.id'),
+                           primary_key=True)
+    depth = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return u"<CategoryClosure({} -> {})>".format(self.ancestor_id,
+                                                     self.descendant_id)
+
+Index('ix_category_closure_descendant', CategoryClosure.descendant_id)
+
+
+class CategoryStats(Base):
+    """Torrent counters, maintained by worker"""
+    __tablename__ = 'category_stats'
+
+    category_id = Column(Integer, ForeignKey('categories.id'),
+                         primary_key=True, autoincrement=False)
+    # Torrents in this category
+    torrents = Column(Integer, nullable=False, default=0)
+    # Torrents in this category and all its subcategories
+    subtree_torrents = Column(Integer, nullable=False, default=0)
+    # Set when torrents are added, cleared by cleanup
+    needs_cleanup = Column(Boolean, nullable=False, default=False,
+                           server_default=expression.false())
+
+    def __repr__(self):
+        return u"<CategoryStats(id={}, torrents={}/{})>".format(
+            self.category_id, self.torrents, self.subtree_torrents)
+
+
 class Topic(Base):
     __tablename__ = 'topics'
 
@@ -42,17 +83,23 @@ class Topic(Base):
 
     title = Column(String(500), nullable=False)
 
+    # Denormalized flag, set when torrent is added to topic
+    has_torrent = Column(Boolean, nullable=False, default=False,
+                         server_default=expression.false())
+
     category = relationship("Category", backref='topics')
     torrent = relationship('Torrent', uselist=False, backref='topic')
 
     def __repr__(self):
         return u"<Topic(id={}, title='{}')>".format(self.id, self.title)
 
-# TODO Tune indexes
-# Index('ix_category_updated_at', Topic.category_id, Torrent.updated_at.desc())
 Index('ix_category', Topic.category_id)
 Index('ix_updated_at', Topic.updated_at.desc())
 
+# Latest topics with torrents in category
+Index('ix_category_updated_at', Topic.category_id, Topic.updated_at.desc(),
+      postgresql_where=Topic.has_torrent)
+
 
 class Torrent(Base):
     __tablename__ = 'torrents'
@@ -0,0 +1,62 @@
+"""
+Token bucket rate limiter for tracker requests, shared by all WebClient
+instances in the process
+"""
+import time
+import threading
+
+
+_buckets = dict()
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. Tokens are added at rate tokens per second, up to
+    capacity. Waiting callers reserve tokens in advance, so concurrent callers
+    are served in order without holding the lock while sleeping
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token, returns delay in seconds before it can be used"""
+        with self._lock:
+            now = time.time()
+            elapsed = max(now - self._updated, 0)
+            self._tokens = min(self.capacity,
+                               self._tokens + elapsed * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def consume(self):
+        """Take one token, waiting as long as needed"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_bucket(key, interval):
+    """
+    Returns process-wide bucket for key, allowing one request per interval
+    seconds
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(1.0 / interval)
+        return bucket
+
+
+def throttle(key, interval):
+    """Wait until request identified by key is allowed"""
+    if interval > 0:
+        get_bucket(key, interval).consume()
@@ -1,25 +1,38 @@
 # -*- coding: utf-8 -*-
+import io
+import re
+import urlparse
 import logging
 import datetime
+import multiprocessing
 
 from dateutil import parser as dateparser
-import pytz
 from lxml import etree
 
-from rtrss import torrentfile
+from rtrss import torrentfile, selectors
 from rtrss.exceptions import TopicException, ItemProcessingFailedException
 from rtrss.webclient import WebClient
+from rtrss.backends import GEVENT
 from rtrss.util import save_debug_file
 
 
 _logger = logging.getLogger(__name__)
 
+# Process-wide pool of page parsing processes, see start_parse_pool
+_parse_pool = None
+
 # Tracker time is 1 hour early for some reason
 TRACKER_TIMEFIX = datetime.timedelta(hours=1)
 
+# ATOM feed elements namespace
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+
 # This string in topic title marks updated torrents
 UPDATED_MARKER = u'[Обновлено]'
 
+# Search results are crawled up to this number of pages
+SEARCH_MAX_PAGES = 10
+
 # Section with this title contains private forums, we don't need
 PRIVATE_SECTION_TITLE = u'Приватные форумы'
 
@@ -29,6 +42,16 @@ TOPIC_STOPLIST = [
     u'Тема не найдена'
 ]
 
+# All stoplist messages, matched in single pass over page
+TOPIC_STOPLIST_RE = re.compile(
+    u'|'.join(re.escape(msg) for msg in TOPIC_STOPLIST), re.UNICODE)
+
+# Topic page markup, used to extract data without building page tree
+INFOHASH_RE = re.compile(r'<span[^>]*\sid="tor-hash"[^>]*>([^<]*)<')
+TORRENT_LINK_RE = re.compile(r'<a[^>]*\sclass="dl-stub dl-link"')
+BREADCRUMB_CLASS = 'class="nav w100 pad_2"'
+TAG_NAME_RE = re.compile(r'<(\w+)')
+
 
 def make_tree(html, encoding='utf-8'):
     parser = etree.HTMLParser(encoding=encoding)
@@ -36,117 +59,328 @@ def make_tree(html, encoding='utf-8'):
     return tree
 
 
+def start_parse_pool(config):
+    """
+    Start pool of page parsing processes, if parsing in processes is
+    enabled. Must be called before any other threads are started, process
+    forked while other thread holds a lock (logging, ssl) may deadlock
+    """
+    global _parse_pool
+    if _parse_pool is not None or config.PARSE_PROCESSES < 1 or \
+            config.WEBCLIENT_BACKEND == GEVENT:
+        return
+
+    _parse_pool = multiprocessing.Pool(config.PARSE_PROCESSES)
+
+
+def stop_parse_pool():
+    """Wait for parsing processes to exit"""
+    global _parse_pool
+    if _parse_pool is None:
+        return
+
+    _parse_pool.close()
+    _parse_pool.join()
+    _parse_pool = None
+
+
 def jointext(elem):
     """Joins text from element and all its sub-elements"""
     return elem.text + ''.join(e.text for e in elem.iterdescendants())
 
 
-class Scraper(object):
-    def __init__(self, config):
-        self.config = config
+def extract_topic(html):
+    """
+    Extracts infohash and breadcrumb links from topic page without parsing
+    whole page, only breadcrumb element is parsed. Returns None if
+    breadcrumb not found
+    """
+    pos = html.find(BREADCRUMB_CLASS)
+    if pos == -1:
+        return None
 
-    def get_latest_topics(self):
-        """Parses ATOM feed, returns topic_id:dict(topic)"""
-        wc = WebClient(self.config)
-        feed = wc.get_feed()
+    start = html.rfind('<', 0, pos)
+    match = TAG_NAME_RE.match(html, start)
+    if not match:
+        return None
+    closing = '</{}>'.format(match.group(1))
+    end = html.find(closing, pos)
+    if end == -1:
+        return None
 
-        # remove stupid namespace
-        feed = feed.replace('xmlns="http://www.w3.org/2005/Atom"', '')
-        result = dict()
-        entries = etree.fromstring(feed).findall('entry')
+    fragment = make_tree(html[start:end + len(closing)])
+    catlinks = selectors.TOPIC_BREADCRUMB_LINKS(fragment)
+    if not catlinks:
+        return None
 
-        for e in entries:
-            entry = self.parse_feed_entry(e)
-            result[entry['id']] = entry
+    infohash = None
+    if TORRENT_LINK_RE.search(html):
+        match = INFOHASH_RE.search(html)
+        if match:
+            infohash = match.group(1) or None
 
-        return result
+    return infohash, catlinks
 
-    def parse_feed_entry(self, entry):
-        title = entry.find('title').text
-        id = entry.find('link').attrib['href'].split('=')[1]
 
-        updated_raw = dateparser.parse(entry.find('updated').text)
-        updated_at = updated_raw + TRACKER_TIMEFIX
+def validate_topic(extracted, parsed):
+    """Logs difference between extracted and parsed topic data"""
+    def describe(result):
+        infohash, catlinks = result
+        return infohash, [(a.get('href'), a.text) for a in catlinks]
 
-        if title[0:len(UPDATED_MARKER)] == UPDATED_MARKER:
-            title = title[len(UPDATED_MARKER):]
-            changed = True
-        else:
-            changed = False
+    if describe(extracted) != describe(parsed):
+        _logger.warn('Topic extraction mismatch: %r != %r',
+                     describe(extracted), describe(parsed))
 
-        return dict({
-            'title': title.strip(),
-            'id': int(id),
-            'updated_at': updated_at.replace(tzinfo=None),
-            'changed': changed
-        })
 
-    def get_topic(self, tid, user):
-        wc = WebClient(self.config, user)
-        html = wc.get_topic(tid)
+def parse_topic_page(tid, html, validate=False):
+    """
+    Parses topic page, returns dict(infohash, categories). Runs in parse
+    pool worker process
+    """
+    match = TOPIC_STOPLIST_RE.search(html)
+    if match:
+        raise TopicException('Skipping topic {} because of {}'.format(
+            tid, match.group(0).encode('utf-8')))
+
+    infohash, catlinks = parse_topic(html, validate)
+
+    if not catlinks:
+        msg = 'Failed to parse categories for topic {}'.format(tid)
+        raise TopicException(msg)
+
+    categories = parse_categories(catlinks)
+    if not categories:
+        src = ''.join([etree.tostring(l) for l in catlinks])
+        msg = 'Failed to parse categories in topic {}: {}'.format(tid, src)
+        raise TopicException(msg)
+
+    return dict({
+        'infohash': infohash,
+        'categories': categories
+    })
+
+
+def parse_topic(html, validate=False):
+    """
+    Returns infohash and breadcrumb links of topic page. Page is scanned
+    for needed elements, full page tree is built only if breadcrumb is
+    not found or validate is set
+    """
+    result = extract_topic(html)
+    if result is None:
+        return parse_topic_tree(html)
+
+    if validate:
+        validate_topic(result, parse_topic_tree(html))
+    return result
 
-        for msg in TOPIC_STOPLIST:
-            if msg in html:
-                raise TopicException('Skipping topic {} because of {}'.format(
-                    tid, msg.encode('utf-8')))
 
-        infohash, catlinks = self.parse_topic(html)
+def parse_topic_tree(html):
+    tree = make_tree(html)
+    hashspans = selectors.TOPIC_INFOHASH(tree)
+    infohash = hashspans[0].text if hashspans else None
+    torrentlinks = selectors.TOPIC_TORRENT_LINKS(tree)
 
-        if not catlinks:
-            msg = 'Failed to parse categories for topic {}'.format(tid)
-            raise TopicException(msg)
+    if not torrentlinks:
+        infohash = None
 
-        categories = self.parse_categories(catlinks)
-        if not categories:
-            src = ''.join([etree.tostring(l) for l in catlinks])
-            msg = 'Failed to parse categories in topic {}: {}'.format(tid, src)
-            raise TopicException(msg)
+    catlinks = selectors.TOPIC_BREADCRUMB_LINKS(tree)
+    return infohash, catlinks
 
+
+def parse_categories(links):
+    """Maked list of parsed categories from list of etree.Elements"""
+
+    result = [parse_category(link) for link in links]
+    return result
+
+
+def parse_category(c):
+    href = c.get('href', '').strip('./')
+
+    if href == 'index.php':     # Root category
         return dict({
-            'infohash': infohash,
-            'categories': categories
+            'tracker_id': 0,
+            'title': u'Все разделы',
+            'is_subforum': False,
         })
 
-    def parse_topic(self, html):
-        tree = make_tree(html)
-        hashspans = tree.xpath('//span[@id="tor-hash"]')
-        infohash = hashspans[0].text if hashspans else None
-        torrentlinks = tree.xpath('//a[@class="dl-stub dl-link"]')
+    if not href or '?' not in href or '=' not in href:
+        msg = "Can't parse breadcrumb link {}".format(etree.tostring(c))
+        raise TopicException(msg)
 
-        if not torrentlinks:
-            infohash = None
+    param, tracker_id = href.split('?')[1].split('=')
 
-        catlinks = tree.xpath('//*[@class="nav w100 pad_2"]/a')
-        return infohash, catlinks
+    return dict({
+        'tracker_id': int(tracker_id),
+        'title': c.text,
+        'is_subforum': param == 'f',
+    })
 
-    def parse_categories(self, links):
-        """Maked list of parsed categories from list of etree.Elements"""
 
-        result = [self.parse_category(link) for link in links]
-        return result
+def parse_search_page(html, start=0):
+    """
+    Parses search results page starting at result number start. Returns
+    dict(rows, next_page), next_page is link to following page or None
+    """
+    tree = make_tree(html)
+    rows = [parse_search_row(row) for row in selectors.SEARCH_ROWS(tree)]
 
-    def parse_category(self, c):
-        href = c.get('href', '').strip('./')
+    next_page = None
+    next_start = None
+    for href in selectors.SEARCH_PAGE_LINKS(tree):
+        query = urlparse.parse_qs(urlparse.urlparse(href).query)
+        try:
+            page_start = int(query['start'][0])
+        except (KeyError, ValueError):
+            continue
+        if page_start > start and (next_start is None or
+                                   page_start < next_start):
+            next_page, next_start = unicode(href), page_start
 
-        if href == 'index.php':     # Root category
-            return dict({
-                'tracker_id': 0,
-                'title': u'Все разделы',
-                'is_subforum': False,
-            })
+    return dict({
+        'rows': rows,
+        'next_page': next_page,
+        'next_start': next_start,
+    })
+
+
+def parse_search_row(row):
+    cells = selectors.SEARCH_ROW_CELLS(row)
+
+    if len(cells) != selectors.SEARCH_ROW_CELLS_COUNT:
+        html = etree.tostring(row)
+        msg = 'Failed to parse search row: {}'.format(html)
+        raise ItemProcessingFailedException(msg)
+
+    category, topic, author, size, updated = cells
+
+    topic_id = int(topic.attrib['href'].split('=')[1])
+    title = jointext(topic)
+    cat_id = category.attrib['href'].split('=')[1]
+
+    author_id = author.attrib['href'].split('=')[1]
+    author_name = author.text
 
-        if not href or '?' not in href or '=' not in href:
-            msg = "Can't parse breadcrumb link {}".format(etree.tostring(c))
-            raise TopicException(msg)
+    # Timestamp is UTC, no need for tracker timezone
+    updated_ts = int(updated.text)
+    updated_at = datetime.datetime.utcfromtimestamp(updated_ts)
+    updated_at = updated_at + TRACKER_TIMEFIX
 
-        param, tracker_id = href.split('?')[1].split('=')
+    tdict = dict({
+        'id': topic_id,
+        'category_id': int(cat_id),
+        'title': title,
+
+        'author_id': int(author_id),
+        'author_name': author_name,
+
+        'size': int(size.text),
+        'updated_at': updated_at
+    })
+
+    return tdict
+
+
+class Scraper(object):
+    def __init__(self, config):
+        self.config = config
+        self.parse_pool = _parse_pool
+
+    def parse(self, func, *args):
+        """
+        Calls page parsing function in parse pool worker, if pool is
+        enabled. Calling thread is blocked, other threads keep fetching
+        pages meanwhile
+        """
+        if self.parse_pool is None:
+            return func(*args)
+        return self.parse_pool.apply(func, args)
+
+    def get_latest_topics(self, state=None):
+        """
+        Parses ATOM feed, returns topic_id:dict(topic). If feed state is
+        given, feed is requested conditionally and only entries not seen
+        in previous cycles are returned, state validators and high-water
+        mark are updated
+        """
+        wc = WebClient(self.config)
+        # Entries to retry are looked up in feed even if it was not modified
+        if state is None or state.retry:
+            response = wc.get_feed()
+        else:
+            response = wc.get_feed(etag=state.etag,
+                                   last_modified=state.last_modified)
+
+        if response.status_code == 304:
+            _logger.debug('Feed not modified')
+            return dict()
+
+        entries = self.parse_feed(response.content, state)
+
+        if state is not None:
+            state.etag = response.headers.get('ETag')
+            state.last_modified = response.headers.get('Last-Modified')
+            state.advance(entries)
+            # Entries to retry which are no longer in feed are dropped
+            state.retry = dict((entry['id'], state.retry[entry['id']])
+                               for entry in entries if entry['retry'])
+
+        return dict((entry['id'], entry) for entry in entries)
+
+    def parse_feed(self, feed, state=None):
+        """
+        Parses feed entries, newest first. Parsing stops at first entry
+        processed in previous cycles and older than all entries to retry.
+        Entries to retry are returned whether processed or not
+        """
+        result = list()
+        retry_since = state.retry_since() if state is not None else None
+        events = etree.iterparse(io.BytesIO(feed), tag=ATOM_NS + 'entry')
+
+        for _, elem in events:
+            entry = self.parse_feed_entry(elem)
+            elem.clear()
+
+            entry['retry'] = state is not None and entry['id'] in state.retry
+            if not entry['retry'] and state is not None and \
+                    state.is_seen(entry['id'], entry['updated_at']):
+                if entry['updated_at'] < state.high_water and \
+                        (retry_since is None or
+                         entry['updated_at'] < retry_since):
+                    break
+                continue
+
+            result.append(entry)
+
+        return result
+
+    def parse_feed_entry(self, entry):
+        title = entry.find(ATOM_NS + 'title').text
+        id = entry.find(ATOM_NS + 'link').attrib['href'].split('=')[1]
+
+        updated_raw = dateparser.parse(entry.find(ATOM_NS + 'updated').text)
+        updated_at = updated_raw + TRACKER_TIMEFIX
+
+        if title[0:len(UPDATED_MARKER)] == UPDATED_MARKER:
+            title = title[len(UPDATED_MARKER):]
+            changed = True
+        else:
+            changed = False
 
         return dict({
-            'tracker_id': int(tracker_id),
-            'title': c.text,
-            'is_subforum': param == 'f',
+            'title': title.strip(),
+            'id': int(id),
+            'updated_at': updated_at.replace(tzinfo=None),
+            'changed': changed
         })
 
+    def get_topic(self, tid, user):
+        wc = WebClient(self.config, user)
+        html = wc.get_topic(tid)
+        return self.parse(parse_topic_page, tid, html, self.config.DEBUG)
+
     def get_torrent(self, tid, user):
         wc = WebClient(self.config, user)
         bindata = wc.get_torrent(tid)
@@ -154,6 +388,11 @@ class Scraper(object):
 
         try:
             tf.remove_announcers_with_passkeys()
+            torrent_dict = dict({
+                'download_size': tf.download_size,
+                'infohash': tf.infohash,
+                'torrentfile': tf.encoded
+            })
         except ValueError as e:
             message = "Failed to decode torrent {}: {}".format(tid, str(e))
             _logger.error(message)
@@ -161,12 +400,6 @@ class Scraper(object):
                 save_debug_file('{}-failed.torrent'.format(tid), bindata)
             raise TopicException(message)
 
-        torrent_dict = dict({
-            'download_size': tf.download_size,
-            'infohash': tf.infohash,
-            'torrentfile': tf.encoded
-        })
-
         return torrent_dict
 
     def get_forum_ids(self, user):
@@ -177,16 +410,14 @@ class Scraper(object):
 
     def parse_category_map(self, html):
         tree = make_tree(html)
-        sections = tree.xpath('//*/ul[@class="tree-root"]')
         result = list()
-        for section in sections:
-            section_title = section.find('li/span/span').attrib.get('title')
-
+        for section in selectors.CATEGORY_MAP_SECTIONS(tree):
             # Skip private forums
-            if section_title == PRIVATE_SECTION_TITLE:
+            titles = selectors.CATEGORY_MAP_SECTION_TITLE(section)
+            if titles and titles[0] == PRIVATE_SECTION_TITLE:
                 continue
 
-            hrefs = [a.attrib.get('href') for a in section.findall('.//a')]
+            hrefs = selectors.CATEGORY_MAP_LINKS(section)
             result.extend([int(h) for h in hrefs if h.isdigit()])
 
         return result
@@ -194,8 +425,7 @@ class Scraper(object):
     def get_forum_page_navlinks(self, html):
         """Parse forum page and return list of links from breadcrumb"""
         tree = make_tree(html)
-        links = tree.xpath('//*[@class="nav nav-top w100 pad_2"]/a')
-        return links
+        return selectors.FORUM_BREADCRUMB_LINKS(tree)
 
     def get_forum_categories(self, forum_id, user):
         wc = WebClient(self.config, user)
@@ -211,54 +441,29 @@ class Scraper(object):
             msg = "Can't get parents for forum {}: {}".format(forum_id, dump)
             raise ItemProcessingFailedException(msg)
 
-        return self.parse_categories(links)
+        return parse_categories(links)
 
-    def find_torrents(self, user, category_id=None):
+    def search_pages(self, user, category_id=None,
+                     max_pages=SEARCH_MAX_PAGES):
+        """
+        Generates lists of search results rows, page by page. Next page is
+        requested only when consumer asks for it
+        """
         wc = WebClient(self.config, user)
-        html = wc.find_torrents(category_id)
-        return self.parse_search_results(html)
-
-    def parse_search_results(self, html):
-        tree = make_tree(html)
-        row_xpath = '//*/table[@id="tor-tbl"]/tbody/tr[@class="tCenter hl-tr"]'
-        rows = tree.xpath(row_xpath)
-        if rows:
-            return [self.parse_search_row(row) for row in rows]
-        else:
-            return []
-
-    def parse_search_row(self, row):
-        topic = row.find('td[4]/div/a[@data-topic_id]')
-
-        if topic is None:
-            html = etree.tostring(row)
-            msg = 'Failed to parse search row: {}'.format(html)
-            raise ItemProcessingFailedException(msg)
-
-        topic_id = int(topic.attrib['href'].split('=')[1])
-        title = jointext(topic)
-        cat_id = row.find('td[3]/*/a').attrib['href'].split('=')[1]
-
-        author_id = row.find('td[5]/*/a').attrib['href'].split('=')[1]
-        author_name = row.find('td[5]/*/a').text
-
-        size = row.find('td[6]/u').text
-        updated_ts = int(row.find('td[10]/u').text)
-        local_tz = pytz.timezone(self.config.TZNAME)
-        updated_at = datetime.datetime.fromtimestamp(updated_ts, local_tz)
-        updated_at = updated_at + TRACKER_TIMEFIX
-        updated_at = updated_at.astimezone(pytz.utc).replace(tzinfo=None)
-
-        tdict = dict({
-            'id': topic_id,
-            'category_id': int(cat_id),
-            'title': title,
-
-            'author_id': int(author_id),
-            'author_name': author_name,
-
-            'size': int(size),
-            'updated_at': updated_at
-        })
-
-        return tdict
+        next_page = None
+        start = 0
+
+        for _ in range(max_pages):
+            if next_page is None:
+                html = wc.find_torrents(category_id)
+            else:
+                html = wc.get_search_page(next_page)
+
+            page = self.parse(parse_search_page, html, start)
+            if not page['rows']:
+                return
+            yield page['rows']
+
+            if page['next_page'] is None:
+                return
+            next_page, start = page['next_page'], page['next_start']
@@ -0,0 +1,34 @@
+"""
+Compiled XPath selectors for tracker pages. Expressions are compiled once
+at import, not on every call
+"""
+from lxml import etree
+
+
+# Topic page
+TOPIC_INFOHASH = etree.XPath('//span[@id="tor-hash"]')
+TOPIC_TORRENT_LINKS = etree.XPath('//a[@class="dl-stub dl-link"]')
+TOPIC_BREADCRUMB_LINKS = etree.XPath('//*[@class="nav w100 pad_2"]/a')
+
+# Forum page
+FORUM_BREADCRUMB_LINKS = etree.XPath(
+    '//*[@class="nav nav-top w100 pad_2"]/a')
+
+# Category map page
+CATEGORY_MAP_SECTIONS = etree.XPath('//*/ul[@class="tree-root"]')
+CATEGORY_MAP_SECTION_TITLE = etree.XPath('li/span/span/@title')
+CATEGORY_MAP_LINKS = etree.XPath('.//a/@href')
+
+# Search results page
+SEARCH_ROWS = etree.XPath(
+    '//*/table[@id="tor-tbl"]/tbody/tr[@class="tCenter hl-tr"]')
+
+# All needed cells of search results row, in document order: category
+# link, topic link, author link, size and update timestamp
+SEARCH_ROW_CELLS = etree.XPath(
+    '(td[3]/*/a)[1] | (td[4]/div/a[@data-topic_id])[1] | (td[5]/*/a)[1] | '
+    '(td[6]/u)[1] | (td[10]/u)[1]')
+SEARCH_ROW_CELLS_COUNT = 5
+
+# Links to other pages of search results
+SEARCH_PAGE_LINKS = etree.XPath('//a[@class="pg"]/@href')
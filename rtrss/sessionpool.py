@@ -0,0 +1,80 @@
+"""
+Pool of HTTP sessions, shared by all WebClient instances in the process.
+Keeps keep-alive connections and cookie jars between requests
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import requests
+
+
+MAX_RETRIES = 3
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def make_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
+    session.mount('http://', adapter)
+    return session
+
+
+class SessionPool(object):
+    """
+    Bounded LRU pool of sessions. Sessions unused for more than max_idle
+    seconds are closed and evicted
+    """
+    def __init__(self, size, max_idle):
+        self.size = size
+        self.max_idle = max_idle
+        self._sessions = OrderedDict()  # key: (session, last used time)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns session for key and a flag, indicating whether session was just
+        created
+        :returns (requests.Session, bool)
+        """
+        now = time.time()
+
+        with self._lock:
+            self.evict_idle(now)
+
+            entry = self._sessions.pop(key, None)
+            if entry:
+                session, created = entry[0], False
+            else:
+                session, created = make_session(), True
+
+            self._sessions[key] = (session, now)
+
+            while len(self._sessions) > self.size:
+                _, (evicted, _) = self._sessions.popitem(last=False)
+                evicted.close()
+
+        return session, created
+
+    def evict_idle(self, now):
+        """Close sessions idle for too long. Must be called with lock held"""
+        for key, (session, last_used) in self._sessions.items():
+            if now - last_used <= self.max_idle:
+                break   # Sessions are ordered by last use time
+            del self._sessions[key]
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+def get_pool(config):
+    """Returns process-wide session pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool(config.SESSION_POOL_SIZE,
+                                config.SESSION_MAX_IDLE)
+        return _pool
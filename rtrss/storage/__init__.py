@@ -3,12 +3,29 @@
 import urlparse
 import os
 
-from rtrss.storage import gcs, localdirectory
+from rtrss.storage import gcs, localdirectory, cached, packed
 from rtrss.storage.util import download_and_save_keyfile
 
 
 def make_storage(storage_settings, data_path):
-    """Return file storage based on url scheme"""
+    """
+    Return file storage based on url scheme, remote storage is wrapped with
+    local cache if CACHE_SIZE is set
+    """
+    backend = make_backend(storage_settings, data_path)
+
+    cache_size = storage_settings.get('CACHE_SIZE')
+    if not cache_size or not isinstance(backend, gcs.GCSStorage):
+        return backend
+
+    cache_dir = os.path.join(data_path, 'torrent-cache')
+    memory_size = storage_settings.get('MEMORY_CACHE_SIZE',
+                                       cached.MEMORY_CACHE_SIZE)
+    return cached.CachedStorage(backend, cache_dir, cache_size, memory_size)
+
+
+def make_backend(storage_settings, data_path):
+    """Return file storage backend based on url scheme"""
     parsed = urlparse.urlparse(storage_settings['URL'])
 
     if parsed.scheme == 'gs':
@@ -30,6 +47,10 @@ def make_storage(storage_settings, data_path):
         dirname = parsed.path.rstrip('/')
         return localdirectory.LocalDirectoryStorage(dirname)
 
+    elif parsed.scheme == 'pack':
+        dirname = parsed.path.rstrip('/')
+        return packed.PackedStorage(dirname)
+
     else:
         raise ValueError('Invalid URL: {}'.format(storage_settings['URL']))
 
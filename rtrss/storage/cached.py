@@ -0,0 +1,259 @@
+"""Local cache in front of slow file storage backends"""
+import os
+import time
+import errno
+import logging
+import threading
+from collections import OrderedDict
+
+from rtrss.caching import open_for_atomic_write
+from rtrss.storage.localdirectory import mkdir_p
+
+
+# Default size of in-memory cache tier, bytes
+MEMORY_CACHE_SIZE = 16 * 1024 * 1024
+
+# Modification time of cached files is used as last access time for LRU
+# eviction, it is updated at most once per this interval, seconds
+TOUCH_INTERVAL = 60
+
+_logger = logging.getLogger(__name__)
+
+
+class CachedStorage(object):
+    """
+    Wraps storage backend with two cache tiers: size-limited LRU directory
+    on local disk, shared by all processes, and small in-memory LRU.
+    Memory entries are validated against disk file, so objects deleted or
+    replaced by another process are never served from memory.
+    """
+
+    def __init__(self, backend, cache_dir, max_size,
+                 memory_size=MEMORY_CACHE_SIZE):
+        self._backend = backend
+        self._dir = cache_dir
+        self._max_size = max_size
+        self._memory_size = memory_size
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = None
+        self._lock = threading.Lock()
+
+    def _key_to_path(self, key):
+        if os.sep in key:
+            key = key.replace(os.sep, '%')
+        return os.path.join(self._dir, key)
+
+    def put(self, key, value, **kwargs):
+        self._backend.put(key, value, **kwargs)
+        self._store(key, value)
+
+    def put_async(self, key, value, **kwargs):
+        self._backend.put_async(key, value, **kwargs)
+        self._store(key, value)
+
+    def put_many(self, items, **kwargs):
+        items = list(items)
+        failed = self._backend.put_many(items, **kwargs)
+        for key, value in items:
+            if key not in failed:
+                self._store(key, value)
+        return failed
+
+    def flush(self):
+        return self._uncache(self._backend.flush())
+
+    def close(self):
+        return self._uncache(self._backend.close())
+
+    def _uncache(self, failed):
+        """Drop cached copies of files failed to upload"""
+        for key in failed:
+            self._invalidate(key)
+        return failed
+
+    def get(self, key):
+        value = self._get_cached(key)
+        if value is not None:
+            return value
+
+        value = self._backend.get(key)
+        if value is not None:
+            self._store(key, value)
+        return value
+
+    def _get_cached(self, key):
+        """:returns cached value or None"""
+        path = self._key_to_path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        value = self._memory_get(key, st)
+        if value is None:
+            value = self._disk_get(key, path, st)
+        if value is not None and time.time() - st.st_mtime > TOUCH_INTERVAL:
+            touch(path)
+        return value
+
+    def get_many(self, keys):
+        result = dict()
+        missing = []
+        for key in keys:
+            value = self._get_cached(key)
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+
+        if missing:
+            fetched = self._backend.get_many(missing)
+            for key, value in fetched.items():
+                if value is not None:
+                    self._store(key, value)
+            result.update(fetched)
+
+        return result
+
+    def exists_many(self, keys):
+        return self._backend.exists_many(keys)
+
+    def delete(self, key):
+        self._invalidate(key)
+        self._backend.delete(key)
+
+    def bulk_delete(self, keys):
+        for key in keys:
+            self._invalidate(key)
+        self._backend.bulk_delete(keys)
+
+    def _memory_get(self, key, st):
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is None:
+                return None
+
+            value, signature = entry
+            if signature != _signature(st):
+                self._memory_used -= len(value)
+                return None
+
+            # Move to the end of LRU order
+            self._memory[key] = entry
+            return value
+
+    def _memory_put(self, key, value, st):
+        if len(value) > self._memory_size:
+            return
+
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_used -= len(old[0])
+
+            self._memory[key] = (value, _signature(st))
+            self._memory_used += len(value)
+
+            while self._memory_used > self._memory_size:
+                _, (evicted, _) = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _memory_drop(self, key):
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_used -= len(entry[0])
+
+    def _disk_get(self, key, path, st):
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except IOError:
+            return None
+
+        self._memory_put(key, value, st)
+        return value
+
+    def _store(self, key, value):
+        """Save value to both cache tiers, errors are logged and ignored"""
+        if len(value) > self._max_size:
+            return
+
+        path = self._key_to_path(key)
+        try:
+            if not os.path.isdir(self._dir):
+                mkdir_p(self._dir)
+            with open_for_atomic_write(path) as f:
+                f.write(value)
+            st = os.stat(path)
+        except (IOError, OSError) as e:
+            _logger.warn('Failed to cache %s: %s', key, e)
+            return
+
+        self._memory_put(key, value, st)
+
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used += st.st_size
+            over_limit = self._disk_used is None or \
+                self._disk_used > self._max_size
+
+        if over_limit:
+            self._trim()
+
+    def _invalidate(self, key):
+        self._memory_drop(key)
+        try:
+            os.unlink(self._key_to_path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _trim(self):
+        """Remove least recently used files until cache fits max size"""
+        entries = []
+        for name in os.listdir(self._dir):
+            path = os.path.join(self._dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        used = sum(size for (_, size, _) in entries)
+        removed = 0
+        for (_, size, path) in sorted(entries):
+            if used <= self._max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            used -= size
+            removed += 1
+
+        with self._lock:
+            self._disk_used = used
+
+        if removed:
+            _logger.debug('Removed %d files from torrent cache', removed)
+
+    def __repr__(self):
+        return "<CachedStorage dir='{}' backend={!r}>".format(
+            self._dir, self._backend)
+
+
+def _signature(st):
+    """
+    Identifies version of cached file. Files are replaced by rename, so new
+    version gets new inode, mtime is not used as it changes on access.
+    """
+    return st.st_ino, st.st_size
+
+
+def touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
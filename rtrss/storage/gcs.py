@@ -12,7 +12,8 @@ from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.http import BatchHttpRequest
 from googleapiclient.errors import BatchError, HttpError
 
-from rtrss.storage.util import retry_on_exception
+from rtrss.storage.util import retry_on_exception, ClientPool, \
+    BackgroundUploader, parallel_map
 from rtrss.storage.credentialstorage import Storage
 from rtrss.storage.servicebuilder import CachedServiceBuilder
 
@@ -23,14 +24,28 @@ API_VERSION = 'v1'
 
 SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
 
-# Maximum number of requests in batch request
-MAX_BATCH_SIZE = 1000
+# Maximum number of calls in batch request, limit of JSON API
+MAX_BATCH_CALLS = 100
+
+# Number of batch requests made to check existence of files, failed checks
+# are repeated in next batch
+EXISTS_TRIES = 3
+
+# Maximum number of API clients, one client is used by one thread at a time
+CLIENT_POOL_SIZE = 4
+
+# Number of background upload threads
+UPLOAD_CONCURRENCY = 4
+
+# Number of parallel downloads in get_many
+DOWNLOAD_CONCURRENCY = 4
 
 _logger = logging.getLogger(__name__)
 
-service = None
 credentials_store = None
 
+_init_lock = threading.Lock()
+
 
 class GCSStorage(object):
     def __init__(self, bucket_name, prefix, keyfile_path, client_email):
@@ -38,33 +53,38 @@ class GCSStorage(object):
         self.prefix = prefix
         self.keyfile_path = keyfile_path
         self.client_email = client_email
+        self._bucket_checked = False
+        self._pool = ClientPool(self._make_client, CLIENT_POOL_SIZE)
+        self._uploader = BackgroundUploader(self.put, UPLOAD_CONCURRENCY)
 
-    @property
-    def client(self):
-        if service:
-            return service
+    def _make_client(self):
+        """Create API client with its own HTTP connection"""
+        with _init_lock:
+            if credentials_store is None:
+                init_credentials_store(os.path.dirname(self.keyfile_path))
 
-        with threading.Lock():
-            init_credentials_store(os.path.dirname(self.keyfile_path))
-            init_service(self.keyfile_path, self.client_email)
-            self.ensure_bucket()
+        client = build_service(self.keyfile_path, self.client_email)
 
-        return service
+        with _init_lock:
+            if not self._bucket_checked:
+                self.ensure_bucket(client)
+                self._bucket_checked = True
+
+        return client
 
     @retry_on_exception()
-    def ensure_bucket(self):
+    def ensure_bucket(self, client):
         """Ensure storage bucket exists"""
-        with threading.Lock():
-            self.client.buckets().get(bucket=self.bucket_name).execute()
+        client.buckets().get(bucket=self.bucket_name).execute()
 
     @retry_on_exception()
     def get(self, key):
         """
         Get file from storage. Returns file contents of None if file not exists
         """
-        with threading.Lock():
+        with self._pool.client() as client:
             # Get Payload Data
-            req = self.client.objects().get_media(
+            req = client.objects().get_media(
                 bucket=self.bucket_name,
                 object=self.prefix + key
             )
@@ -88,26 +108,114 @@ class GCSStorage(object):
                 content = fh.getvalue()
         return content
 
+    def get_many(self, keys):
+        """
+        Get files in parallel. Batch requests do not support media downloads,
+        so each file is a separate request.
+        :returns dict(key: contents or None)
+        """
+        keys = list(keys)
+        contents = parallel_map(self.get, keys, DOWNLOAD_CONCURRENCY)
+        return dict(zip(keys, contents))
+
+    def exists_many(self, keys):
+        """
+        Check files existence with batch requests
+        :returns dict(key: True if file exists)
+        """
+        # Request ids of batch calls are object names and must be unique
+        keys = list(set(keys))
+        result = dict()
+        if not keys:
+            return result
+
+        with self._pool.client() as client:
+            for seg in segment(MAX_BATCH_CALLS, keys):
+                found = self._batch_exists([self.prefix + k for k in seg],
+                                           client)
+                for key in seg:
+                    result[key] = self.prefix + key in found
+        return result
+
+    def _batch_exists(self, objects, client):
+        """
+        Check objects existence, repeating failed checks. Objects which
+        could not be checked are reported as missing
+        :returns set of names of existing objects
+        """
+        found = set()
+        for _ in range(EXISTS_TRIES):
+            try:
+                batch_found, objects = batch_exists(objects, client, None,
+                                                    self.bucket_name)
+            except BatchError as e:
+                _logger.warn('Batch error: %s', e)
+                continue
+            except httplib2.HttpLib2Error as e:
+                _logger.warn('Transport error: %s', e)
+                continue
+
+            found.update(batch_found)
+            if not objects:
+                return found
+
+        _logger.error('Failed to check existence of %d files', len(objects))
+        return found
+
     @retry_on_exception()
     def put(self, key, contents, **kwargs):
         """Put file into storage, possibly overwriting it"""
         mimetype = kwargs.get('mimetype', 'application/octet-stream')
 
-        with threading.Lock():
+        with self._pool.client() as client:
             media = MediaIoBaseUpload(io.BytesIO(contents), mimetype=mimetype)
 
-            self.client.objects().insert(
+            client.objects().insert(
                 bucket=self.bucket_name,
                 name=self.prefix + key,
                 media_body=media
             ).execute()
 
+    def put_async(self, key, contents, **kwargs):
+        """
+        Queue file for upload in background, call flush() to wait for
+        queued uploads
+        """
+        self._uploader.submit(key, contents, **kwargs)
+
+    def put_many(self, items, **kwargs):
+        """
+        Upload files in parallel
+        :param items: iterable of (key, contents) tuples
+        :returns list of keys failed to upload
+        """
+        for key, contents in items:
+            self.put_async(key, contents, **kwargs)
+        return self.flush()
+
+    def flush(self):
+        """
+        Wait for background uploads to finish
+        :returns list of keys failed to upload
+        """
+        return self._uploader.flush()
+
+    def close(self):
+        """
+        Wait for background uploads, stop upload threads and drop API
+        clients. Storage may still be used after close.
+        :returns list of keys failed to upload
+        """
+        failed = self._uploader.close()
+        self._pool.close()
+        return failed
+
     @retry_on_exception()
     def delete(self, key):
         """Delete file from storage"""
-        with threading.Lock():
+        with self._pool.client() as client:
             try:
-                self.client.objects().delete(
+                client.objects().delete(
                     bucket=self.bucket_name,
                     object=self.prefix + key
                 ).execute()
@@ -118,16 +226,20 @@ class GCSStorage(object):
                     raise
 
     def bulk_delete(self, keys):
-        with threading.Lock():
-            objects = [self.prefix + key for key in keys]
-            for seg in segment(MAX_BATCH_SIZE, objects):
+        objects = [self.prefix + key for key in keys]
+        with self._pool.client() as client:
+            for seg in segment(MAX_BATCH_CALLS, objects):
                 try:
-                    batch_remove(seg, self.client, None, self.bucket_name)
+                    batch_remove(seg, client, None, self.bucket_name)
                 except BatchError as e:
                     _logger.warn('Batch error: %s', e)
                 except httplib2.HttpLib2Error as e:
                     _logger.warn('Transport error: %s', e)
 
+    def __repr__(self):
+        return "<GCSStorage bucket='{}' prefix='{}'>".format(
+            self.bucket_name, self.prefix)
+
 
 def segment(size, items):
     cuts = range(0, len(items), size)
@@ -152,17 +264,47 @@ def batch_remove(objects, srv, http, bucket_name):
     batch.execute(http=http)
 
 
+@retry_on_exception()
+def batch_exists(objects, srv, http, bucket_name):
+    """
+    :returns tuple(set of names of existing objects, list of names of
+    objects failed to check)
+    """
+    found = set()
+    failed = list()
+
+    def cb(req_id, response, exception):
+        if exception is None:
+            found.add(response['name'])
+        elif not (isinstance(exception, HttpError) and
+                  exception.resp.status == 404):
+            _logger.warn("Request %s failed:%s", req_id, exception)
+            failed.append(req_id)
+
+    batch = BatchHttpRequest()
+    for obj in objects:
+        batch.add(
+            srv.objects().get(
+                bucket=bucket_name,
+                object=obj,
+                fields='name'
+            ), callback=cb, request_id=obj
+        )
+    batch.execute(http=http)
+    return found, failed
+
+
 def init_credentials_store(data_dir):
     global credentials_store
     cs_filename = os.path.join(data_dir, 'stored-credentials.json')
     credentials_store = Storage(cs_filename)
 
 
-def init_service(keyfile_path, client_email):
-    global service
+def build_service(keyfile_path, client_email):
     builder = make_service_builder(keyfile_path, client_email)
-    service = builder.build_service()
+    client = builder.build_service()
     _logger.debug('Google Cloud Storage service created')
+    return client
 
 
 def make_service_builder(keyfile_path, client_email):
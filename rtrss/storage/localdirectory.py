@@ -1,53 +1,143 @@
 import os
 import errno
+import hashlib
 import logging
 
-from rtrss.storage.util import locked_open, M_WRITE
+from rtrss.caching import open_for_atomic_write
+from rtrss.storage.util import SyncUploadMixin
 
 
+# Sharded layout: number of nested subdirectories and length of their names,
+# subdirectory names are taken from hex digest of file key
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
 _logger = logging.getLogger(__name__)
 
 
-class LocalDirectoryStorage(object):
-    def __init__(self, dir_path):
+class LocalDirectoryStorage(SyncUploadMixin):
+    """
+    Stores files in local directory. In sharded layout files are placed in
+    subdirectories named by key hash, files in flat layout (all files in one
+    directory) are still found and can be moved with migrate_flat_layout().
+    """
+
+    def __init__(self, dir_path, sharded=True):
         self._dir = dir_path
+        self._sharded = sharded
 
     def _key_to_path(self, key):
+        if not self._sharded:
+            return self._flat_path(key)
+        digest = hashlib.md5(key).hexdigest()
+        return os.path.join(self._dir, *(
+            [digest[i:i + SHARD_WIDTH] for i in
+             range(0, SHARD_DEPTH * SHARD_WIDTH, SHARD_WIDTH)] + [key]))
+
+    def _flat_path(self, key):
         return os.path.join(self._dir, key)
 
-    def put(self, key, value):
+    def _paths(self, key):
+        """Possible file locations, in lookup order"""
+        path = self._key_to_path(key)
+        if not self._sharded:
+            return [path]
+        # File may be moved from flat layout while we are reading it
+        return [path, self._flat_path(key), path]
+
+    def put(self, key, value, **kwargs):
         filepath = self._key_to_path(key)
         dirpath = os.path.dirname(filepath)
 
         if not os.path.isdir(dirpath):
             mkdir_p(dirpath)
 
-        with locked_open(filepath, M_WRITE) as f:
+        with open_for_atomic_write(filepath) as f:
             f.write(value)
 
+        if self._sharded:
+            unlink(self._flat_path(key))
+
     def get(self, key):
-        try:
-            with locked_open(self._key_to_path(key)) as f:
-                return f.read()
-        except OSError as e:
-            if e.errno == 2:  # No such file
-                return None
+        # Files are replaced by rename, no locking required
+        for path in self._paths(key):
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except IOError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+        return None
+
+    def get_many(self, keys):
+        """:returns dict(key: contents or None)"""
+        return {k: self.get(k) for k in keys}
+
+    def exists_many(self, keys):
+        """:returns dict(key: True if file exists)"""
+        return {k: any(os.path.isfile(p) for p in self._paths(k))
+                for k in keys}
 
     def delete(self, key):
-        try:
-            os.unlink(self._key_to_path(key))
-        except OSError as e:
-            if e.errno == 2:  # No such file
-                pass
+        unlink(self._key_to_path(key))
+        if self._sharded:
+            unlink(self._flat_path(key))
 
     def bulk_delete(self, keys):
         for k in keys:
             self.delete(k)
 
+    def migrate_flat_layout(self):
+        """
+        Move files from flat layout to sharded one, storage may be used
+        while migration is in progress
+        :returns int Number of moved files
+        """
+        if not self._sharded:
+            raise ValueError('Storage is not sharded')
+
+        moved = 0
+        for name in os.listdir(self._dir):
+            flat_path = self._flat_path(name)
+            if not os.path.isfile(flat_path) or name.endswith('.tmp'):
+                continue
+
+            path = self._key_to_path(name)
+            dirpath = os.path.dirname(path)
+            if not os.path.isdir(dirpath):
+                mkdir_p(dirpath)
+
+            # link() never replaces file written to sharded layout after
+            # migration started
+            try:
+                os.link(flat_path, path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:  # Deleted meanwhile
+                    continue
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                moved += 1
+
+            unlink(flat_path)
+
+        _logger.info('Moved %d files to sharded layout in %s', moved,
+                     self._dir)
+        return moved
+
     def __repr__(self):
         return "<LocalDirectoryStorage dir='{}'>".format(self._dir)
 
 
+def unlink(path):
+    """Remove file, if it exists"""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
 def mkdir_p(path):
     """Make directory with all subdirectories
     :param path: directory to create
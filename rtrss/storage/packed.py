@@ -0,0 +1,323 @@
+"""
+Torrent file storage in large append-only segment files.
+
+Files are appended to segment files, their locations are recorded in index
+log, deleted files are marked with tombstone records. Index log is plain
+text, one record per line:
+    P <key> <segment> <offset> <length>   - file stored
+    D <key>                               - file deleted
+    M <generation>                        - storage moved to new generation
+Compaction copies live files to new generation directory and switches
+CURRENT pointer, readers in other processes follow the M record.
+Only one process writes at a time, writers hold exclusive flock.
+"""
+import os
+import mmap
+import errno
+import fcntl
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+
+from rtrss.caching import open_for_atomic_write
+from rtrss.storage.localdirectory import mkdir_p
+from rtrss.storage.util import SyncUploadMixin
+
+
+# New segment is started when current one exceeds this size, bytes
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Compaction starts when deleted data exceeds this share of all data
+COMPACT_RATIO = 0.5
+
+# and this size, bytes
+COMPACT_MIN_GARBAGE = 16 * 1024 * 1024
+
+# Number of files copied at once by compaction
+COMPACT_CHUNK_SIZE = 100
+
+INDEX_FILENAME = 'index.log'
+CURRENT_FILENAME = 'CURRENT'
+LOCK_FILENAME = 'lock'
+
+_logger = logging.getLogger(__name__)
+
+
+class PackedStorage(SyncUploadMixin):
+    def __init__(self, dir_path):
+        self._dir = dir_path
+        self._lock = threading.RLock()
+        self._compaction = None
+        self._reset(None)
+
+    def _reset(self, generation):
+        self._generation = generation
+        self._index = dict()
+        self._index_file = None
+        self._index_pos = 0
+        self._maps = dict()
+        self._segment_sizes = dict()
+        self._live_bytes = 0
+
+    # Index
+
+    def _gen_dir(self, generation=None):
+        if generation is None:
+            generation = self._generation
+        return os.path.join(self._dir, '{:06d}'.format(generation))
+
+    def _segment_path(self, segment):
+        return os.path.join(self._gen_dir(), 'seg-{:06d}.dat'.format(segment))
+
+    def _read_current(self):
+        try:
+            with open(os.path.join(self._dir, CURRENT_FILENAME)) as f:
+                return int(f.read().strip())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _refresh(self):
+        """Read new index records, follow generation switch"""
+        if self._generation is None:
+            generation = self._read_current()
+            if generation is None:
+                return
+            self._reset(generation)
+            path = os.path.join(self._gen_dir(), INDEX_FILENAME)
+            self._index_file = open(path, 'rb')
+
+        self._index_file.seek(self._index_pos)
+        data = self._index_file.read()
+        end = data.rfind('\n') + 1
+        if not end:
+            return
+        self._index_pos += end
+
+        for line in data[:end].splitlines():
+            record = line.split('\t')
+            if record[0] == 'P':
+                key, segment, offset, length = record[1:]
+                self._set_entry(key, (int(segment), int(offset), int(length)))
+            elif record[0] == 'D':
+                self._set_entry(record[1], None)
+            elif record[0] == 'M':
+                self._reload()
+                return
+
+    def _set_entry(self, key, entry):
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._live_bytes -= old[2]
+        if entry is not None:
+            self._index[key] = entry
+            self._live_bytes += entry[2]
+            segment, offset, length = entry
+            self._segment_sizes[segment] = max(
+                self._segment_sizes.get(segment, 0), offset + length)
+
+    def _reload(self):
+        """Load index of current generation from scratch"""
+        self._close()
+        self._reset(None)
+        self._refresh()
+
+    def _close(self):
+        for m in self._maps.values():
+            m.close()
+        if self._index_file is not None:
+            self._index_file.close()
+
+    # Reading
+
+    def _read(self, entry):
+        segment, offset, length = entry
+        m = self._maps.get(segment)
+        if m is None or len(m) < offset + length:
+            if m is not None:
+                m.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = m
+        return m[offset:offset + length]
+
+    def get(self, key):
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+
+            try:
+                return self._read(entry)
+            except (IOError, OSError, ValueError):
+                # Segment removed by compaction in other process
+                self._reload()
+                entry = self._index.get(key)
+                return self._read(entry) if entry else None
+
+    def get_many(self, keys):
+        """:returns dict(key: contents or None)"""
+        return {k: self.get(k) for k in keys}
+
+    def exists_many(self, keys):
+        """:returns dict(key: True if file exists)"""
+        with self._lock:
+            self._refresh()
+            return {k: k in self._index for k in keys}
+
+    # Writing
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive write access, across threads and processes"""
+        with self._lock:
+            if not os.path.isdir(self._dir):
+                mkdir_p(self._dir)
+
+            with open(os.path.join(self._dir, LOCK_FILENAME), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._refresh()
+                    if self._generation is None:
+                        self._create_generation(1)
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _create_generation(self, generation):
+        mkdir_p(self._gen_dir(generation))
+        open(os.path.join(self._gen_dir(generation), INDEX_FILENAME),
+             'ab').close()
+        with open_for_atomic_write(
+                os.path.join(self._dir, CURRENT_FILENAME)) as f:
+            f.write(str(generation))
+        self._reload()
+
+    def _append_index(self, lines):
+        path = os.path.join(self._gen_dir(), INDEX_FILENAME)
+        with open(path, 'ab') as f:
+            f.write(''.join('\t'.join(map(str, line)) + '\n'
+                            for line in lines))
+            f.flush()
+            os.fdatasync(f.fileno())
+        self._refresh()
+
+    def _append_segment(self, items):
+        """Appends values to last segment, returns index records"""
+        segment = max(self._segment_sizes) if self._segment_sizes else 1
+        records = []
+
+        f = open(self._segment_path(segment), 'ab')
+        try:
+            # Position of append mode file is undefined until first write
+            f.seek(0, os.SEEK_END)
+            for key, value in items:
+                offset = f.tell()
+                if offset and offset + len(value) > SEGMENT_SIZE:
+                    f.flush()
+                    os.fdatasync(f.fileno())
+                    f.close()
+                    segment += 1
+                    f = open(self._segment_path(segment), 'ab')
+                    offset = 0
+
+                f.write(value)
+                records.append(('P', key, segment, offset, len(value)))
+            f.flush()
+            os.fdatasync(f.fileno())
+        finally:
+            f.close()
+
+        return records
+
+    def put(self, key, value, **kwargs):
+        self.put_many([(key, value)])
+
+    def put_many(self, items, **kwargs):
+        items = [(_check_key(k), v) for k, v in items]
+        if not items:
+            return []
+
+        with self._writing():
+            self._append_index(self._append_segment(items))
+        return []
+
+    def delete(self, key):
+        self.bulk_delete([key])
+
+    def bulk_delete(self, keys):
+        with self._writing():
+            records = [('D', k) for k in keys if k in self._index]
+            if records:
+                self._append_index(records)
+            needs_compaction = self._needs_compaction()
+
+        if needs_compaction:
+            self.compact_async()
+
+    # Compaction
+
+    def garbage_bytes(self):
+        return sum(self._segment_sizes.values()) - self._live_bytes
+
+    def _needs_compaction(self):
+        garbage = self.garbage_bytes()
+        total = sum(self._segment_sizes.values())
+        return garbage > COMPACT_MIN_GARBAGE and \
+            garbage > total * COMPACT_RATIO
+
+    def compact_async(self):
+        """Start compaction in background thread, unless already running"""
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._compaction = threading.Thread(target=self.compact)
+            self._compaction.daemon = True
+            self._compaction.start()
+
+    def compact(self):
+        """Copy live files to new generation, remove old one"""
+        with self._writing():
+            old_generation = self._generation
+            # Copy in order of location, reading segments sequentially
+            live = sorted(self._index.items(), key=lambda item: item[1])
+
+            new_generation = old_generation + 1
+            new_dir = self._gen_dir(new_generation)
+            if os.path.isdir(new_dir):
+                # Left by interrupted compaction
+                shutil.rmtree(new_dir)
+
+            # Write new generation with no readers, then publish it
+            mkdir_p(new_dir)
+            writer = PackedStorage(self._dir)
+            writer._reset(new_generation)
+            writer._index_file = open(
+                os.path.join(new_dir, INDEX_FILENAME), 'a+b')
+
+            for start in range(0, len(live), COMPACT_CHUNK_SIZE):
+                chunk = live[start:start + COMPACT_CHUNK_SIZE]
+                items = [(key, self._read(entry)) for key, entry in chunk]
+                writer._append_index(writer._append_segment(items))
+            writer._close()
+
+            with open_for_atomic_write(
+                    os.path.join(self._dir, CURRENT_FILENAME)) as f:
+                f.write(str(new_generation))
+            self._append_index([('M', new_generation)])
+
+        shutil.rmtree(self._gen_dir(old_generation), ignore_errors=True)
+        _logger.info('Compacted %s: %d files in generation %d',
+                     self._dir, len(live), new_generation)
+
+    def __repr__(self):
+        return "<PackedStorage dir='{}'>".format(self._dir)
+
+
+def _check_key(key):
+    if '\t' in key or '\n' in key:
+        raise ValueError('Invalid key: {!r}'.format(key))
+    return key
@@ -2,6 +2,8 @@ import logging
 import time
 import os
 import fcntl
+import threading
+from Queue import Queue, Empty
 from contextlib import contextmanager
 
 import requests
@@ -10,10 +12,6 @@ from googleapiclient.errors import HttpError
 
 
 
-
-
-
-
 # Number of retries in case of API errors
 NUM_RETRIES = 3
 
@@ -104,3 +102,195 @@ def download_and_save_keyfile(keyfile_url, keyfile_path):
     with open(keyfile_path, 'w') as fh:
         fh.write(content)
     _logger.info('Keyfile saved to {}'.format(keyfile_path))
+
+
+class ClientPool(object):
+    """
+    Pool of API clients, each client is used by one thread at a time.
+    Clients are created on demand by factory, up to size clients.
+    """
+
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._size = size
+        self._created = 0
+        self._idle = list()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @contextmanager
+    def client(self):
+        client = self._acquire()
+        try:
+            yield client
+        finally:
+            self._release(client)
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._created >= self._size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+
+        try:
+            return self._factory()
+        except Exception:
+            self._drop()
+            raise
+
+    def _release(self, client):
+        if self._closed:
+            self._drop()
+            return
+
+        with self._cond:
+            self._idle.append(client)
+            self._cond.notify()
+
+    def _drop(self):
+        """Forget client, so waiting thread can create a new one"""
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def close(self):
+        """
+        Drop idle clients, clients in use are dropped when returned. Closed
+        pool creates new client for every use
+        """
+        with self._cond:
+            self._closed = True
+            self._created -= len(self._idle)
+            del self._idle[:]
+            self._cond.notify_all()
+
+
+def parallel_map(func, items, concurrency):
+    """
+    Call func for every item in up to concurrency threads
+    :returns list of results in order of items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+    errors = []
+
+    def run():
+        while not errors:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=run)
+               for _ in range(min(concurrency, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+class SyncUploadMixin(object):
+    """
+    Upload interface of storages with local writes: writes are fast, so
+    asynchronous uploads are done synchronously and never fail silently
+    """
+
+    def put_async(self, key, value, **kwargs):
+        self.put(key, value, **kwargs)
+
+    def put_many(self, items, **kwargs):
+        for key, value in items:
+            self.put(key, value, **kwargs)
+        return []
+
+    def flush(self):
+        return []
+
+    def close(self):
+        return []
+
+
+class BackgroundUploader(object):
+    """
+    Runs put(key, value, **kwargs) calls in background threads with bounded
+    concurrency. submit() blocks when queue is full. Threads are started on
+    first submit and stopped by close().
+    """
+
+    def __init__(self, put, concurrency, queue_size=None):
+        self._put = put
+        self._concurrency = concurrency
+        self._queue = Queue(queue_size or concurrency * 4)
+        self._threads = []
+        self._failed = []
+        self._lock = threading.Lock()
+
+    def submit(self, key, value, **kwargs):
+        self._start()
+        self._queue.put((key, value, kwargs))
+
+    def flush(self):
+        """
+        Wait for all submitted uploads to finish
+        :returns list of keys failed to upload
+        """
+        self._queue.join()
+        with self._lock:
+            failed, self._failed = self._failed, []
+        return failed
+
+    def close(self):
+        """
+        Wait for all submitted uploads to finish and stop threads
+        :returns list of keys failed to upload
+        """
+        failed = self.flush()
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join()
+        return failed
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self._concurrency):
+                t = threading.Thread(target=self._run)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+
+            key, value, kwargs = task
+            try:
+                self._put(key, value, **kwargs)
+            except Exception:
+                _logger.exception('Failed to upload %s', key)
+                with self._lock:
+                    self._failed.append(key)
+            finally:
+                self._queue.task_done()
@@ -3,8 +3,13 @@ import hashlib
 import bencode
 
 
+ANNOUNCE_KEY = 'announce'
+ANNOUNCE_LIST_KEY = 'announce-list'
+
+
 class TorrentFile(object):
     def __init__(self, initdata):
+        self._spans = None
         if isinstance(initdata, dict):
             self._decoded = initdata.copy()
             self._encoded = None
@@ -22,6 +27,7 @@ class TorrentFile(object):
     def set_encoded(self, encoded):
         self._encoded = encoded
         self._decoded = None
+        self._spans = None
 
     encoded = property(get_encoded, set_encoded)
 
@@ -36,18 +42,39 @@ class TorrentFile(object):
     def set_decoded(self, decoded):
         self._decoded = decoded
         self._encoded = None
+        self._spans = None
 
     decoded = property(get_decoded, set_decoded)
 
+    @property
+    def spans(self):
+        """Byte ranges of top-level values in encoded data"""
+        if self._spans is None:
+            self._spans = dict_spans(self.encoded)
+        return self._spans
+
+    def _info_spans(self):
+        if 'info' not in self.spans:
+            raise ValueError('Torrent file has no info dictionary')
+        return dict_spans(self._encoded, self.spans['info'][1])
+
     @property
     def infohash(self):
         """Calculates torrent infohash"""
-        info = bencode.bencode(self.decoded['info'])
+        if self._decoded is None:
+            # Hash original bytes of info dictionary, no decoding required
+            _, start, end = self.spans['info']
+            info = memoryview(self._encoded)[start:end]
+        else:
+            info = bencode.bencode(self.decoded['info'])
         return hashlib.sha1(info).hexdigest()
 
     @property
     def download_size(self):
         """Calculates torrent size"""
+        if self._decoded is None:
+            return sum(length for (_, length) in self.files)
+
         length = self.decoded['info'].get('length', 0)
         if length:
             return length
@@ -57,18 +84,262 @@ class TorrentFile(object):
 
         return length
 
+    @property
+    def files(self):
+        """
+        Generates (path, length) tuples for all files in torrent, path is a
+        list of path elements, pieces hashes are never decoded
+        """
+        if self._decoded is not None:
+            info = self.decoded['info']
+            if 'files' not in info:
+                yield [info.get('name')], info.get('length', 0)
+            for entry in info.get('files', []):
+                yield entry['path'], entry['length']
+            return
+
+        data = self._encoded
+        info = self._info_spans()
+
+        if 'files' not in info:
+            yield [_decode_span(data, info.get('name'))], \
+                _decode_span(data, info.get('length'), 0)
+            return
+
+        for pos in list_items(data, info['files'][1]):
+            entry = dict_spans(data, pos)
+            yield _decode_span(data, entry.get('path')), \
+                _decode_span(data, entry.get('length'))
+
     def remove_announcers_with_passkeys(self):
         """Remove all announce urls with user passkey"""
-        if '?uk=' in self.decoded['announce']:
+        if self._decoded is None and self._remove_announcers_encoded():
+            return
+
+        if '?uk=' in self.decoded.get('announce', ''):
             self.decoded.pop('announce', None)
-        ann_list = self.decoded['announce-list']
+        ann_list = self.decoded.get('announce-list', [])
         newlist = filter(lambda a: '?uk=' not in a[0], ann_list)
         self.decoded['announce-list'] = newlist
         self._encoded = None
 
+    def _remove_announcers_encoded(self):
+        """
+        Splice filtered announce urls into encoded data
+        :returns bool False if data can't be spliced
+        """
+        data = self._encoded
+        spans = self.spans
+
+        entries = [k for k in (ANNOUNCE_KEY, ANNOUNCE_LIST_KEY) if k in spans]
+        if not entries:
+            return True
+
+        if len(entries) == 2 and \
+                spans[ANNOUNCE_KEY][2] != spans[ANNOUNCE_LIST_KEY][0]:
+            # Some other key between announce entries
+            return False
+
+        announce = _decode_span(data, spans.get(ANNOUNCE_KEY))
+        ann_list = _decode_span(data, spans.get(ANNOUNCE_LIST_KEY), [])
+
+        replacement = ''
+        if announce is not None and '?uk=' not in announce:
+            replacement += bencode.bencode(ANNOUNCE_KEY) + \
+                bencode.bencode(announce)
+        if ANNOUNCE_LIST_KEY in spans:
+            newlist = filter(lambda a: '?uk=' not in a[0], ann_list)
+            replacement += bencode.bencode(ANNOUNCE_LIST_KEY) + \
+                bencode.bencode(newlist)
+
+        start = spans[entries[0]][0]
+        end = spans[entries[-1]][2]
+        self.set_encoded(data[:start] + replacement + data[end:])
+        return True
+
     def add_announcer(self, announcer):
+        if self._decoded is None:
+            # Fast path, splice announcer into encoded data
+            try:
+                layout = announce_layout(self._encoded)
+            except ValueError:
+                layout = None
+
+            if layout is not None:
+                self.set_encoded(splice_announcer(self._encoded, announcer,
+                                                  layout))
+                return
+
         self.decoded['announce'] = announcer
         if 'announce-list' not in self.decoded:
             self.decoded['announce-list'] = list()
         self.decoded['announce-list'].append([announcer])
         self._encoded = None
+        self._spans = None
+
+
+def dict_spans(data, pos=0):
+    """
+    Streaming scan of encoded dictionary at pos, nested values are skipped
+    without decoding. Top-level dictionary must span whole data.
+    :returns dict(key: tuple(key start, value start, value end))
+    """
+    if data[pos:pos + 1] != 'd':
+        raise ValueError('Dictionary expected at {}'.format(pos))
+
+    spans = dict()
+    start = pos
+    pos += 1
+
+    while pos < len(data) and data[pos] != 'e':
+        key_start = pos
+        key, pos = _read_string(data, pos)
+        value_start = pos
+        pos = _skip_value(data, pos)
+        spans[key] = (key_start, value_start, pos)
+
+    if pos >= len(data):
+        raise ValueError('Unexpected end of torrent file')
+
+    if start == 0 and pos + 1 != len(data):
+        raise ValueError('Unexpected data after end of torrent file')
+
+    return spans
+
+
+def list_items(data, pos):
+    """Generates start positions of items in encoded list at pos"""
+    if data[pos:pos + 1] != 'l':
+        raise ValueError('List expected at {}'.format(pos))
+
+    pos += 1
+    while pos < len(data) and data[pos] != 'e':
+        yield pos
+        pos = _skip_value(data, pos)
+
+    if pos >= len(data):
+        raise ValueError('Unexpected end of torrent file')
+
+
+def announce_layout(data):
+    """
+    Locates announce urls in encoded torrent file. Only top-level keys
+    sorted before 'info' are scanned, so cost does not depend on torrent size.
+    :returns tuple(start, end, list start, list end) - byte range occupied by
+    'announce' and 'announce-list' entries, or insert position if they are
+    missing, and range of announce-list value, or None if data can't be
+    spliced
+    """
+    if not data.startswith('d'):
+        raise ValueError('Torrent file is not a dictionary')
+
+    start = end = None
+    list_span = None
+    pos = 1
+
+    while pos < len(data) and data[pos] != 'e':
+        key_start = pos
+        key, pos = _read_string(data, pos)
+        value_start = pos
+
+        if key > ANNOUNCE_LIST_KEY:
+            break
+
+        pos = _skip_value(data, pos)
+
+        if key < ANNOUNCE_KEY:
+            continue
+
+        if key == ANNOUNCE_KEY:
+            start = key_start
+        elif key == ANNOUNCE_LIST_KEY:
+            if data[value_start] != 'l':
+                return None
+            list_span = (value_start, pos)
+            if start is None:
+                start = key_start
+        else:
+            # Unexpected key between 'announce' and 'announce-list'
+            return None
+
+        end = pos
+    else:
+        if pos >= len(data):
+            raise ValueError('Unexpected end of torrent file')
+        key_start = pos
+
+    if start is None:
+        start = end = key_start
+
+    return (start, end) + (list_span or (None, None))
+
+
+def splice_announcer(data, announcer, layout=None):
+    """
+    Returns encoded torrent with announcer set as 'announce' url and appended
+    to 'announce-list', without decoding whole torrent
+    """
+    if layout is None:
+        layout = announce_layout(data)
+    start, end, list_start, list_end = layout
+
+    encoded = bencode.bencode(announcer)
+    if list_start is None:
+        announce_list = 'l'
+    else:
+        announce_list = data[list_start:list_end - 1]
+
+    return ''.join([
+        data[:start],
+        bencode.bencode(ANNOUNCE_KEY), encoded,
+        bencode.bencode(ANNOUNCE_LIST_KEY), announce_list, 'l', encoded, 'ee',
+        data[end:]
+    ])
+
+
+def _decode_span(data, span, default=None):
+    """Decodes single value by its span"""
+    if span is None:
+        return default
+    try:
+        return bencode.bdecode(data[span[1]:span[2]])
+    except bencode.BTFailure as e:
+        raise ValueError('Failed to decode torrent file: {}'.format(e))
+
+
+def _read_string(data, pos):
+    """Returns string at pos and position after it"""
+    colon = data.find(':', pos)
+    if colon == -1:
+        raise ValueError('Invalid string at {}'.format(pos))
+    try:
+        length = int(data[pos:colon])
+    except ValueError:
+        raise ValueError('Invalid string at {}'.format(pos))
+    end = colon + 1 + length
+    if length < 0 or end > len(data):
+        raise ValueError('Invalid string at {}'.format(pos))
+    return data[colon + 1:end], end
+
+
+def _skip_value(data, pos):
+    """Returns position after encoded value starting at pos"""
+    if pos >= len(data):
+        raise ValueError('Unexpected end of torrent file')
+
+    kind = data[pos]
+    if kind == 'i':
+        end = data.find('e', pos)
+        if end == -1:
+            raise ValueError('Invalid integer at {}'.format(pos))
+        return end + 1
+    elif kind in 'ld':
+        pos += 1
+        while pos < len(data) and data[pos] != 'e':
+            pos = _skip_value(data, pos)
+        if pos >= len(data):
+            raise ValueError('Unexpected end of torrent file')
+        return pos + 1
+    else:
+        _, end = _read_string(data, pos)
+        return end
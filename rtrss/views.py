@@ -1,24 +1,37 @@
 # -*- coding: utf-8 -*-
 import os
 import datetime
+import calendar
 import json
 import random
+import mimetypes
 from functools import wraps
 
 from flask import (send_from_directory, render_template, make_response, abort,
                    Response, request, blueprints, )
+from werkzeug.http import is_resource_modified
 
 from rtrss import config
 from rtrss.storage import make_storage
 from rtrss.webapphelpers import (make_category_tree, get_feed_data,
-                                 check_auth, get_stats_data)
-from rtrss.caching import DiskCache
+                                 check_auth, get_stats_data, insert_passkey,
+                                 make_feed_etag, PASSKEY_PLACEHOLDER)
+from rtrss.caching import (get_cache, feed_namespace, LRUCache, ENCODINGS,
+                           compress, compressed_key, store_compressed,
+                           TREE_NAMESPACE, CATEGORY_TREE_KEY, FEED_KEY,
+                           FEED_META_KEY)
 from rtrss.stats import get_stats
 from rtrss import torrentfile
 
 
+# Number of compressed feeds with passkeys kept in memory
+COMPRESSED_FEEDS_CACHE_SIZE = 500
+
 storage = make_storage(config.FILESTORAGE_SETTINGS, config.DATA_DIR)
 
+# Feeds with passkeys compressed on request, keyed by (etag, encoding)
+compressed_feeds = LRUCache(COMPRESSED_FEEDS_CACHE_SIZE)
+
 blueprint = blueprints.Blueprint('views', __name__)
 
 
@@ -48,17 +61,36 @@ def index():
 
 @blueprint.route('/loadtree')
 def loadtree():
-    # TODO replace DIskCache
-    cache = DiskCache(os.path.join(config.DATA_DIR, 'cache'))
-    cache_key = 'category_tree.json'
-
-    if cache_key not in cache:
+    cache = get_cache(config)
+    version = cache.version(TREE_NAMESPACE)
+    encoding = choose_encoding()
+    if encoding:
+        key = compressed_key(CATEGORY_TREE_KEY, encoding)
+    else:
+        key = CATEGORY_TREE_KEY
+
+    body = cache.get(TREE_NAMESPACE, key, version)
+    if body is None:
         tree = make_category_tree()
         jsontree = json.dumps(tree, ensure_ascii=False, separators=(',', ':'))
-        jsondata = u"var treeData = {};".format(jsontree)
-        cache[cache_key] = jsondata.encode('utf-8')
-    dirname, filename = os.path.split(cache.full_path(cache_key))
-    return send_from_directory(dirname, filename)
+        jsondata = u"var treeData = {};".format(jsontree).encode('utf-8')
+        variants = store_compressed(cache, TREE_NAMESPACE, CATEGORY_TREE_KEY,
+                                    jsondata, version)
+        cache.set(TREE_NAMESPACE, CATEGORY_TREE_KEY, jsondata, version)
+        body = variants[encoding] if encoding else jsondata
+
+    response = make_response(body)
+    response.mimetype = mimetypes.guess_type(CATEGORY_TREE_KEY)[0]
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag('tree-{}-{}'.format(version, encoding or 'identity'))
+    return response.make_conditional(request)
+
+
+def choose_encoding():
+    """Best precompressed content encoding accepted by client, or None"""
+    return request.accept_encodings.best_match(ENCODINGS)
 
 
 @blueprint.route('/torrent/<int:torrent_id>')
@@ -85,16 +117,116 @@ def torrent(torrent_id):
 @blueprint.route('/feed/<int:category_id>')
 def feed(category_id=0):
     passkey = request.args.get('pk')
+    cache = get_cache(config)
+    namespace = feed_namespace(category_id)
+    # Manager bumps namespace version whenever topics of the feed change.
+    # Version is read once, feed rendered from data changed after that is
+    # not stored under newer version
+    version = cache.version(namespace)
+    etag = make_feed_etag(category_id, version, passkey)
+
+    meta = load_feed_meta(cache, namespace, version)
+    if meta is not None and meta['updated_at'] is None:
+        # Empty feed is not rendered again until it gets new topics
+        abort(404)
+
+    if not is_resource_modified(request.environ, etag,
+                                last_modified=feed_last_modified(meta)):
+        response = Response(status=304)
+    else:
+        content = cache.get(namespace, FEED_KEY, version) if meta else None
+        if content is None:
+            content, meta = render_feed(category_id)
+            store_feed(cache, namespace, version, content, meta)
+            if content is None:
+                abort(404)
+
+        encoding = choose_encoding()
+        if encoding:
+            body = compressed_feed(cache, namespace, version, content,
+                                   passkey, etag, encoding)
+        else:
+            body = insert_passkey(content, passkey)
+
+        response = make_response(body)
+        response.headers['content-type'] = \
+            'application/rss+xml; charset=UTF-8'
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    if meta is not None:
+        response.last_modified = feed_last_modified(meta)
+        response.cache_control.max_age = meta['ttl'] * 60
+    return response
+
+
+def compressed_feed(cache, namespace, version, content, passkey, etag,
+                    encoding):
+    """
+    Returns compressed feed. Feeds without passkey are compressed when
+    cached, feeds with passkeys are compressed once per feed version
+    """
+    if not passkey:
+        key = compressed_key(FEED_KEY, encoding)
+        body = cache.get(namespace, key, version)
+        if body is None:
+            body = compress(insert_passkey(content), encoding)
+            cache.set(namespace, key, body, version)
+        return body
+
+    body = compressed_feeds.get((etag, encoding))
+    if body is None:
+        body = compress(insert_passkey(content, passkey), encoding)
+        compressed_feeds.put((etag, encoding), body)
+    return body
+
+
+def load_feed_meta(cache, namespace, version):
+    try:
+        return json.loads(cache.get(namespace, FEED_META_KEY, version))
+    except (TypeError, ValueError):
+        return None
+
+
+def feed_last_modified(meta):
+    if meta is None or meta['updated_at'] is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(meta['updated_at'])
+
+
+def store_feed(cache, namespace, version, content, meta):
+    if content is not None:
+        cache.set(namespace, FEED_KEY, content, version)
+        store_compressed(cache, namespace, FEED_KEY, insert_passkey(content),
+                         version)
+    # Metadata is written last, feed is not used without it
+    cache.set(namespace, FEED_META_KEY, json.dumps(meta), version)
+
+
+def render_feed(category_id):
+    """
+    Render passkey-independent feed, suitable for caching. Content and
+    update time are None if feed is empty
+    :returns tuple(content, dict(updated_at, ttl))
+    """
     feed_data = get_feed_data(category_id)
+    if feed_data is None:
+        return None, dict({'updated_at': None, 'ttl': None})
+
     content = render_template(
         'feed.xml',
         channel=feed_data['channel'],
         items=feed_data['items'],
-        passkey=passkey
+        passkey=PASSKEY_PLACEHOLDER
     ).encode('utf-8')
-    response = make_response(content)
-    response.headers['content-type'] = 'application/rss+xml; charset=UTF-8'
-    return response
+    meta = dict({
+        'updated_at': calendar.timegm(
+            feed_data['updated_at'].utctimetuple()),
+        'ttl': feed_data['channel']['ttl'],
+    })
+    return content, meta
 
 
 @blueprint.route('/favicon.ico')
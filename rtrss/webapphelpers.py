@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
 import rfc822
 
+from flask import escape
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import orm, func
-
-from rtrss.models import Topic, Category, Torrent
+from sqlalchemy import select
+from werkzeug.urls import url_quote_plus
+from rtrss.models import Topic, Category, Torrent, CategoryClosure, \
+    CategoryStats
 from rtrss.stats import get_stats
 from rtrss import config
 
@@ -13,6 +16,9 @@ from rtrss import config
 MIN_TTL = 30  # minutes
 MAX_TTL = 1440  # 1 day
 
+# Rendered into cached feeds in place of the passkey
+PASSKEY_PLACEHOLDER = '__PASSKEY__'
+
 db = SQLAlchemy()
 
 
@@ -24,6 +30,7 @@ def check_auth(login, password):
 
 
 def get_feed_data(category_id):
+    """Returns feed channel data and items, None if feed is empty"""
     category = db.session.query(Category).get(category_id)
     if category_id:
         description = u'Новые раздачи в разделе {}'.format(category.title)
@@ -37,11 +44,11 @@ def get_feed_data(category_id):
         'lastBuildDate': datetime_to_rfc822(datetime.datetime.utcnow())
     })
 
-    category_ids = get_subcategories([category_id]) if category_id else None
+    category_ids = get_subcategories(category_id) if category_id else None
     topics = get_feed_items(category_ids)
 
     if not topics:
-        raise RuntimeError('This feed is empty')
+        return None
 
     items = list()
     deltas = list()
@@ -51,7 +58,7 @@ def get_feed_data(category_id):
         items.append(dict({
             'id': topic.id,
             'title': topic.title,
-            'guid': topic.torrent.infohash,
+            'guid': topic.infohash,
             'pubDate': datetime_to_rfc822(topic.updated_at),
         }))
 
@@ -62,7 +69,31 @@ def get_feed_data(category_id):
         last_dt = topic.updated_at
 
     channel_data['ttl'] = int(calculate_ttl(deltas) / 60)
-    return dict({'channel': channel_data, 'items': items})
+    return dict({
+        'channel': channel_data,
+        'items': items,
+        'updated_at': topics[0].updated_at
+    })
+
+
+def insert_passkey(content, passkey=None):
+    """Replace passkey placeholder in pre-rendered feed with actual passkey,
+    or remove passkey parameter from links if passkey is not set"""
+    if not passkey:
+        return content.replace('?pk=' + PASSKEY_PLACEHOLDER, '')
+
+    quoted = escape(url_quote_plus(passkey)).encode('utf-8')
+    return content.replace(PASSKEY_PLACEHOLDER, quoted)
+
+
+def make_feed_etag(category_id, version, passkey=None):
+    """
+    Feed validator, unique for feed cache namespace version and passkey
+    """
+    passkey_hash = hashlib.md5(passkey.encode('utf-8')).hexdigest() \
+        if passkey else ''
+    data = '{}-{}-{}'.format(category_id, version, passkey_hash)
+    return hashlib.md5(data).hexdigest()
 
 
 def calculate_ttl(deltas):
@@ -95,18 +126,15 @@ def datetime_to_rfc822(the_time):
     return rfc822.formatdate(rfc822.mktime_tz(parsed))
 
 
-def get_subcategories(parent_ids):
-    """Returns list of all subcategory ids"""
-    subcategories = db.session.query(Category.id) \
-        .filter(Category.parent_id.in_(parent_ids)) \
+def get_subcategories(category_id):
+    """Returns list of category id and ids of all its subcategories"""
+    rows = (
+        db.session.query(CategoryClosure.descendant_id)
+        .filter(CategoryClosure.ancestor_id == category_id)
+        .order_by(CategoryClosure.depth)
         .all()
-
-    children = [cat_id for (cat_id, ) in subcategories]
-
-    if children:
-        children += get_subcategories(children)
-
-    return parent_ids + children
+    )
+    return [cid for (cid, ) in rows] or [category_id]
 
 
 def get_feed_items(category_ids=None):
@@ -117,12 +145,28 @@ def get_feed_items(category_ids=None):
     else:  # Leaf category
         limit = 25
 
-    query = db.session.query(Topic).join(Torrent)
+    columns = [Topic.id, Topic.title, Topic.updated_at]
 
-    if category_ids:
-        query = query.filter(Topic.category_id.in_(category_ids))
+    # Single query for the whole subtree, so statement size does not grow
+    # with number of subcategories
+    latest = select(columns).where(Topic.has_torrent)
+    if category_ids is not None:
+        latest = latest.where(Topic.category_id.in_(category_ids))
 
-    return query.order_by(Topic.updated_at.desc()).limit(limit).all()
+    latest = (
+        latest
+        .order_by(Topic.updated_at.desc())
+        .limit(limit)
+        .alias('latest')
+    )
+    query = (
+        db.session.query(latest.c.id, latest.c.title, latest.c.updated_at,
+                         Torrent.infohash)
+        .join(Torrent, Torrent.id == latest.c.id)
+        .order_by(latest.c.updated_at.desc())
+        .limit(limit)
+    )
+    return query.all()
 
 
 def category_link(category, tracker_host):
@@ -173,36 +217,10 @@ def sort_leafs_first(tree):
 
 def category_list(return_empty=False):
     """Returns category list with torrent count for each category"""
-    q = db.session
-    top = (
-        orm.query.Query(
-            [Category.id.label('root_id'), Category.id.label('id')]
-        )
-        .cte('descendants', recursive=True)
-    )
-
-    descendants = (
-        top.union_all(
-            orm.query.Query([top.c.root_id, Category.id])
-            .filter(Category.parent_id == top.c.id))
-    )
-
-    tc = (
-        q.query(Topic.category_id, Torrent.id)
-        .join(Torrent, Torrent.id == Topic.id)
-        .subquery(name='tc')
-    )
-
-    tcc = (
-        q.query(descendants.c.root_id, func.count(tc.c.id).label('cnt'))
-        .filter(descendants.c.id == tc.c.category_id)
-        .group_by(descendants.c.root_id)
-        .subquery(name='tcc')
-    )
-
-    outer = (
-        q.query(Category.id, Category.parent_id, Category.title, tcc.c.cnt)
-        .outerjoin(tcc, tcc.c.root_id == Category.id)
+    query = (
+        db.session.query(Category.id, Category.parent_id, Category.title,
+                         CategoryStats.subtree_torrents.label('cnt'))
+        .outerjoin(CategoryStats)
         .filter(Category.id > 0)
         .order_by(Category.is_subforum)
         .order_by(Category.parent_id)
@@ -210,9 +228,9 @@ def category_list(return_empty=False):
     )
 
     if not return_empty:
-        outer = outer.filter(tcc.c.cnt > 0)
+        query = query.filter(CategoryStats.subtree_torrents > 0)
 
-    return outer.all()
+    return query.all()
 
 def get_stats_data():
     return get_stats(db.session)
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 import logging
-import time
 
 import requests
 from requests.utils import cookiejar_from_dict, dict_from_cookiejar
 
+from rtrss import ratelimit, sessionpool
 from rtrss.util import save_debug_file
 from rtrss.exceptions import (OperationInterruptedException,
                               CaptchaRequiredException, TorrentFileException,
@@ -18,21 +18,13 @@ LOGIN_URL = 'http://login.{host}/forum/login.php'
 MAP_URL = 'http://{host}/forum/index.php?map=1'
 SUBFORUM_URL = 'http://{host}/forum/viewforum.php?f={id}'
 SEARCH_URL = 'http://{host}/forum/tracker.php?f={cid}'
+SEARCH_PAGE_URL = 'http://{host}/forum/{href}'
 
 
 # if this string is in server response then user is logged in
 LOGGED_IN_STR = u'Вы зашли как: &nbsp;<a href="./profile.php?mode='\
     u'viewprofile&amp;u={user_id}"><b class="med">{username}'
 
-# Time between page download requests (seconds)
-PAGE_DOWNLOAD_DELAY = 0.5
-
-# Time between torrent file download requests (seconds)
-TORRENT_DOWNLOAD_DELAY = 5
-
-# Time between search requests (seconds)
-SEARCH_DELAY = 1.8
-
 DL_LIMIT_MSG = u'Вы уже исчерпали суточный лимит скачиваний торрент-файлов'
 
 CAPTCHA_STR = u'<img src="http://static.{host}/captcha/'
@@ -41,8 +33,6 @@ MAINTENANCE_MSG = u'Форум временно отключен на профи
 
 REQUEST_TIMEOUT = 15
 
-MAX_RETRIES = 3
-
 _logger = logging.getLogger(__name__)
 
 
@@ -61,18 +51,36 @@ def detect_cp1251_encoding(response):
 class WebClient(object):
     def __init__(self, config, user=None):
         self.config = config
-        self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
-        self.session.mount('http://', adapter)
-
         self.user = user
 
-        if user:
+        pool = sessionpool.get_pool(config)
+        self.session, created = pool.get(user.id if user else None)
+
+        # Pooled session already has user cookies
+        if user and created:
             self.set_user(user)
 
-    def get_feed(self, cid=0):
+    def throttle(self, kind):
+        """
+        Wait until next request of this kind (page, search, torrent) is allowed
+        for current user
+        """
+        user_id = self.user.id if self.user else None
+        key = (self.config.TRACKER_HOST, user_id, kind)
+        ratelimit.throttle(key, self.config.REQUEST_INTERVALS[kind])
+
+    def get_feed(self, cid=0, etag=None, last_modified=None):
+        """
+        Request ATOM feed, conditionally if validators of previous response
+        are set. Returns response, with status 304 if feed not changed
+        """
         url = FEED_URL.format(host=self.config.TRACKER_HOST, category_id=cid)
-        return self.request(url).content
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return self.request(url, headers=headers)
 
     def request(self, url, method='get', **kwargs):
         if 'timeout' not in kwargs:
@@ -110,14 +118,14 @@ class WebClient(object):
                 save_debug_file(filename, response.content)
 
             self.sign_in(self.user)
-            time.sleep(PAGE_DOWNLOAD_DELAY)
+            self.throttle('page')
             response = self.request(url, method, **kwargs)
 
         return response
 
     def get_topic(self, tid):
         url = TOPIC_URL.format(host=self.config.TRACKER_HOST, topic_id=tid)
-        time.sleep(PAGE_DOWNLOAD_DELAY)
+        self.throttle('page')
         return self.authorized_request(url).text
 
     def get_torrent(self, torrent_id):
@@ -126,10 +134,10 @@ class WebClient(object):
                                  topic_id=torrent_id)
 
         cookies = {'bb_dl': str(torrent_id)}
+        self.throttle('torrent')
         response = self.authorized_request(url, 'post', cookies=cookies)
 
         if 'application/x-bittorrent' in response.headers['content-type']:
-            time.sleep(TORRENT_DOWNLOAD_DELAY)
             return response.content
 
         # Something went wrong
@@ -171,7 +179,7 @@ class WebClient(object):
                      'login_password': user.password,
                      'login': '%C2%F5%EE%E4'}
 
-        time.sleep(PAGE_DOWNLOAD_DELAY)
+        self.throttle('page')
         response = self.request(login_url, 'post', data=post_data)
         html = response.text
 
@@ -194,12 +202,12 @@ class WebClient(object):
 
     def get_category_map(self):
         url = MAP_URL.format(host=self.config.TRACKER_HOST)
-        time.sleep(PAGE_DOWNLOAD_DELAY)
+        self.throttle('page')
         return self.authorized_request(url).text
 
     def get_forum_page(self, fid):
         url = SUBFORUM_URL.format(host=self.config.TRACKER_HOST, id=fid)
-        time.sleep(PAGE_DOWNLOAD_DELAY)
+        self.throttle('page')
         return self.authorized_request(url).text
 
     def find_torrents(self, cid=None):
@@ -216,5 +224,12 @@ class WebClient(object):
             'oop': 1        # only open
         }
         url = SEARCH_URL.format(host=self.config.TRACKER_HOST, cid=cid or '')
-        time.sleep(SEARCH_DELAY)
+        self.throttle('search')
         return self.authorized_request(url, 'post', data=form_data).text
+
+    def get_search_page(self, href):
+        """Get next page of search results by pagination link"""
+        url = SEARCH_PAGE_URL.format(host=self.config.TRACKER_HOST,
+                                     href=href.lstrip('./'))
+        self.throttle('search')
+        return self.authorized_request(url).text
@@ -3,7 +3,12 @@ import os
 import logging
 import argparse
 
-from rtrss import config, scheduler, database, manager, util
+from rtrss import config, backends
+
+# Patch blocking modules before they are used by the rest of the worker
+backends.setup(config.WEBCLIENT_BACKEND)
+
+from rtrss import scheduler, database, manager, util, scraper
 
 
 _logger = logging.getLogger(__name__)
@@ -16,10 +21,13 @@ def worker_init():
 
 def worker_teardown():
     _logger.debug('Tearing down worker')
+    scraper.stop_parse_pool()
     logging.shutdown()
 
 
 def worker_action(action):
+    # Parsing processes are forked before agent and storage threads start
+    scraper.start_parse_pool(config)
     util.init_newrelic_agent()
     util.setup_logentries_logging('LOGENTRIES_TOKEN_WORKER')
 
@@ -39,6 +47,8 @@ def db_action(action):
         database.clear()
     elif action == 'init':
         database.init()
+    elif action == 'migrate':
+        database.migrate()
     elif action == 'import_users':
         csvfilename = os.path.join(config.ROOT_DIR, 'users.csv')
         database.import_users(csvfilename)
@@ -60,7 +70,7 @@ def make_argparser():
         'action',
         help='Action to perform',
         choices=['run', 'update', 'sync_categories', 'populate_categories',
-                 'cleanup']
+                 'cleanup', 'rebuild_category_stats', 'migrate_storage']
     )
     wp.set_defaults(func=worker_action)
 
@@ -70,7 +80,7 @@ def make_argparser():
     dbp.add_argument(
         'action',
         help='Perform database initialization or clean-up',
-        choices=['init', 'clear', 'import_users']
+        choices=['init', 'clear', 'migrate', 'import_users']
     )
     dbp.set_defaults(func=db_action)
 
@@ -0,0 +1,37 @@
+"""
+Micro-benchmark of search results parsing, reports cost per row.
+Run with: RTRSS_ENVIRONMENT=testing python -m tests.bench_scraper
+"""
+import timeit
+
+from rtrss import scraper
+from tests.test_scraper import make_search_page
+
+
+ROWS = 50
+REPEAT = 5
+NUMBER = 100
+
+
+def best_time(stmt):
+    """Best time of single statement call, seconds"""
+    return min(timeit.repeat(stmt, repeat=REPEAT, number=NUMBER)) / NUMBER
+
+
+def main():
+    html = make_search_page(ROWS)
+    tree = scraper.make_tree(html)
+    rows = scraper.selectors.SEARCH_ROWS(tree)
+
+    page = best_time(lambda: scraper.parse_search_page(html))
+    build = best_time(lambda: scraper.make_tree(html))
+    row = best_time(lambda: [scraper.parse_search_row(r) for r in rows])
+
+    print('Search page of {} rows: {:.2f} ms'.format(ROWS, page * 1000))
+    print('  tree building:  {:.2f} ms'.format(build * 1000))
+    print('  row parsing:    {:.2f} ms, {:.1f} us per row'.format(
+        row * 1000, row / ROWS * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+import unittest
+
+from rtrss import backends
+
+
+class BackendsTestCase(unittest.TestCase):
+    def test_setup_sync_backend_does_nothing(self):
+        self.assertIsNone(backends.setup(backends.SYNC))
+
+    def test_setup_raises_on_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            backends.setup('unknown backend')
@@ -0,0 +1,65 @@
+import os
+import unittest
+
+from testfixtures import TempDirectory
+from mock import MagicMock
+
+from rtrss.storage.cached import CachedStorage
+
+
+class CachedStorageTestCase(unittest.TestCase):
+    key = '1.torrent'
+    value = 'some torrent data'
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.backend = MagicMock()
+        self.backend.get.return_value = self.value
+        self.store = CachedStorage(self.backend, self.dir.path, 1024, 64)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_get_fetches_from_backend_once(self):
+        self.assertEqual(self.store.get(self.key), self.value)
+        self.assertEqual(self.store.get(self.key), self.value)
+        self.backend.get.assert_called_once_with(self.key)
+
+    def test_put_populates_cache(self):
+        self.store.put(self.key, self.value)
+        self.backend.put.assert_called_once_with(self.key, self.value)
+        self.assertEqual(self.store.get(self.key), self.value)
+        self.assertFalse(self.backend.get.called)
+
+    def test_get_returns_none_for_nonexistent(self):
+        self.backend.get.return_value = None
+        self.assertIsNone(self.store.get(self.key))
+        self.assertFalse(os.listdir(self.dir.path))
+
+    def test_delete_invalidates_cache(self):
+        self.store.put(self.key, self.value)
+        self.store.delete(self.key)
+        self.backend.delete.assert_called_once_with(self.key)
+        self.store.get(self.key)
+        self.backend.get.assert_called_once_with(self.key)
+
+    def test_bulk_delete_invalidates_cache(self):
+        self.store.put(self.key, self.value)
+        self.store.bulk_delete([self.key])
+        self.backend.bulk_delete.assert_called_once_with([self.key])
+        self.store.get(self.key)
+        self.backend.get.assert_called_once_with(self.key)
+
+    def test_memory_entry_not_used_after_file_removed(self):
+        other = CachedStorage(self.backend, self.dir.path, 1024, 64)
+        self.store.put(self.key, self.value)
+        other.delete(self.key)
+        self.store.get(self.key)
+        self.backend.get.assert_called_once_with(self.key)
+
+    def test_disk_cache_size_is_limited(self):
+        for i in range(10):
+            self.store.put(str(i), 'x' * 300)
+        size = sum(os.path.getsize(os.path.join(self.dir.path, name))
+                   for name in os.listdir(self.dir.path))
+        self.assertLessEqual(size, 1024)
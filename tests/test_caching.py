@@ -1,6 +1,10 @@
 import os
+import time
+import unittest
 import tempfile
 
+from mock import patch
+
 from tests import TempDirTestCase
 from rtrss import caching
 
@@ -35,3 +39,82 @@ class CachingTestCase(TempDirTestCase):
             data = f.read()
 
         self.assertEqual(test_data, data)
+
+
+class CompressionTestCase(TempDirTestCase):
+    def test_store_compressed_stores_all_variants(self):
+        cache = caching.Cache(self.dir.path, 1024, 60)
+        caching.store_compressed(cache, 'ns', 'key', 'value')
+        for encoding in caching.ENCODINGS:
+            key = caching.compressed_key('key', encoding)
+            self.assertIsNotNone(cache.get('ns', key))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_lrucache_evicts_least_recently_used(self):
+        cache = caching.LRUCache(max_items=2)
+        cache.put('first', '1')
+        cache.put('second', '2')
+        cache.get('first')
+        cache.put('third', '3')
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('first'), '1')
+
+    def test_lrucache_limits_size(self):
+        cache = caching.LRUCache(max_bytes=10)
+        cache.put('first', 'x' * 6)
+        cache.put('second', 'x' * 6)
+        self.assertIsNone(cache.get('first'))
+        self.assertIsNotNone(cache.get('second'))
+
+    def test_lrucache_expires_items(self):
+        cache = caching.LRUCache(ttl=10)
+        cache.put('key', 'value')
+        with patch('rtrss.caching.time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache.get('key'))
+
+
+class CacheTestCase(TempDirTestCase):
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.cache = caching.Cache(self.dir.path, 1024, 60)
+
+    def test_get_returns_stored(self):
+        self.cache.set('ns', 'key', 'value')
+        self.assertEqual(self.cache.get('ns', 'key'), 'value')
+
+    def test_get_returns_none_for_nonexistent(self):
+        self.assertIsNone(self.cache.get('ns', 'key'))
+
+    def test_other_instance_reads_shared_tier(self):
+        self.cache.set('ns', 'key', 'value')
+        other = caching.Cache(self.dir.path, 1024, 60)
+        self.assertEqual(other.get('ns', 'key'), 'value')
+
+    def test_bump_invalidates_namespace_in_other_instance(self):
+        other = caching.Cache(self.dir.path, 1024, 60)
+        self.cache.set('ns', 'key', 'value')
+        self.cache.set('other ns', 'key', 'value')
+        self.assertEqual(other.get('ns', 'key'), 'value')
+
+        self.cache.bump('ns')
+
+        with patch.object(caching, 'VERSION_CHECK_INTERVAL', 0):
+            self.assertIsNone(other.get('ns', 'key'))
+            self.assertEqual(other.get('other ns', 'key'), 'value')
+
+    def test_set_stores_under_given_version(self):
+        version = self.cache.version('ns')
+        self.cache.bump('ns')
+        self.cache.set('ns', 'key', 'old value', version)
+
+        self.assertIsNone(self.cache.get('ns', 'key'))
+        self.assertEqual(self.cache.get('ns', 'key', version), 'old value')
+
+    def test_purge_stale_removes_old_versions(self):
+        self.cache.set('ns', 'key', 'old value')
+        self.cache.bump('ns')
+        self.cache.set('ns', 'key', 'new value')
+
+        self.assertEqual(self.cache.purge_stale(), 1)
+        self.assertEqual(self.cache.get('ns', 'key'), 'new value')
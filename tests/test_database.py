@@ -0,0 +1,32 @@
+from mock import patch
+
+from tests import DatabaseTestCase
+from rtrss import database
+from rtrss.models import Category, CategoryClosure, CategoryStats
+
+
+class DatabaseMigrationTestCase(DatabaseTestCase):
+    def test_migrate_is_idempotent(self):
+        database.migrate()
+        database.migrate()
+        indexes = self.db.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'topics'")
+        self.assertIn('ix_category_updated_at', [i for (i, ) in indexes])
+
+    def test_migrate_rebuilds_category_closure(self):
+        self.db.add(Category(id=0, title='Root', tracker_id=0))
+        self.db.add(Category(id=1, title='Child', tracker_id=1, parent_id=0))
+        self.db.commit()
+
+        database.migrate()
+
+        closure = [(c.ancestor_id, c.descendant_id)
+                   for c in self.db.query(CategoryClosure)]
+        self.assertEqual(sorted(closure), [(0, 0), (0, 1), (1, 1)])
+        self.assertEqual(self.db.query(CategoryStats).count(), 2)
+
+    @patch('rtrss.database.server_version_num')
+    def test_migrate_fails_on_old_server(self, svn):
+        svn.return_value = 90200
+        with self.assertRaises(RuntimeError):
+            database.migrate()
@@ -0,0 +1,31 @@
+import datetime
+
+from tests import TempDirTestCase
+from rtrss.feedstate import FeedState
+
+
+class FeedStateTestCase(TempDirTestCase):
+    def test_load_returns_empty_state_if_missing(self):
+        state = FeedState.load(self.dir.path)
+        self.assertIsNone(state.high_water)
+        self.assertFalse(state.is_seen(1, datetime.datetime.utcnow()))
+
+    def test_save_and_load_round_trip(self):
+        now = datetime.datetime(2016, 1, 1, 12, 0, 0, 500)
+        state = FeedState.load(self.dir.path)
+        state.etag = '"abc"'
+        state.advance([dict(id=1, updated_at=now),
+                       dict(id=2, updated_at=now)])
+        state.retry = {3: dict(id=3, title='Title', updated_at=now,
+                               changed=True)}
+        state.save()
+
+        loaded = FeedState.load(self.dir.path)
+        self.assertEqual(loaded.etag, '"abc"')
+        self.assertEqual(loaded.high_water, now)
+        self.assertEqual(loaded.seen_ids, {1, 2})
+        self.assertEqual(loaded.retry, state.retry)
+
+    def test_load_ignores_invalid_state(self):
+        self.dir.write('feed-state.json', b'{invalid')
+        self.assertIsNone(FeedState.load(self.dir.path).high_water)
@@ -88,12 +88,29 @@ class GCSStorageTestCase(unittest.TestCase):
         mock_storage.assert_called_once()
 
     @patch('rtrss.storage.gcs.make_service_builder')
-    def test_init_service_sets_service(self, mock_make_service_builder):
+    def test_build_service_returns_service(self, mock_make_service_builder):
         mock_builder = MagicMock()
         mock_builder.build_service.return_value = mock_service = MagicMock()
         mock_make_service_builder.return_value = mock_builder
-        gcs.init_service('', '')
-        self.assertIs(mock_service, gcs.service)
+        self.assertIs(mock_service, gcs.build_service('', ''))
+
+    @patch('rtrss.storage.gcs.init_credentials_store')
+    @patch('rtrss.storage.gcs.build_service')
+    def test_put_many_uploads_all(self, mock_build_service, _):
+        mock_build_service.side_effect = lambda *args: MagicMock()
+        store = gcs.GCSStorage(self.bucket_name, self.prefix,
+                               self.keyfile_path, self.email)
+        items = [(str(i), self.test_value) for i in range(10)]
+
+        failed = store.put_many(items)
+
+        self.assertEqual(failed, [])
+        calls = [c for client in store._pool._idle
+                 for c in client.objects.return_value.insert.call_args_list]
+        names = sorted(c[1]['name'] for c in calls)
+        self.assertEqual(names, sorted(self.prefix + k for k, _ in items))
+        self.assertLessEqual(mock_build_service.call_count,
+                             gcs.CLIENT_POOL_SIZE)
 
     def test_make_service_builder_returns_csb(self):
         result = gcs.make_service_builder(self.keyfile_path, self.email)
@@ -110,3 +127,51 @@ class GCSStorageTestCase(unittest.TestCase):
         mmc.return_value = mock_credentials = MagicMock()
         _ = gcs.make_service_builder(self.keyfile_path, self.email)
         mock_credentials.authorize.assert_called_once_with(httplib2.Http())
+
+    @patch('rtrss.storage.gcs.BatchHttpRequest')
+    def test_batch_exists_returns_found_objects(self, mock_batch_class):
+        not_found = gcs.HttpError(AttrDict({'status': 404}), '')
+        server_error = gcs.HttpError(AttrDict({'status': 503}), '')
+        callbacks = []
+        batch = mock_batch_class.return_value
+        batch.add.side_effect = lambda req, callback, request_id: \
+            callbacks.append(callback)
+        batch.execute.side_effect = lambda http: [
+            callbacks[0]('first', {'name': 'first'}, None),
+            callbacks[1]('second', None, not_found),
+            callbacks[2]('third', None, server_error),
+        ]
+
+        found, failed = gcs.batch_exists(['first', 'second', 'third'],
+                                         MagicMock(), None, self.bucket_name)
+
+        self.assertEqual(found, {'first'})
+        self.assertEqual(failed, ['third'])
+
+    @patch('rtrss.storage.gcs.batch_exists')
+    def test_exists_many_splits_keys_into_batches(self, batch_exists):
+        batch_exists.side_effect = lambda objects, srv, http, bucket: (
+            set(objects), [])
+        keys = [str(i) for i in range(250)]
+
+        store = gcs.GCSStorage(self.bucket_name, '', self.keyfile_path,
+                               self.email)
+        with patch.object(store, '_pool'):
+            result = store.exists_many(keys)
+
+        self.assertEqual(result, dict((k, True) for k in keys))
+        sizes = [len(c[0][0]) for c in batch_exists.call_args_list]
+        self.assertEqual(sorted(sizes), [50, 100, 100])
+
+    @patch('rtrss.storage.gcs.batch_exists')
+    def test_exists_many_repeats_failed_checks(self, batch_exists):
+        batch_exists.side_effect = [({'first'}, ['second']),
+                                    ({'second'}, [])]
+
+        store = gcs.GCSStorage(self.bucket_name, '', self.keyfile_path,
+                               self.email)
+        with patch.object(store, '_pool'):
+            result = store.exists_many(['first', 'second'])
+
+        self.assertEqual(result, {'first': True, 'second': True})
+        self.assertEqual(batch_exists.call_args[0][0], ['second'])
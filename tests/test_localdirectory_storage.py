@@ -1,3 +1,4 @@
+import os
 import unittest
 
 from testfixtures import TempDirectory
@@ -12,7 +13,7 @@ class LocalDirectoryStorageTestCase(unittest.TestCase):
 
     def setUp(self):
         self.dir = TempDirectory()
-        self.store = LocalDirectoryStorage(self.dir.path)
+        self.store = LocalDirectoryStorage(self.dir.path, sharded=False)
 
     def tearDown(self):
         self.dir.cleanup()
@@ -61,3 +62,57 @@ class LocalDirectoryStorageTestCase(unittest.TestCase):
         mkdir_p(self.dir.getpath(dirname))
         self.dir.check_dir(dirname)
 
+    def test_get_many_retrieves_all(self):
+        self.dir.write(self.test_key, self.test_value)
+        result = self.store.get_many([self.test_key, 'nonexistent key'])
+        self.assertEqual(result, {self.test_key: self.test_value,
+                                  'nonexistent key': None})
+
+    def test_exists_many_checks_all(self):
+        self.dir.write(self.test_key, self.test_value)
+        result = self.store.exists_many([self.test_key, 'nonexistent key'])
+        self.assertEqual(result, {self.test_key: True,
+                                  'nonexistent key': False})
+
+
+class ShardedLocalDirectoryStorageTestCase(unittest.TestCase):
+    test_key = '12345.torrent'
+    test_value = 'some random value'
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.store = LocalDirectoryStorage(self.dir.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_put_stores_in_subdirectory(self):
+        self.store.put(self.test_key, self.test_value)
+        self.assertNotIn(self.test_key, os.listdir(self.dir.path))
+        self.assertEqual(self.store.get(self.test_key), self.test_value)
+
+    def test_get_finds_file_in_flat_layout(self):
+        self.dir.write(self.test_key, self.test_value)
+        self.assertEqual(self.store.get(self.test_key), self.test_value)
+
+    def test_put_replaces_file_in_flat_layout(self):
+        self.dir.write(self.test_key, 'old value')
+        self.store.put(self.test_key, self.test_value)
+        self.assertEqual(self.store.get(self.test_key), self.test_value)
+        self.assertNotIn(self.test_key, os.listdir(self.dir.path))
+
+    def test_delete_deletes_from_both_layouts(self):
+        self.dir.write(self.test_key, self.test_value)
+        self.store.delete(self.test_key)
+        self.assertIsNone(self.store.get(self.test_key))
+
+    def test_migrate_flat_layout_moves_files(self):
+        for i in range(5):
+            self.dir.write('{}.torrent'.format(i), str(i))
+
+        self.assertEqual(self.store.migrate_flat_layout(), 5)
+
+        self.assertFalse([name for name in os.listdir(self.dir.path)
+                          if os.path.isfile(self.dir.getpath(name))])
+        self.assertEqual(self.store.get('3.torrent'), '3')
+        self.assertEqual(self.store.migrate_flat_layout(), 0)
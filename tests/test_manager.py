@@ -1,8 +1,374 @@
-from tests import DatabaseTestCase
+import datetime
+import threading
 
-from rtrss import manager
+from testfixtures import TempDirectory
+from mock import patch, MagicMock
+
+from tests import DatabaseTestCase, AttrDict
+from rtrss import manager, config, database
+from rtrss.caching import get_cache, feed_namespace, FEED_KEY
+from rtrss.exceptions import TopicException, OperationInterruptedException
+from rtrss.feedstate import FeedState
+from rtrss.models import (Category, Topic, Torrent, User, CategoryClosure,
+                          CategoryStats)
 
 
 class ManagerTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(ManagerTestCase, self).setUp()
+        self.dir = TempDirectory()
+        self.data_dir = patch.object(config, 'DATA_DIR', self.dir.path)
+        self.data_dir.start()
+
+    def tearDown(self):
+        self.data_dir.stop()
+        self.dir.cleanup()
+        super(ManagerTestCase, self).tearDown()
+
+    def _populate_categories(self):
+        self.db.add(Category(id=0, title='Root', tracker_id=0,
+                             is_subforum=False))
+        self.db.add(Category(id=1, title='Parent', tracker_id=1, parent_id=0,
+                             is_subforum=False))
+        self.db.add(Category(id=2, title='Child', tracker_id=2, parent_id=1))
+        self.db.add(Category(id=3, title='Other', tracker_id=3, parent_id=0))
+        self.db.commit()
+
     def test_load_topics_returns_empty_(self):
         self.assertEqual(manager.load_topics([-1]), dict())
+
+    def test_category_index_finds_loaded_categories(self):
+        self._populate_categories()
+        index = manager.CategoryIndex()
+        index.load()
+        self.assertEqual(index.find(2, True), 2)
+        self.assertIsNone(index.find(2, False))
+
+    def test_category_index_with_ancestors_returns_all_ancestors(self):
+        self._populate_categories()
+        index = manager.CategoryIndex()
+        index.load()
+        self.assertEqual(index.with_ancestors([2]), {0, 1, 2})
+
+    def test_ensure_category_adds_parents_to_index(self):
+        self._populate_categories()
+        self.db.execute("SELECT setval('categories_id_seq', 100)")
+        self.db.commit()
+        mgr = manager.Manager(config)
+        parents = [
+            dict(tracker_id=0, is_subforum=False, title=u'Root'),
+            dict(tracker_id=4, is_subforum=False, title=u'New parent'),
+        ]
+        child = dict(tracker_id=5, is_subforum=True, title=u'New child')
+
+        category_id = mgr.ensure_category(child, parents)
+
+        self.assertEqual(mgr.categories.find(5, True), category_id)
+        self.assertEqual(self.db.query(Category).get(category_id).parent_id,
+                         mgr.categories.find(4, False))
+
+    def test_ensure_category_adds_closure_and_stats(self):
+        self._populate_categories()
+        mgr = manager.Manager(config)
+        mgr.rebuild_category_stats()
+        self.db.execute("SELECT setval('categories_id_seq', 100)")
+        self.db.commit()
+        child = dict(tracker_id=5, is_subforum=True, title=u'New child')
+        parents = [dict(tracker_id=2, is_subforum=True, title=u'Child')]
+
+        category_id = mgr.ensure_category(child, parents)
+
+        ancestors = (
+            self.db.query(CategoryClosure.ancestor_id)
+            .filter(CategoryClosure.descendant_id == category_id)
+        )
+        self.assertEqual(set(a for (a, ) in ancestors), {0, 1, 2, category_id})
+        self.assertIsNotNone(self.db.query(CategoryStats).get(category_id))
+
+    def test_rebuild_category_stats_counts_subtree_torrents(self):
+        self._populate_categories()
+        topic = Topic(id=1, title='Topic', category_id=2,
+                      updated_at=datetime.datetime.utcnow())
+        topic.torrent = Torrent(infohash='infohash', size=1, tfsize=1)
+        self.db.add(topic)
+        self.db.commit()
+
+        manager.Manager(config).rebuild_category_stats()
+
+        stats = dict((s.category_id, (s.torrents, s.subtree_torrents))
+                     for s in self.db.query(CategoryStats))
+        self.assertEqual(stats, {0: (0, 1), 1: (0, 1), 2: (1, 1), 3: (0, 0)})
+
+    def test_update_torrent_counts_updates_ancestors(self):
+        self._populate_categories()
+        manager.Manager(config).rebuild_category_stats()
+        db = database.Session()
+        manager.update_torrent_counts(db, {2: 2})
+        db.commit()
+        db.close()
+
+        stats = dict((s.category_id, (s.torrents, s.subtree_torrents))
+                     for s in self.db.query(CategoryStats))
+        self.assertEqual(stats, {0: (0, 2), 1: (0, 2), 2: (2, 2), 3: (0, 0)})
+
+    def test_invalidate_cache_invalidates_changed_feeds_only(self):
+        self._populate_categories()
+        cache = get_cache(config)
+        for cid in range(4):
+            cache.set(feed_namespace(cid), FEED_KEY, 'feed')
+
+        mgr = manager.Manager(config)
+        mgr.changed_categories.add(2)
+        mgr.invalidate_cache()
+
+        self.assertIsNone(cache.get(feed_namespace(0), FEED_KEY))
+        self.assertIsNone(cache.get(feed_namespace(1), FEED_KEY))
+        self.assertIsNone(cache.get(feed_namespace(2), FEED_KEY))
+        self.assertEqual(cache.get(feed_namespace(3), FEED_KEY), 'feed')
+
+    @patch.object(manager.Manager, 'close_storage')
+    @patch.object(manager.Manager, 'invalidate_cache')
+    @patch.object(manager.Manager, 'update')
+    def test_task_invalidates_cache_if_interrupted(self, update, ic, cs):
+        update.side_effect = OperationInterruptedException('tracker is down')
+        manager.Manager(config).task_wrapper('update')
+        self.assertTrue(ic.called)
+
+    def test_cleanup_keeps_latest_torrents_in_flagged_categories(self):
+        self._populate_categories()
+        now = datetime.datetime.utcnow()
+        for i in range(30):
+            topic = Topic(id=i + 1, title='Topic', category_id=2,
+                          updated_at=now - datetime.timedelta(hours=i))
+            topic.torrent = Torrent(infohash=str(i), size=1, tfsize=1)
+            topic.has_torrent = True
+            self.db.add(topic)
+        self.db.commit()
+
+        mgr = manager.Manager(config)
+        mgr.rebuild_category_stats()
+        mgr._storage = MagicMock()
+        with patch.object(manager, 'CLEANUP_BATCH_SIZE', 2):
+            mgr.cleanup()
+
+        ids = sorted(t for (t, ) in self.db.query(Topic.id))
+        self.assertEqual(ids, range(1, 26))
+        stats = self.db.query(CategoryStats).get(2)
+        self.db.refresh(stats)
+        self.assertEqual(stats.torrents, 25)
+        self.assertFalse(stats.needs_cleanup)
+        self.assertEqual(self.db.query(CategoryStats).get(0).subtree_torrents,
+                         25)
+        deleted = [k for c in mgr._storage.bulk_delete.call_args_list
+                   for k in c[0][0]]
+        self.assertEqual(sorted(deleted),
+                         sorted('{}.torrent'.format(i) for i in range(26, 31)))
+
+    @patch('rtrss.manager.select_users')
+    @patch.object(manager.Manager, 'process_pending_topic')
+    def test_process_pending_items_in_lanes_processes_all(self, ppt, su):
+        su.return_value = ['first user', 'second user']
+        ppt.return_value = 1
+        items = [dict(id=i) for i in range(10)]
+
+        with patch.object(config, 'UPDATE_CONCURRENCY', 2):
+            result = manager.Manager(config).process_pending_items(items)
+
+        self.assertEqual(result, len(items))
+        processed = sorted(c[0][0]['id'] for c in ppt.call_args_list)
+        self.assertEqual(processed, range(10))
+
+    @patch('rtrss.manager.load_topics')
+    @patch('rtrss.manager.Scraper')
+    def test_make_pending_list_skips_database_if_nothing_new(self, scraper,
+                                                             lt):
+        scraper.return_value.get_latest_topics.return_value = dict()
+        state = FeedState.load(self.dir.path)
+
+        self.assertEqual(manager.Manager(config).make_pending_list(state), [])
+        self.assertFalse(lt.called)
+
+    @patch('rtrss.manager.load_topics')
+    @patch('rtrss.manager.Scraper')
+    def test_make_pending_list_retries_existing_topics(self, scraper, lt):
+        now = datetime.datetime.utcnow()
+        scraper.return_value.get_latest_topics.return_value = dict({
+            1: dict(title='Retry', updated_at=now, changed=False,
+                    retry=True),
+            2: dict(title='Saved', updated_at=now, changed=False,
+                    retry=False),
+        })
+        lt.return_value = {1: None, 2: 'infohash'}
+        state = FeedState.load(self.dir.path)
+
+        pending = manager.Manager(config).make_pending_list(state)
+
+        self.assertEqual([item['id'] for item in pending], [1])
+        self.assertTrue(pending[0]['new'])
+
+    @patch('rtrss.manager.select_users')
+    @patch.object(manager.Manager, 'process_pending_topic')
+    def test_lane_records_unexpected_errors_as_failed(self, ppt, su):
+        su.return_value = ['first user', 'second user']
+        ppt.side_effect = lambda item, user: item['id'] // item['id']
+        items = [dict(id=i) for i in range(4)]
+
+        m = manager.Manager(config)
+        with patch.object(config, 'UPDATE_CONCURRENCY', 2):
+            result = m.process_pending_items(items)
+
+        self.assertEqual(result, 3)
+        self.assertEqual([item['id'] for item in m.failed_items], [0])
+
+    @patch('rtrss.manager.select_users')
+    @patch.object(manager.ChangeBatch, 'flush')
+    @patch.object(manager.Manager, 'process_pending_topic')
+    def test_process_pending_items_raises_if_lane_failed(self, ppt, flush,
+                                                         su):
+        su.return_value = ['first user', 'second user']
+        ppt.side_effect = OperationInterruptedException('tracker is down')
+        items = [dict(id=i) for i in range(4)]
+
+        with patch.object(config, 'UPDATE_CONCURRENCY', 2):
+            with self.assertRaises(OperationInterruptedException):
+                manager.Manager(config).process_pending_items(items)
+
+    @patch('rtrss.manager.select_user')
+    @patch.object(manager.Manager, 'process_pending_topic')
+    def test_process_pending_items_keeps_failed_items(self, ppt, su):
+        ppt.side_effect = [TopicException('failed'), 1]
+        now = datetime.datetime.utcnow()
+        items = [dict(id=i, title='Topic', updated_at=now, changed=False)
+                 for i in range(2)]
+
+        m = manager.Manager(config)
+        with patch.object(config, 'UPDATE_CONCURRENCY', 1):
+            m.process_pending_items(items)
+        state = FeedState.load(self.dir.path)
+        m.save_feed_state(state)
+
+        self.assertEqual(FeedState.load(self.dir.path).retry.keys(), [0])
+
+    @patch('rtrss.manager.select_users')
+    @patch.object(manager.Manager, 'process_pending_topic')
+    def test_add_new_topics_skips_existing_and_stops_at_count(self, ppt, su):
+        self._populate_categories()
+        self.db.add(Topic(id=1, category_id=2, title='Existing',
+                          updated_at=datetime.datetime.utcnow()))
+        self.db.commit()
+        su.return_value = ['first user', 'second user']
+        ppt.return_value = 1
+        torrents = [dict(id=i) for i in range(10)]
+
+        with patch.object(config, 'UPDATE_CONCURRENCY', 2):
+            added = manager.Manager(config).add_new_topics(torrents, 4)
+
+        self.assertIn(added, (4, 5))
+        processed = [c[0][0]['id'] for c in ppt.call_args_list]
+        self.assertEqual(len(processed), added)
+        self.assertNotIn(1, processed)
+
+    @patch.object(manager.ChangeBatch, 'save_cookies')
+    @patch('rtrss.manager.select_user')
+    @patch('rtrss.manager.Scraper')
+    @patch.object(manager.Manager, 'add_new_topics')
+    def test_populate_category_crawls_pages_until_count(self, ant, scraper,
+                                                        su, sc):
+        pages = [[dict(id=i)] for i in range(5)]
+        scraper.return_value.search_pages.return_value = iter(pages)
+        ant.return_value = 1
+
+        added = manager.Manager(config).populate_category(10, 3)
+
+        self.assertEqual(added, 3)
+        self.assertEqual([c[0] for c in ant.call_args_list],
+                         [(pages[0], 3), (pages[1], 2), (pages[2], 1)])
+
+    def test_existing_topic_ids_returns_existing_only(self):
+        self._populate_categories()
+        self.db.add(Topic(id=1, category_id=2, title='Existing',
+                          updated_at=datetime.datetime.utcnow()))
+        self.db.commit()
+
+        self.assertEqual(manager.existing_topic_ids([1, 2]), {1})
+
+    @patch('rtrss.manager.select_user')
+    @patch.object(manager.Manager, 'process_pending_topic')
+    def test_failed_uploads_are_not_saved(self, ppt, su):
+        now = datetime.datetime.utcnow()
+        items = [dict(id=i, title='Topic', updated_at=now, changed=False)
+                 for i in range(1, 3)]
+
+        def process(item, user):
+            m.batch.add_topic(item['id'], 2, now, 'Topic')
+            m.batch.add_torrent(item['id'], str(item['id']) * 40, 1, 1)
+            m.batch.count_torrent(item['id'], 2)
+            return 1
+
+        self._populate_categories()
+        m = manager.Manager(config)
+        m._storage = MagicMock()
+        m._storage.flush.return_value = ['2.torrent']
+        ppt.side_effect = process
+
+        with patch.object(config, 'UPDATE_CONCURRENCY', 1):
+            m.process_pending_items(items)
+
+        self.assertEqual([t.id for t in self.db.query(Torrent)], [1])
+        self.assertEqual([t.id for t in self.db.query(Topic)], [1])
+        self.assertEqual([item['id'] for item in m.failed_items], [2])
+
+    @patch.object(manager.ChangeBatch, 'flush')
+    def test_batch_not_flushed_while_torrent_is_queued(self, flush):
+        m = manager.Manager(config)
+        m._storage = MagicMock()
+        m._storage.flush.return_value = []
+        lane = threading.Thread(target=m.flush_batch)
+
+        def put_async(key, data, mimetype):
+            lane.start()
+            lane.join(0.1)
+            self.assertFalse(flush.called)
+
+        m._storage.put_async.side_effect = put_async
+        m.queue_torrent(1, 'infohash', 1, 'torrent')
+        lane.join()
+
+        self.assertTrue(flush.called)
+
+
+class ChangeBatchTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(ChangeBatchTestCase, self).setUp()
+        self.db.add(Category(id=1, title='Category', tracker_id=1))
+        self.db.add(User(id=1, username='user', password='pass',
+                         downloads_today=1))
+        self.db.commit()
+        self.batch = manager.ChangeBatch()
+        self.now = datetime.datetime.utcnow()
+
+    def test_flush_saves_topics_and_torrents(self):
+        self.batch.add_topic(1, 1, self.now, u'Title')
+        self.batch.add_torrent(1, 'infohash', 100, 10)
+        self.batch.flush()
+        self.assertEqual(self.db.query(Topic).get(1).title, u'Title')
+        self.assertEqual(self.db.query(Torrent).get(1).infohash, 'infohash')
+        self.assertTrue(self.db.query(Topic).get(1).has_torrent)
+        self.assertEqual(len(self.batch), 0)
+
+    def test_flush_updates_existing_topics(self):
+        self.batch.add_topic(1, 1, self.now, u'Old title')
+        self.batch.flush()
+        self.batch.add_topic(1, 1, self.now, u'New title')
+        self.batch.flush()
+        self.assertEqual(self.db.query(Topic).get(1).title, u'New title')
+
+    def test_flush_increments_user_downloads(self):
+        user = AttrDict(id=1, cookies={'key': 'value'})
+        self.batch.add_download(user)
+        self.batch.add_download(user)
+        self.batch.save_cookies(user)
+        self.batch.flush()
+        saved = self.db.query(User).get(1)
+        self.assertEqual(saved.downloads_today, 3)
+        self.assertEqual(saved.cookies, {'key': 'value'})
@@ -0,0 +1,71 @@
+import unittest
+
+from testfixtures import TempDirectory
+from mock import patch
+
+from rtrss.storage import packed
+from rtrss.storage.packed import PackedStorage
+
+
+class PackedStorageTestCase(unittest.TestCase):
+    test_key = '1.torrent'
+    test_value = 'some random value'
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.store = PackedStorage(self.dir.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_get_retrieves_stored(self):
+        self.store.put(self.test_key, self.test_value)
+        self.assertEqual(self.store.get(self.test_key), self.test_value)
+
+    def test_get_returns_none_for_nonexistent(self):
+        self.assertIsNone(self.store.get('nonexistent key'))
+
+    def test_put_overwrites(self):
+        self.store.put(self.test_key, 'old value')
+        self.store.put(self.test_key, self.test_value)
+        self.assertEqual(self.store.get(self.test_key), self.test_value)
+
+    def test_delete_deletes(self):
+        self.store.put(self.test_key, self.test_value)
+        self.store.delete(self.test_key)
+        self.assertIsNone(self.store.get(self.test_key))
+
+    def test_other_instance_sees_changes(self):
+        reader = PackedStorage(self.dir.path)
+        self.store.put(self.test_key, self.test_value)
+        self.assertEqual(reader.get(self.test_key), self.test_value)
+        self.store.bulk_delete([self.test_key])
+        self.assertIsNone(reader.get(self.test_key))
+
+    def test_put_starts_new_segment(self):
+        with patch.object(packed, 'SEGMENT_SIZE', 20):
+            self.store.put_many([(str(i), str(i) * 15) for i in range(3)])
+
+        self.assertEqual(self.store.get('2'), '2' * 15)
+        self.assertEqual(len(self.store._segment_sizes), 3)
+
+    def test_compact_keeps_live_files(self):
+        reader = PackedStorage(self.dir.path)
+        self.store.put_many([(str(i), str(i) * 10) for i in range(10)])
+        self.assertEqual(reader.get('1'), '1' * 10)
+        self.store.bulk_delete([str(i) for i in range(5)])
+
+        self.store.compact()
+
+        self.assertEqual(self.store.garbage_bytes(), 0)
+        self.assertEqual(reader.get('7'), '7' * 10)
+        self.assertIsNone(reader.get('1'))
+        self.assertEqual(self.store.exists_many(['4', '5']),
+                         {'4': False, '5': True})
+
+    def test_bulk_delete_starts_compaction(self):
+        self.store.put_many([(str(i), 'x' * 10) for i in range(4)])
+        with patch.object(packed, 'COMPACT_MIN_GARBAGE', 0), \
+                patch.object(PackedStorage, 'compact_async') as compact:
+            self.store.bulk_delete(['0', '1', '2'])
+        compact.assert_called_once_with()
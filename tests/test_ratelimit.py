@@ -0,0 +1,34 @@
+import unittest
+
+from mock import patch
+
+from rtrss import ratelimit
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    @patch('rtrss.ratelimit.time')
+    def test_reserve_first_token_without_delay(self, mock_time):
+        mock_time.time.return_value = 100.0
+        bucket = ratelimit.TokenBucket(0.5)
+        self.assertEqual(bucket.reserve(), 0)
+
+    @patch('rtrss.ratelimit.time')
+    def test_reserve_waits_only_remaining_interval(self, mock_time):
+        mock_time.time.return_value = 100.0
+        bucket = ratelimit.TokenBucket(0.5)
+        bucket.reserve()
+        mock_time.time.return_value = 101.5
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+
+    @patch('rtrss.ratelimit.time')
+    def test_concurrent_reservations_queue_up(self, mock_time):
+        mock_time.time.return_value = 100.0
+        bucket = ratelimit.TokenBucket(1)
+        bucket.reserve()
+        bucket.reserve()
+        self.assertAlmostEqual(bucket.reserve(), 2)
+
+    def test_get_bucket_shares_bucket_for_key(self):
+        key = ('host', 1, 'test')
+        self.assertIs(ratelimit.get_bucket(key, 1),
+                      ratelimit.get_bucket(key, 1))
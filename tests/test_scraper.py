@@ -1,5 +1,67 @@
+# -*- coding: utf-8 -*-
+import datetime
 import unittest
-from rtrss import scraper
+import multiprocessing
+
+from mock import patch
+
+from rtrss import scraper, config
+from rtrss.feedstate import FeedState
+
+
+FEED_ENTRY = """
+<entry>
+  <title>{title}</title>
+  <link href="http://example.com/forum/viewtopic.php?t={id}"/>
+  <updated>{updated}</updated>
+</entry>"""
+
+
+def make_feed(*entries):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<feed xmlns="http://www.w3.org/2005/Atom">{}</feed>').format(
+        ''.join(FEED_ENTRY.format(id=tid, title='Topic {}'.format(tid),
+                                  updated=updated)
+                for tid, updated in entries))
+
+TOPIC_PAGE = u"""<html><body>
+<table><tr>
+<td class="nav w100 pad_2"><a href="./index.php">Главная</a>
+<em>&raquo;</em> <a href="viewforum.php?c=1">Section</a>
+<em>&raquo;</em> <a href="viewforum.php?f=2">Forum</a></td>
+</tr></table>
+<table><tr><td>
+<span id="tor-hash">0123456789ABCDEF0123456789ABCDEF01234567</span>
+<a href="dl.php?t=1" class="dl-stub dl-link">Download</a>
+</td></tr></table>
+</body></html>"""
+
+SEARCH_ROW = u"""
+<tr class="tCenter hl-tr">
+  <td>1</td><td>2</td>
+  <td><div><a href="tracker.php?f={category_id}">Forum</a></div></td>
+  <td><div><a data-topic_id="{id}" href="viewtopic.php?t={id}">Topic
+    <wbr>{id}</a></div></td>
+  <td><div><a href="tracker.php?pid=7">Author</a></div></td>
+  <td><u>{size}</u><a href="dl.php?t={id}">1 GB</a></td>
+  <td>7</td><td>8</td><td>9</td>
+  <td><u>{updated}</u><p>01-Jan-16</p></td>
+</tr>"""
+
+
+def make_search_page(rows, first=0, pages=()):
+    """
+    Search results page with rows number of topics, starting with topic
+    first + 1, and pagination links to pages starting at given numbers
+    """
+    links = ''.join(
+        u'<a class="pg" href="tracker.php?search_id=a&amp;start={}">{}</a>'
+        .format(start, n) for n, start in enumerate(pages))
+    return (u'<html><body><table id="tor-tbl"><tbody>{}</tbody></table>'
+            u'<p>{}</p></body></html>').format(''.join(
+                SEARCH_ROW.format(id=i + 1, category_id=10, size=1024 * i,
+                                  updated=1451649600 + i)
+                for i in range(first, first + rows)), links)
 
 
 class ScraperTestCase(unittest.TestCase):
@@ -7,3 +69,159 @@ class ScraperTestCase(unittest.TestCase):
         from lxml import etree
         tree = scraper.make_tree('<xml></xml>')
         self.assertIsInstance(tree, etree._Element)
+
+    def test_parse_feed_returns_all_entries_without_state(self):
+        feed = make_feed((3, '2016-01-01T12:02:00+00:00'),
+                         (2, '2016-01-01T12:01:00+00:00'))
+        entries = scraper.Scraper(config).parse_feed(feed)
+        self.assertEqual([e['id'] for e in entries], [3, 2])
+        self.assertEqual(entries[0]['title'], 'Topic 3')
+
+    def test_parse_feed_stops_at_seen_entries(self):
+        feed = make_feed((4, '2016-01-01T12:02:00+00:00'),
+                         (3, '2016-01-01T12:01:00+00:00'),
+                         (2, '2016-01-01T12:01:00+00:00'),
+                         (1, '2016-01-01T12:00:00+00:00'))
+        s = scraper.Scraper(config)
+        state = FeedState()
+        state.advance(s.parse_feed(make_feed(
+            (2, '2016-01-01T12:01:00+00:00'),
+            (1, '2016-01-01T12:00:00+00:00'))))
+
+        entries = s.parse_feed(feed, state)
+        self.assertEqual([e['id'] for e in entries], [4, 3])
+
+        state.advance(entries)
+        self.assertEqual(state.high_water, entries[0]['updated_at'])
+        self.assertEqual(state.seen_ids, {4})
+        self.assertEqual(s.parse_feed(feed, state), [])
+
+    @patch('rtrss.scraper.WebClient')
+    def test_get_latest_topics_returns_entries_to_retry(self, wc):
+        feed = make_feed((4, '2016-01-01T12:02:00+00:00'),
+                         (3, '2016-01-01T12:01:00+00:00'),
+                         (2, '2016-01-01T12:00:00+00:00'),
+                         (1, '2016-01-01T11:59:00+00:00'))
+        wc.return_value.get_feed.return_value.status_code = 200
+        wc.return_value.get_feed.return_value.content = feed
+        s = scraper.Scraper(config)
+        entries = s.parse_feed(feed)
+        state = FeedState()
+        state.advance(entries)
+        state.retry = {2: dict(id=2, updated_at=entries[2]['updated_at']),
+                       5: dict(id=5, updated_at=entries[3]['updated_at'])}
+
+        latest = s.get_latest_topics(state)
+
+        wc.return_value.get_feed.assert_called_once_with()
+        self.assertEqual(latest.keys(), [2])
+        self.assertTrue(latest[2]['retry'])
+        # Topic 5 is no longer in feed
+        self.assertEqual(state.retry.keys(), [2])
+
+    def test_parse_topic_extracts_infohash_and_breadcrumb(self):
+        infohash, catlinks = scraper.parse_topic(TOPIC_PAGE)
+        self.assertEqual(infohash, '0123456789ABCDEF0123456789ABCDEF01234567')
+        self.assertEqual([a.get('href') for a in catlinks],
+                         ['./index.php', 'viewforum.php?c=1',
+                          'viewforum.php?f=2'])
+        self.assertEqual(catlinks[0].text, u'Главная')
+
+    def test_extract_topic_matches_tree_parser(self):
+        for page in (TOPIC_PAGE, TOPIC_PAGE.replace('dl-stub dl-link', '')):
+            extracted = scraper.extract_topic(page)
+            parsed = scraper.parse_topic_tree(page)
+            self.assertEqual(extracted[0], parsed[0])
+            self.assertEqual([a.get('href') for a in extracted[1]],
+                             [a.get('href') for a in parsed[1]])
+
+    def test_extract_topic_returns_none_without_breadcrumb(self):
+        page = TOPIC_PAGE.replace('nav w100 pad_2', 'nav')
+        self.assertIsNone(scraper.extract_topic(page))
+        self.assertEqual(scraper.parse_topic(page)[1], [])
+
+    def test_stoplist_matches_any_message(self):
+        for msg in scraper.TOPIC_STOPLIST:
+            match = scraper.TOPIC_STOPLIST_RE.search(TOPIC_PAGE + msg)
+            self.assertEqual(match.group(0), msg)
+        self.assertIsNone(scraper.TOPIC_STOPLIST_RE.search(TOPIC_PAGE))
+
+    def test_parse_topic_page_runs_in_process_pool(self):
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(scraper.parse_topic_page, (1, TOPIC_PAGE))
+            self.assertEqual(result, scraper.parse_topic_page(1, TOPIC_PAGE))
+            self.assertEqual(result['categories'][2],
+                             dict(tracker_id=2, title='Forum',
+                                  is_subforum=True))
+
+            msg = scraper.TOPIC_STOPLIST[0]
+            with self.assertRaises(scraper.TopicException):
+                pool.apply(scraper.parse_topic_page, (1, TOPIC_PAGE + msg))
+        finally:
+            pool.terminate()
+
+    def test_scraper_uses_started_parse_pool(self):
+        with patch.object(config, 'PARSE_PROCESSES', 1):
+            scraper.start_parse_pool(config)
+        try:
+            s = scraper.Scraper(config)
+            self.assertIsNotNone(s.parse_pool)
+            self.assertEqual(s.parse(scraper.parse_topic_page, 1, TOPIC_PAGE),
+                             scraper.parse_topic_page(1, TOPIC_PAGE))
+        finally:
+            scraper.stop_parse_pool()
+
+        self.assertIsNone(scraper.Scraper(config).parse_pool)
+
+    def test_parse_search_page_parses_rows(self):
+        results = scraper.parse_search_page(make_search_page(2))['rows']
+        self.assertEqual(results[1], dict({
+            'id': 2,
+            'category_id': 10,
+            'title': 'Topic\n    2',
+            'author_id': 7,
+            'author_name': 'Author',
+            'size': 1024,
+            'updated_at': datetime.datetime(2016, 1, 1, 13, 0, 1),
+        }))
+
+    def test_parse_search_row_raises_on_missing_cells(self):
+        page = make_search_page(1).replace('data-topic_id', 'data-id')
+        with self.assertRaises(scraper.ItemProcessingFailedException):
+            scraper.parse_search_page(page)
+
+    def test_parse_search_page_finds_next_page(self):
+        page = scraper.parse_search_page(
+            make_search_page(2, pages=(0, 50, 100)), start=0)
+        self.assertEqual(len(page['rows']), 2)
+        self.assertEqual(page['next_page'], 'tracker.php?search_id=a&start=50')
+        self.assertEqual(page['next_start'], 50)
+
+        page = scraper.parse_search_page(
+            make_search_page(2, pages=(0, 50)), start=50)
+        self.assertIsNone(page['next_page'])
+
+    @patch('rtrss.scraper.WebClient')
+    def test_search_pages_requests_next_page_on_demand(self, wc):
+        wc.return_value.find_torrents.return_value = make_search_page(
+            2, pages=(0, 2, 4))
+        wc.return_value.get_search_page.return_value = make_search_page(
+            2, first=2, pages=(0, 2, 4))
+
+        pages = scraper.Scraper(config).search_pages('user', 10)
+        self.assertEqual([t['id'] for t in next(pages)], [1, 2])
+        self.assertFalse(wc.return_value.get_search_page.called)
+
+        self.assertEqual([t['id'] for t in next(pages)], [3, 4])
+        wc.return_value.get_search_page.assert_called_once_with(
+            'tracker.php?search_id=a&start=2')
+
+    @patch('rtrss.scraper.WebClient')
+    def test_search_pages_stops_at_max_pages(self, wc):
+        wc.return_value.find_torrents.return_value = make_search_page(
+            2, pages=(0, 2, 4))
+
+        pages = scraper.Scraper(config).search_pages('user', 10, max_pages=1)
+        self.assertEqual(len(list(pages)), 1)
+        self.assertFalse(wc.return_value.get_search_page.called)
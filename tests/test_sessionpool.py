@@ -0,0 +1,33 @@
+import unittest
+
+from mock import patch
+
+from rtrss import sessionpool
+
+
+class SessionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = sessionpool.SessionPool(2, 60)
+
+    def test_get_returns_same_session_for_key(self):
+        first, created = self.pool.get('key')
+        second, created_again = self.pool.get('key')
+        self.assertIs(first, second)
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+
+    def test_get_evicts_least_recently_used(self):
+        first, _ = self.pool.get('first')
+        self.pool.get('second')
+        self.pool.get('first')
+        self.pool.get('third')
+        self.assertIs(self.pool.get('first')[0], first)
+        self.assertTrue(self.pool.get('second')[1])
+
+    @patch('rtrss.sessionpool.time')
+    def test_get_evicts_idle_sessions(self, mock_time):
+        mock_time.time.return_value = 100
+        self.pool.get('first')
+        mock_time.time.return_value = 200
+        self.pool.get('second')
+        self.assertEqual(len(self.pool), 1)
@@ -27,3 +27,22 @@ class FileStorageTestCase(unittest.TestCase):
         }
         s = storage.make_storage(settings, self.dir.path)
         self.assertIsInstance(s, storage.gcs.GCSStorage)
+
+    @patch('rtrss.storage.download_and_save_keyfile')
+    def test_makestorage_wraps_remote_storage_with_cache(self, _):
+        settings = {
+            'URL': 'gs:///random bucket name',
+            'CACHE_SIZE': 1
+        }
+        s = storage.make_storage(settings, self.dir.path)
+        self.assertIsInstance(s, storage.cached.CachedStorage)
+
+    def test_makestorage_not_caches_localdirstorage(self):
+        settings = {'URL': 'file:///random directory name', 'CACHE_SIZE': 1}
+        s = storage.make_storage(settings, self.dir.path)
+        self.assertIsInstance(s, storage.localdirectory.LocalDirectoryStorage)
+
+    def test_makestorage_returns_packedstorage(self):
+        settings = {'URL': 'pack:///random directory name'}
+        s = storage.make_storage(settings, self.dir.path)
+        self.assertIsInstance(s, storage.packed.PackedStorage)
@@ -128,3 +128,81 @@ class DownloadAndSaveKeyFileTestCase(unittest.TestCase):
         util.download_and_save_keyfile(self.url, self.filepath)
         self.assertEqual(self.test_data, self.dir.read(self.filename))
 
+
+
+class ClientPoolTestCase(unittest.TestCase):
+    def test_client_reuses_released_client(self):
+        factory = MagicMock(side_effect=lambda: object())
+        pool = util.ClientPool(factory, 2)
+        with pool.client() as first:
+            pass
+        with pool.client() as second:
+            self.assertIs(first, second)
+        self.assertEqual(factory.call_count, 1)
+
+    def test_client_creates_new_client_while_busy(self):
+        factory = MagicMock(side_effect=lambda: object())
+        pool = util.ClientPool(factory, 2)
+        with pool.client() as first:
+            with pool.client() as second:
+                self.assertIsNot(first, second)
+
+    def test_client_in_use_dropped_after_close(self):
+        factory = MagicMock(side_effect=lambda: object())
+        pool = util.ClientPool(factory, 1)
+        with pool.client() as first:
+            pool.close()
+        with pool.client() as second:
+            self.assertIsNot(first, second)
+        self.assertEqual(factory.call_count, 2)
+
+
+class BackgroundUploaderTestCase(unittest.TestCase):
+    def test_flush_waits_for_all_uploads(self):
+        put = MagicMock()
+        uploader = util.BackgroundUploader(put, 3)
+        for i in range(20):
+            uploader.submit(str(i), 'value', mimetype='test')
+
+        self.assertEqual(uploader.flush(), [])
+        self.assertEqual(put.call_count, 20)
+        put.assert_any_call('5', 'value', mimetype='test')
+
+    def test_flush_returns_failed_keys(self):
+        def put(key, value):
+            if key == 'bad':
+                raise ValueError(key)
+
+        uploader = util.BackgroundUploader(put, 2)
+        uploader.submit('good', 'value')
+        uploader.submit('bad', 'value')
+        self.assertEqual(uploader.flush(), ['bad'])
+        self.assertEqual(uploader.flush(), [])
+
+    def test_close_stops_threads(self):
+        put = MagicMock()
+        uploader = util.BackgroundUploader(put, 3)
+        uploader.submit('key', 'value')
+        threads = list(uploader._threads)
+
+        self.assertEqual(uploader.close(), [])
+        self.assertFalse(any(t.is_alive() for t in threads))
+        put.assert_called_once_with('key', 'value')
+
+        # Threads are started again on next submit
+        uploader.submit('other', 'value')
+        self.assertEqual(uploader.close(), [])
+        self.assertEqual(put.call_count, 2)
+
+
+class ParallelMapTestCase(unittest.TestCase):
+    def test_parallel_map_keeps_order(self):
+        self.assertEqual(util.parallel_map(lambda x: x * 2, range(10), 3),
+                         [x * 2 for x in range(10)])
+
+    def test_parallel_map_reraises(self):
+        def func(x):
+            raise ValueError(x)
+
+        with self.assertRaises(ValueError):
+            util.parallel_map(func, range(3), 2)
@@ -8,6 +8,21 @@ from rtrss import torrentfile
 testdata = dict({'some key': 'some value'})
 encoded_testdata = bencode.bencode(testdata)
 
+multifile_testdata = dict({
+    'announce': 'http://tracker/ann?uk=passkey',
+    'announce-list': [['http://tracker/ann?uk=passkey'], ['http://other']],
+    'comment': 'comment',
+    'info': {
+        'name': 'dir',
+        'piece length': 16384,
+        'pieces': 'p' * 200,
+        'files': [
+            {'length': 10, 'path': ['a', 'b.txt']},
+            {'length': 32, 'path': ['c.txt']},
+        ]
+    }
+})
+
 
 class TorrentFileTestCase(unittest.TestCase):
     def test_torrentfile_decoded_equals_encoded(self):
@@ -52,6 +67,55 @@ class TorrentFileTestCase(unittest.TestCase):
         self.assertIn('announce', decoded)
         self.assertEqual(test_announcer, decoded['announce'])
 
+    def test_splice_announcer_equals_reencoded(self):
+        announcer = 'http://tracker/ann?uk=passkey'
+        samples = [
+            dict({'info': {'pieces': 'x' * 100}}),
+            dict({'announce': 'a', 'info': {'length': 1}}),
+            dict({'announce-list': [['a'], ['b']], 'comment': 'c'}),
+            dict({'Z': [1, {'k': 'v'}], 'announce': 'a',
+                  'announce-list': [['a']], 'info': {}}),
+        ]
+        for data in samples:
+            expected = dict(data)
+            expected['announce'] = announcer
+            expected['announce-list'] = \
+                list(data.get('announce-list', [])) + [[announcer]]
+
+            result = torrentfile.splice_announcer(bencode.bencode(data),
+                                                  announcer)
+            self.assertEqual(result, bencode.bencode(expected))
+
+    def test_announce_layout_raises_valueerror_on_invalid_data(self):
+        with self.assertRaises(ValueError):
+            torrentfile.announce_layout('d8:announce')
+
+    def test_infohash_equals_reencoded_info_hash(self):
+        encoded = bencode.bencode(multifile_testdata)
+        self.assertEqual(torrentfile.TorrentFile(encoded).infohash,
+                         torrentfile.TorrentFile(multifile_testdata).infohash)
+
+    def test_download_size_sums_file_lengths(self):
+        tf = torrentfile.TorrentFile(bencode.bencode(multifile_testdata))
+        self.assertEqual(tf.download_size, 42)
+        self.assertIsNone(tf._decoded)
+
+    def test_files_lists_paths_and_lengths(self):
+        tf = torrentfile.TorrentFile(bencode.bencode(multifile_testdata))
+        self.assertEqual(list(tf.files),
+                         [(['a', 'b.txt'], 10), (['c.txt'], 32)])
+
+    def test_remove_announcers_encoded_equals_decoded(self):
+        encoded = torrentfile.TorrentFile(bencode.bencode(multifile_testdata))
+        encoded.remove_announcers_with_passkeys()
+        decoded = torrentfile.TorrentFile(multifile_testdata)
+        decoded.remove_announcers_with_passkeys()
+        self.assertEqual(encoded.encoded, decoded.encoded)
+
+    def test_dict_spans_raises_valueerror_on_trailing_data(self):
+        with self.assertRaises(ValueError):
+            torrentfile.dict_spans(encoded_testdata + 'x')
+
     def test_init_raises_valueerror(self):
         with self.assertRaises(ValueError):
             _ = torrentfile.TorrentFile(None)
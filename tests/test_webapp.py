@@ -1,4 +1,5 @@
 import datetime
+import zlib
 
 from testfixtures import TempDirectory
 
@@ -9,6 +10,8 @@ from rtrss import config
 from rtrss.models import *
 from rtrss.webapp import make_app
 from rtrss import torrentfile
+from rtrss.webapphelpers import get_feed_data
+from rtrss.caching import get_cache, feed_namespace, TREE_NAMESPACE
 
 
 # FIXME this test suite needs refactoring
@@ -28,7 +31,7 @@ class WebAppTestCase(DatabaseTestCase):
 
     def _populate_test_db(self):
         c = Category(id=0, title='Test category', tracker_id=0)
-        t = Topic(id=1, title='Test topic',
+        t = Topic(id=1, title='Test topic', has_torrent=True,
                   updated_at=datetime.datetime.utcnow(), category_id=0)
         t.torrent = Torrent(infohash='testhash', size=1, tfsize=1)
         self.db.add(c)
@@ -45,6 +48,135 @@ class WebAppTestCase(DatabaseTestCase):
         rv = self.app.get('/feed/?pk={}'.format(passkey))
         self.assertIn(passkey, rv.data)
 
+    def test_cached_feed_gets_passkey_of_each_request(self):
+        self._populate_test_db()
+        self.app.get('/feed/?pk=firstpasskey')
+        rv = self.app.get('/feed/?pk=secondpasskey')
+        self.assertIn('secondpasskey', rv.data)
+        self.assertNotIn('firstpasskey', rv.data)
+
+    def test_feed_without_passkey_has_no_passkey_param(self):
+        self._populate_test_db()
+        rv = self.app.get('/feed/')
+        self.assertNotIn('pk=', rv.data)
+
+    def test_category_feed_includes_subcategories(self):
+        self._populate_test_db()
+        self.db.add(Category(id=1, title='Parent', tracker_id=1, parent_id=0))
+        self.db.add(Category(id=2, title='Child', tracker_id=2, parent_id=1))
+        self.db.commit()
+        self.db.add(CategoryClosure(ancestor_id=1, descendant_id=1, depth=0))
+        self.db.add(CategoryClosure(ancestor_id=1, descendant_id=2, depth=1))
+        self.db.query(Topic).get(1).category_id = 2
+        self.db.commit()
+        rv = self.app.get('/feed/1')
+        self.assertIn('Test topic', rv.data)
+
+    def test_feed_has_validators_and_max_age(self):
+        self._populate_test_db()
+        rv = self.app.get('/feed/')
+        self.assertIsNotNone(rv.headers.get('ETag'))
+        self.assertIsNotNone(rv.headers.get('Last-Modified'))
+        self.assertIn('max-age', rv.headers.get('Cache-Control'))
+
+    def test_feed_returns_304_if_not_changed(self):
+        self._populate_test_db()
+        etag = self.app.get('/feed/?pk=passkey').headers['ETag']
+        rv = self.app.get('/feed/?pk=passkey',
+                          headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, '')
+
+    def test_feed_etag_depends_on_passkey(self):
+        self._populate_test_db()
+        etag = self.app.get('/feed/?pk=passkey').headers['ETag']
+        rv = self.app.get('/feed/?pk=otherpasskey',
+                          headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_feed_rendered_again_after_new_topic(self):
+        self._populate_test_db()
+        etag = self.app.get('/feed/').headers['ETag']
+        t = Topic(id=2, title='New topic', has_torrent=True, category_id=0,
+                  updated_at=datetime.datetime.utcnow())
+        t.torrent = Torrent(infohash='newhash', size=1, tfsize=1)
+        self.db.add(t)
+        self.db.commit()
+        get_cache(config).bump(feed_namespace(0))
+
+        rv = self.app.get('/feed/', headers={'If-None-Match': etag})
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('New topic', rv.data)
+
+    def test_feed_rendered_before_bump_not_stored_under_new_version(self):
+        self._populate_test_db()
+
+        def render_and_bump(category_id):
+            data = get_feed_data(category_id)
+            get_cache(config).bump(feed_namespace(0))
+            return data
+
+        with patch('rtrss.views.get_feed_data', render_and_bump):
+            self.app.get('/feed/')
+        with patch('rtrss.views.get_feed_data', wraps=get_feed_data) as gfd:
+            self.app.get('/feed/')
+            self.assertTrue(gfd.called)
+
+    @patch('rtrss.views.get_feed_data', wraps=get_feed_data)
+    def test_feed_not_modified_without_database_queries(self, gfd):
+        self._populate_test_db()
+        etag = self.app.get('/feed/').headers['ETag']
+        self.app.get('/feed/')
+        rv = self.app.get('/feed/', headers={'If-None-Match': etag})
+
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(gfd.call_count, 1)
+
+    @patch('rtrss.views.get_feed_data')
+    def test_empty_feed_rendered_once(self, gfd):
+        gfd.return_value = None
+        for _ in range(2):
+            rv = self.app.get('/feed/')
+            self.assertEqual(rv.status_code, 404)
+        self.assertEqual(gfd.call_count, 1)
+
+    def test_feed_compressed_if_accepted(self):
+        self._populate_test_db()
+        for url in ('/feed/', '/feed/?pk=passkey'):
+            rv = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(rv.headers.get('Content-Encoding'), 'gzip')
+            data = zlib.decompress(rv.data, zlib.MAX_WBITS | 16)
+            self.assertIn('Test topic', data)
+            self.assertIn('Accept-Encoding', rv.headers.get('Vary'))
+
+    def test_feed_not_compressed_if_not_accepted(self):
+        self._populate_test_db()
+        rv = self.app.get('/feed/')
+        self.assertIsNone(rv.headers.get('Content-Encoding'))
+        self.assertIn('Test topic', rv.data)
+
+    @patch('rtrss.views.make_category_tree')
+    def test_loadtree_compressed_if_accepted(self, make_tree):
+        make_tree.return_value = {'test': 'tree'}
+        rv = self.app.get('/loadtree', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers.get('Content-Encoding'), 'gzip')
+        data = zlib.decompress(rv.data, zlib.MAX_WBITS | 16)
+        self.assertIn('treeData', data)
+
+    @patch('rtrss.views.make_category_tree')
+    def test_loadtree_built_once_until_invalidated(self, make_tree):
+        make_tree.return_value = {'test': 'tree'}
+        etag = self.app.get('/loadtree').headers['ETag']
+        rv = self.app.get('/loadtree', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+
+        get_cache(config).bump(TREE_NAMESPACE)
+        rv = self.app.get('/loadtree', headers={'If-None-Match': etag})
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(make_tree.call_count, 2)
+
     @patch('rtrss.views.storage')
     def test_torrent_passkey_embedding(self, mock_storage):
         torrent_id = 1